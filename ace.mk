@@ -1,6 +1,63 @@
 
 ACE_SOURCES=$(wildcard */*.aces)
 
+# worker processes used by acebatch, 0 is one per CPU
+ACE_JOBS ?= 0
+
+# generated code for unchanged sources is reused from here, and an .acec whose
+# contents would not change keeps its timestamp, so its .o isn't rebuilt
+ACE_CACHE ?= ../build/acecache
+
+# the asss headers, indexed once (and kept in ACE_CACHE) so every module is
+# checked against the interfaces, advisers and callbacks they declare, and
+# interfaces used through a pointer named after their type (flagcore-> for
+# Iflagcore) don't need a $#require. see --asss-include
+ACE_ASSS_INCLUDE ?= include
+
+ACE_FLAGS = -l -M --header --prologue aceprologue.h --asss-include $(ACE_ASSS_INCLUDE) --size-probes --cache-dir $(ACE_CACHE)
+
+# set ACE_SOCKET to the socket of a resident "ace.py --socket" daemon, started
+# from src/ with the same ACE_FLAGS, to translate modules without starting a
+# new python process for each. requests are sent with socat.
+ACE_SOCKET ?=
+
+# ace_translate,output,input
+ace_translate = $(if $(ACE_SOCKET),printf 'translate\t%s\t%s\t%s\n' "$$$$PWD" $(2) $(1) \
+	| socat - UNIX-CONNECT:$(ACE_SOCKET) \
+	| awk '/^status /{s=$$$$2; next} {print > "/dev/stderr"} END{exit s == "" || s != 0}',python ace/ace.py $(ACE_FLAGS) -o $(1) $(2))
+
+acecname = $(addprefix ../build/,$(subst .aces,.acec,$(notdir $(1))))
+
+# the public headers written by --header, next to the .acec files. other
+# modules include them as "name.ace.h"; they are only rewritten when a module's
+# interfaces change, so editing a function body doesn't rebuild dependents.
+ACE_HEADERS = $(foreach src,$(ACE_SOURCES),$(subst .acec,.ace.h,$(call acecname,$(src))))
+
+# the headers in ACE_HEADERS a source includes, read by make itself (GNU make
+# 4.2 or later.) its object is only built once they are written, so the first
+# build doesn't need the compiler's dependency file to get the order right.
+ace_used_headers = $(filter $(ACE_HEADERS),$(patsubst "%",../build/%,$(filter "%.ace.h",$(file <$(1)))))
+
+# every .acec starts with #include "aceprologue.h" (asss.h and stdio.h, see
+# --prologue), which is precompiled once; the compiler reads
+# ../build/aceprologue.h.gch instead of parsing the asss headers for each
+# module, as long as it was built with the same CFLAGS.
+ACE_PROLOGUE = ../build/aceprologue.h
+
+# written again whenever ace.py changes, but only touched if its contents do,
+# so the .gch isn't rebuilt for nothing. the stamp keeps make from starting
+# ace.py on every build once ace.py is newer than the header.
+$(ACE_PROLOGUE).stamp: ace/ace.py
+	python ace/ace.py --write-prologue $(ACE_PROLOGUE)
+	touch $@
+
+$(ACE_PROLOGUE): $(ACE_PROLOGUE).stamp ;
+
+$(ACE_PROLOGUE).gch: $(ACE_PROLOGUE)
+	$(CC) $(CFLAGS) -x c-header -MMD -MF $(ACE_PROLOGUE).d -MT $@ -o $@ $<
+
+-include $(ACE_PROLOGUE).d
+
 define regacecallback
 
 CALLBACKS := $(CALLBACKS) acehandler,$(1),$(2)
@@ -10,16 +67,65 @@ endef
 
 define acehandler
 
--include $(subst .acec,.d,$1)
-.PHONY: $(subst .acec,.d,$1)
+# $(1).d is written by ace.py, $(1:.acec=.d) by the compiler
+-include $(subst .acec,.d,$1) $(1).d
+.PHONY: $(subst .acec,.d,$1) $(1).d
 
 $(1): $(2)
-	python ace/ace.py -l -o $(1) $(2)
+	$(call ace_translate,$(1),$(2))
+
+# written along with $(1)
+$(1:.acec=.ace.h): $(1) ;
 
-$(1:.acec=.o): $(1) $(2)
-	$(CC) $(CFLAGS) -I$(dir $(2)) -c -x c -o $(1:.acec=.o) $(1)
-	$(CC) $(CFLAGS) -I$(dir $(2)) -c -x c -MF $(1:.acec=.d) -MT $(1:.acec=.o) -MM $(1)
+$(1:.acec=.o): $(1) $(ACE_PROLOGUE).gch | $(call ace_used_headers,$(2))
+	$(CC) $(CFLAGS) -I$(dir $(2)) -I$(dir $(1)) -c -x c -MMD -MF $(1:.acec=.d) -MT $(1:.acec=.o) -o $(1:.acec=.o) $(1)
 
 endef
 
-$(foreach src,$(ACE_SOURCES),$(eval $(call regacecallback,$(addprefix ../build/,$(subst .aces,.acec,$(notdir $(src)))),$(src))))
+$(foreach src,$(ACE_SOURCES),$(eval $(call regacecallback,$(call acecname,$(src)),$(src))))
+
+# regenerates every stale .acec with a single ace.py process instead of one
+# process per module. "make acebatch" before the normal build.
+../build/ace.stamp: $(ACE_SOURCES)
+	python ace/ace.py $(ACE_FLAGS) -j $(ACE_JOBS) $(foreach src,$?,$(src):$(call acecname,$(src)))
+	touch $@
+
+.PHONY: acebatch
+acebatch: ../build/ace.stamp
+
+# "make acegraph" checks which modules need others loaded before them, from
+# their $#require and $#implement directives, and writes the order to load
+# them in to ../build/acemodules.conf, as lines for conf/modules.conf. modules
+# that require each other when they load are an error. see --graph
+../build/acemodules.conf: $(ACE_SOURCES)
+	python ace/ace.py --graph --graph-dot ../build/acemodules.dot -o $@ $(ACE_SOURCES)
+
+.PHONY: acegraph
+acegraph: ../build/acemodules.conf
+
+# "make acebudget" adds up the player and arena data of every ACE module, from
+# the sizes --size-probes puts in their objects, and fails if it is more than
+# asss allows (General:PerPlayerBytes and PerArenaBytes, read from
+# ACE_GLOBAL_CONF if set), naming the modules whose data should be dynamic.
+# see --budget
+ACE_GLOBAL_CONF ?=
+
+.PHONY: acebudget
+acebudget: $(foreach src,$(ACE_SOURCES),$(subst .acec,.o,$(call acecname,$(src))))
+	python ace/ace.py --budget $(if $(ACE_GLOBAL_CONF),--global-conf $(ACE_GLOBAL_CONF)) $^
+
+# every ACE module in a single translation unit, see --unity. asss.h is only
+# parsed once, and helpers can be inlined across modules. "make aceunity"
+# builds ../build/aceunity.o, to be linked instead of the modules' own objects.
+../build/aceunity.c: $(ACE_SOURCES)
+	python ace/ace.py -l -M --header --asss-include $(ACE_ASSS_INCLUDE) --size-probes --unity -o $@ $(ACE_SOURCES)
+
+-include ../build/aceunity.c.d
+
+../build/aceunity.o: ../build/aceunity.c
+	$(CC) $(CFLAGS) $(addprefix -I,$(sort $(dir $(ACE_SOURCES)))) -I../build -c -x c -MMD -MF ../build/aceunity.d -o $@ $<
+
+-include ../build/aceunity.d
+
+.PHONY: aceunity
+aceunity: ../build/aceunity.o
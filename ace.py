@@ -17,16 +17,32 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/gpl-2.0.html>.
 
-import sys, re
+import sys, os, re, time
+from collections import OrderedDict
+import hashlib, multiprocessing, threading, subprocess
+import cPickle, SocketServer, json, urllib, urlparse
 from cStringIO import StringIO
 from optparse import OptionParser
 
+try:
+	import pyinotify
+except ImportError:
+	pyinotify = None
+
+ACE_VERSION = 'beta 2'
+
 class ProcessingException(Exception):
-	def __init__(self, processor, value):
+	def __init__(self, processor, value, line=None):
 		self.processor = processor
 		self.value = value
+		# the line the error is about, if not the one being processed, and
+		# the file it is in if that is not the one being processed either
+		self.line = line
+		self.filename = None
+	def lineNumber(self):
+		return self.line or self.processor.current_line
 	def message(self):
-		return self.processor.filename + ':' + str(self.processor.current_line) + ': error: ' + self.value
+		return (self.filename or self.processor.filename) + ':' + str(self.lineNumber()) + ': error: ' + self.value
 	def __str__(self):
 		return repr(self.message())
 
@@ -35,6 +51,8 @@ class Processor:
 	InlineEx = re.compile(r'^(\s*)\$(\w+)\((.*)\)[;]?(.*)\s*$')
 	
 	InterfaceUsageEx = re.compile(r'(\w+)->\w+?\(')
+	# a pointer declared as a parameter or local variable, as in "Target *t"
+	PointerDeclarationEx = re.compile(r'[\w,]\s*\*+\s*(\w+)\s*(?=[;,=)\[])')
 	StringEx = re.compile(r'\s*(".*")\s*')
 	
 	CPreprocessorEx = re.compile(r'^#(include|define) (\S+)[ ]?(.+)?\s*')
@@ -110,7 +128,7 @@ class Processor:
 				advType = 'A' + advId[2:].lower()
 				
 		processor.active_adviser = module.createAdviser(scope, advType, advId)
-		processor.active_adviser.file = processor.filename
+		processor.active_adviser.file = processor.line_filename
 		processor.active_adviser.line_number = processor.current_line
 
 		return 'endadviser' # return the expected follow up directive
@@ -153,6 +171,10 @@ class Processor:
 #per-arena-data (using the undocumented global setting on load
 #General:PerArenaBytes, with a default of 10000.) ACE avoids this problem using
 #a wrapper struct.
+# fields of dynamic arena data may start with "hot", and be put in a group, as
+#in $#playerdata. the interface pointers of arena $#require and $#use are kept
+#with the hot fields, as in ad->stats, and the hot fields are zeroed each time
+#the module is attached to the arena.
 
 ##
 	ArenadataParamEx = re.compile(r'^[ ]?(\w+)?$')
@@ -269,7 +291,7 @@ class Processor:
 		cbId = paramMatch.group(2)
 		
 		processor.active_callback = module.createCallback(scope, cbId)
-		processor.active_callback.file = processor.filename
+		processor.active_callback.file = processor.line_filename
 		processor.active_callback.line_number = processor.current_line
 		return 'endcallback' # return the expected follow up directive
 		
@@ -324,7 +346,7 @@ class Processor:
 				
 		names = paramMatch.group(2)
 		processor.active_command = module.createCommand(scope, names)
-		processor.active_command.file = processor.filename
+		processor.active_command.file = processor.line_filename
 		processor.active_command.line_number = processor.current_line
 		return 'endcommand' # return the expected follow up directive
 
@@ -479,7 +501,7 @@ class Processor:
 				
 		processor.active_interface = module.createImplementation(scope, \
 			intType, intId, intName)
-		processor.active_interface.file = processor.filename
+		processor.active_interface.file = processor.line_filename
 		processor.active_interface.line_number = processor.current_line
 		
 		return 'endimplement' # return the expected follow up directive
@@ -501,6 +523,49 @@ class Processor:
 		return None
 
 
+##directive: import
+
+# Imports a fragment: an .aces file without a $#module line, holding
+#directives, functions and code shared by several modules (for example
+#$#require lines, $#playerdata fields and helper functions.) Everything in the
+#fragment is merged into this module, as if it were written here.
+# Fragments are parsed once per build and reused for every module importing
+#them (see --cache-dir.) Keep them out of the directories ace.mk translates,
+#in a subdirectory for example.
+
+##param: path: the fragment, in double quotes, relative to the file with the
+#$#import.
+
+##
+	ImportParamEx = re.compile(r'^ "([^"]+)"\s*$')
+	def handleImport(processor, module, params):
+		if processor.active_structure:
+			raise ProcessingException(processor, 'unexpected $#import')
+		paramMatch = Processor.ImportParamEx.match(params)
+		if not paramMatch:
+			raise ProcessingException(processor,
+				'syntax error in $#import: expected a file name in double quotes')
+
+		path = importPath(processor.filename, paramMatch.group(1))
+		importing = processor.importing + [os.path.normpath(processor.filename)]
+		if path in importing:
+			raise ProcessingException(processor, 'import cycle: ' +
+				' -> '.join(importing[importing.index(path):] + [path]))
+		if path in module.imports:
+			# a fragment is merged once, however it is reached
+			return None
+		try:
+			fragment = parseFragment(path, processor.options, importing)
+		except IOError, e:
+			(errno, message) = e
+			raise ProcessingException(processor, 'unable to read ' + path + ': ' + message)
+		processor.mergeFragment(fragment, path)
+		for imported in fragment.imports + [path]:
+			if imported not in module.imports:
+				module.imports.append(imported)
+		return None
+
+
 ##directive: load
 
 # Defines a code block for extra code to use during MM_LOAD.
@@ -560,6 +625,9 @@ class Processor:
 ##
 	ModuleParamEx = re.compile(r'^ (\w+)$')
 	def handleModule(processor, module, params):
+		if processor.fragment:
+			raise ProcessingException(processor,
+				'unexpected $#module in a fragment, it gets the name of the module importing it')
 		if module.name:
 			raise ProcessingException(processor,
 				'unexpected $#module, $#module is only allowed on first line of module')
@@ -592,9 +660,43 @@ class Processor:
 #per-player-data (using the undocumented global setting on load
 #General:PerPlayerBytes, with a default of 4000) ACE avoids this problem using
 #a wrapper struct.
+# a field of dynamic player data starting with "hot" (as in "hot int kills;")
+#is kept in the data asss stores for the player instead, so it is read without
+#following a pointer. if there are hot fields, $useplayerdata() points to them,
+#and the other fields (which may start with "cold") are reached through its
+#"cold" member, as in pdata->cold->name. cold is NULL while the rest of
+#dynamic player data would not be allocated. the hot fields are zeroed along
+#with it: when the player enters an arena the module is attached to (or it is
+#attached to theirs) and when the rest is freed.
+# with --packed-layout, a field may also be put in a group, after hot or cold,
+#as in "group pos int x;". the fields of a group are kept next to each other,
+#and checked to fit in a cache line. the fields are only reordered if that
+#makes the struct smaller and ACE knows the size of every one of them.
+
+##[param]: pool: only for dynamic player data, "pool" followed by an optional
+#slab size (by default, 32). the structs are taken from a pool kept by the
+#module instead of being allocated and freed one at a time as players enter and
+#leave arenas. the pool starts with a slab of that many structs and grows by
+#another when it runs out; memory goes back to the pool, and is only freed when
+#the module unloads.
+# with pool, the type may be left out, and is dynamic.
+
+##[param]: lazy: only for dynamic player data, before "pool" if both are used.
+#a player's struct isn't allocated when they enter an arena, but the first time
+#$useplayerdata() is used for them, so players the module never looks at cost
+#only the wrapper. $peekplayerdata() gives the struct without allocating it, or
+#NULL if it hasn't been. with hot fields, $peekplayerdata() always points to
+#them, so it reads and writes them without allocating the rest; only its cold
+#member is NULL until $useplayerdata() is used for the player.
+# the struct is freed when the player leaves the arena (any arena, since it may
+#have been allocated outside of the attached ones) or disconnects, or the
+#module is detached from it.
+# the struct is allocated and freed under a lock of the module's own (from the
+#pool too, if there is one), so $useplayerdata() may be used from any thread.
+# with lazy, the type may be left out, and is dynamic.
 
 ##
-	PlayerdataParamEx = re.compile(r'^[ ]?(\w+)?$')
+	PlayerdataParamEx = re.compile(r'^[ ]?(\w+)?(?: (lazy))?(?: (pool)(?: (\d+))?)?\s*$')
 	def handlePlayerdata(processor, module, params):
 		if processor.active_structure:
 			raise ProcessingException(processor, 'unexpected $#playerdata')
@@ -604,14 +706,41 @@ class Processor:
 			raise ProcessingException(processor, 'syntax error in $#playerdata')
 		
 		type = paramMatch.group(1)
+		lazy = paramMatch.group(2)
+		pool = paramMatch.group(3)
+		if type == 'lazy' and not lazy:
+			lazy = type
+			type = None
+		elif type == 'pool' and not lazy and not pool:
+			pool = type
+			type = None
 		if type and type <> 'static' and type <> 'dynamic':
 			raise ProcessingException(processor,
-				'syntax error in $#playerdata: expected: "static" or "dynamic" or nothing as the only parameter')
+				'syntax error in $#playerdata: expected: "static" or "dynamic" or nothing, then optionally "lazy", then optionally "pool" and a size')
+		if pool and type == 'static':
+			raise ProcessingException(processor,
+				'a pool is only used for dynamic player data')
+		if lazy and type == 'static':
+			raise ProcessingException(processor,
+				'only dynamic player data can be allocated lazily')
+		if type == 'static' and module.per_player_data \
+			and (module.per_player_data.pool or module.per_player_data.lazy):
+			raise ProcessingException(processor,
+				'player data with a pool or allocated lazily is dynamic, it can\'t be made static')
 		
-		if type == 'static' or (not type and not module.per_player_data):
+		if type == 'static' or (not type and not pool and not lazy and not module.per_player_data):
 			module.setupPlayerData(dynamic=False)
 		else:
 			module.setupPlayerData(dynamic=True)
+		if pool:
+			size = int(paramMatch.group(4) or ACEPlayerData.PoolSize)
+			if size < 1:
+				raise ProcessingException(processor, 'the pool size must be at least 1')
+			module.per_player_data.pool = size
+		if lazy:
+			module.per_player_data.lazy = True
+		if pool or lazy:
+			module.per_player_data.updateActionFunction()
 		processor.active_structure = module.per_player_data
 		return 'endplayerdata' # return the expected follow up directive
 
@@ -671,6 +800,8 @@ class Processor:
 				'expected: "global" or "arena" as first parameter to $#require')
 
 		intType = paramMatch.group(2)
+		if not intType:
+			raise ProcessingException(processor, 'expected: an interface type after the scope of $#require')
 		
 		pointer = paramMatch.group(3)
 		if not pointer:
@@ -698,7 +829,7 @@ class Processor:
 			intName = intNameParam
 
 		dep = module.createDependency(scope, intType, pointer, intId, intName,
-			False, processor.filename, processor.current_line)
+			False, processor.line_filename, processor.current_line)
 
 		return None
 
@@ -822,7 +953,7 @@ class Processor:
 			intName = intNameParam
 			
 		dep = module.createDependency(scope, intType, pointer, intId, intName,
-			True, processor.filename, processor.current_line)		
+			True, processor.line_filename, processor.current_line)		
 		return None
 		
 ##inline: failattach
@@ -1022,11 +1153,48 @@ class Processor:
 		return module.per_player_data.getInvokeCode(paramMatch.group(1),
 			paramMatch.group(2), whitespace)
 
+
+##inline: peekplayerdata
+
+# Declare a pointer to the player data struct, like $useplayerdata(), but
+#without allocating it for lazy player data (see $#playerdata.) the pointer (or
+#its cold member, if there are hot fields) is NULL if the player's struct
+#hasn't been allocated.
+
+##param: var: the name of the variable to declare
+
+##param: player: the pointer to the player to point to
+
+##
+	def handlePeekplayerdata(processor, module, whitespace, params):
+		if not module.per_player_data:
+			raise ProcessingException(processor,
+				'$peekplayerdata() appeared when per-player-data is not defined for this module')
+		paramMatch = Processor.UseplayerdataParamEx.match(params)
+		if not paramMatch:
+			raise ProcessingException(processor,
+				'syntax error in $peekplayerdata()')
+		
+		return module.per_player_data.getPeekCode(paramMatch.group(1),
+			paramMatch.group(2), whitespace)
+
 	
-	def __init__(self, filename, module):
+	def __init__(self, filename, module, source=None):
+		# source is the text of the module, read from filename if not given.
 		self.filename = filename
+		# the name used in #line directives, see lineFilename()
+		self.line_filename = filename
 		self.module = module
-		self.file_handle = open(filename, 'rU')
+		if source is None:
+			handle = open(filename, 'rU')
+			try:
+				source = handle.read()
+			finally:
+				handle.close()
+		else:
+			# the same newline handling as reading in universal newline mode
+			source = source.replace('\r\n', '\n').replace('\r', '\n')
+		self.source = StringIO(source)
 		self.current_line = 0
 		self.expected_directive = 'module'
 		
@@ -1037,8 +1205,25 @@ class Processor:
 		self.active_command = None
 		self.active_structure = None
 		self.function_mode = False
+		self.function_start = 0
+		self.function_header = None
+		self.function_text = []
+		# the pointers the function (or block) being captured declares, which
+		# aren't interfaces whatever they are named, see --asss-include
+		self.local_pointers = set()
 		
 		self.use_line_directives = False
+		# a dict from newStats() to collect statistics in, see --stats
+		self.stats = None
+		# an index from loadInterfaceIndex() of the interfaces in the asss
+		# headers, see --asss-include
+		self.index = None
+		# the options the module is parsed with, for the fragments it imports
+		self.options = None
+		# parsing a fragment for $#import, which has no $#module line, and the
+		# files importing it (to find import cycles)
+		self.fragment = False
+		self.importing = []
 
 	def registerFunction(self, function):
 		self.module.functions.append(function)
@@ -1057,10 +1242,12 @@ class Processor:
 					'two functions in $#command block')
 			self.active_command.function = function
 
+	def lineDirective(self):
+		return '\n#line ' + str(self.current_line) + ' "' + self.line_filename + '"\n'
+
 	def addLineDirectives(self, line):
 		if self.use_line_directives and self.needs_line_directive:
-			line_directive = '\n#line ' + str(self.current_line) + ' "' \
-				+ self.filename + '"\n'
+			line_directive = self.lineDirective()
 			if line.find('\n', 0, -1) != -1:
 				multiline = line[0:-1].split('\n')
 				line = ''
@@ -1071,16 +1258,83 @@ class Processor:
 				line = line_directive + line
 		return line
 
+	def captureFunctionLine(self, line):
+		# called for each line of a function, starting with its declaration.
+		# the declaration is matched once, as soon as its opening brace is
+		# seen. after that lines are only collected until the unindented }, so
+		# capturing a function takes time linear in its length.
+		# returns the ACEFunction when it is complete.
+		if self.needs_line_directive:
+			line = self.addLineDirectives(line)
+			self.needs_line_directive = False
+
+		# same as ACEFunction.FunctionEndEx
+		if line == '}\n' or line == '}':
+			if not self.function_header:
+				raise ProcessingException(self,
+					'syntax error in function definition. check to make sure your function is declared properly')
+			declaration, name, params = self.function_header
+			newFn = ACEFunction(declaration, name, params,
+				''.join(self.function_text))
+			if self.use_line_directives:
+				newFn.file = self.line_filename
+				newFn.line_number = self.function_start
+			self.function_header = None
+			self.function_text = []
+			return newFn
+
+		self.function_text.append(line)
+		if not self.function_header and '{' in line:
+			text = ''.join(self.function_text)
+			header = ACEFunction.FunctionHeaderEx.search(text)
+			if header:
+				self.function_header = header.group(2, 3, 4)
+				self.function_text = [text[header.end():]]
+		return None
+
 	def process(self):
-		buffer = StringIO()
-		function_start = 0
 		new_line_previously = False
 		self.needs_line_directive = False
-		
-		for line in self.file_handle:
+
+		# every line is classified once by looking at how it starts (and at
+		# a few characters it must contain), and only the expressions that can
+		# possibly match a line of that kind are tried on it.
+		InlineMatch = Processor.InlineEx.match
+		DirectiveMatch = Processor.DirectiveEx.match
+		CPreprocessorMatch = Processor.CPreprocessorEx.match
+		StringMatch = Processor.StringEx.match
+		InterfaceUsageFindall = Processor.InterfaceUsageEx.findall
+		PointerDeclarationFindall = Processor.PointerDeclarationEx.findall
+		FunctionDeclareMatch = ACEFunction.FunctionDeclareEx.match
+		StructDeclareMatch = ACEStructure.StructDeclareEx.match
+		StructDeclareExtraMatch = ACEStructure.StructDeclareExtraEx.match
+		StructEndMatch = ACEStructure.StructEndEx.match
+		StructFieldMatch = ACEStructure.StructFieldEx.match
+		TypedefDeclareMatch = ACEStructure.TypedefDeclareEx.match
+
+		# with statistics, the time spent on each line is charged to what the
+		# processor was doing when the line was read.
+		stats = self.stats
+		if stats is not None:
+			clock = time.time
+			phase = 'classify'
+			mark = clock()
+
+		for line in self.source:
+			if stats is not None:
+				now = clock()
+				stats[phase] += now - mark
+				mark = now
+				if self.function_mode:
+					phase = 'function_capture'
+				elif self.active_structure:
+					phase = 'struct_capture'
+				else:
+					phase = 'classify'
+
 			used_inline = False
 			self.current_line += 1
-			
+
 			if not self.function_mode and (line == '\n' or line == '\r\n'):
 				if new_line_previously:
 					self.needs_line_directive = True
@@ -1088,38 +1342,63 @@ class Processor:
 				new_line_previously = True
 			else:
 				new_line_previously = False
-				
-			inline = Processor.InlineEx.match(line)
-			if inline:
-				initialWhitespace = inline.group(1)
-				if not initialWhitespace:
-					initialWhitespace = ''
-				if self.active_extrablock:
-					initialWhitespace = '\t\t' + initialWhitespace
-				inlineName = inline.group(2)
-				inlineParams = inline.group(3)
-				extraJunk = inline.group(4)
-
-				if inlineName in InlineHandlers:
-					line = InlineHandlers[inlineName](self, \
-						self.module, initialWhitespace, inlineParams) \
-						+ extraJunk + '\n'
-					if line.find('\n', 0, -1) != -1:
-						self.needs_line_directive = True
-					used_inline = True
-				else:
-					raise ProcessingException(self,
-						'unknown inline function $' + inlineName + '()')
 
-			if self.function_mode or self.active_extrablock:
-				interfacesUsed = Processor.InterfaceUsageEx.findall(line)
+			# lead is the first non-whitespace character of the line
+			lead = line[0]
+			if lead.isspace():
+				lead = line.lstrip()[:1]
+
+			if lead == '$' and line[0:2] != '$#':
+				inline = InlineMatch(line)
+				if inline:
+					initialWhitespace = inline.group(1)
+					if not initialWhitespace:
+						initialWhitespace = ''
+					if self.active_extrablock:
+						initialWhitespace = '\t\t' + initialWhitespace
+					inlineName = inline.group(2)
+					inlineParams = inline.group(3)
+					extraJunk = inline.group(4)
+
+					if inlineName in InlineHandlers:
+						line = InlineHandlers[inlineName](self, \
+							self.module, initialWhitespace, inlineParams) \
+							+ extraJunk + '\n'
+						if line.find('\n', 0, -1) != -1:
+							self.needs_line_directive = True
+						used_inline = True
+						lead = line.lstrip()[:1]
+						if stats is not None:
+							stats['inlines'] += 1
+					else:
+						raise ProcessingException(self,
+							'unknown inline function $' + inlineName + '()')
+
+			if self.index and (self.function_mode or self.active_extrablock) and '*' in line:
+				self.local_pointers.update(PointerDeclarationFindall(line))
+
+			if (self.function_mode or self.active_extrablock) and '->' in line:
+				interfacesUsed = InterfaceUsageFindall(line)
 				if interfacesUsed:
 					for key in interfacesUsed:
 						if key in ACEModule.autoInterfaces:
 							self.module.addAutoDependency(key)
-							
-			if not self.function_mode:
-				directive = Processor.DirectiveEx.match(line)
+						elif self.index and key in self.index['auto'] \
+							and key not in self.local_pointers \
+							and key not in self.module.arena_dependencies \
+							and key not in self.module.optional_arena_dependencies:
+							self.module.addAutoDependency(key, self.index['auto'][key])
+
+			if self.function_mode:
+				newFn = self.captureFunctionLine(line)
+				if newFn:
+					self.registerFunction(newFn)
+					self.function_mode = False
+					self.needs_line_directive = True
+				continue
+
+			if line[0:2] == '$#':
+				directive = DirectiveMatch(line)
 				if directive:
 					directiveName = directive.group(1)
 					directiveParams = directive.group(2)
@@ -1130,18 +1409,20 @@ class Processor:
 							'only valid directive here is a $#' +
 							self.expected_directive + ' directive, encountered "' +
 							directiveName + '"')
-			
+
 					if directiveName in DirectiveHandlers:
+						self.local_pointers = set()
 						self.expected_directive = DirectiveHandlers[directiveName]( \
 							self, self.module, directiveParams)
 						self.needs_line_directive = True
+						if stats is not None:
+							stats['directives'] += 1
 						continue
 					else:
 						raise ProcessingException(self,
 							'unknown directive $#' + directiveName)
-						includeCheck = ACEModule.includeCRegex.match(line)
-				
-				cpp = Processor.CPreprocessorEx.match(line)
+			elif line[0:1] == '#':
+				cpp = CPreprocessorMatch(line)
 				if cpp:
 					if cpp.group(1) == 'include':
 						include = cpp.group(2)
@@ -1150,75 +1431,58 @@ class Processor:
 					elif cpp.group(1) == 'define':
 						self.module.defines[cpp.group(2)] = cpp.group(3)
 					continue
-			
-			else:
-				line = self.addLineDirectives(line)
-				buffer.write(line)
-				self.needs_line_directive = False
-				function_end = ACEFunction.FunctionEndEx.match(line)
-				if function_end:
-					function_definition = ACEFunction.FunctionCompleteEx.search(buffer.getvalue())
-					if function_definition:
-						newFn = ACEFunction(function_definition.group(2), function_definition.group(3), function_definition.group(4), function_definition.group(5))
-						if self.use_line_directives:
-							newFn.file = self.filename
-							newFn.line_number = function_start
-						self.registerFunction(newFn)
-						self.function_mode = False
-						buffer.truncate(0)
-						self.needs_line_directive = True
-					else:
-						raise ProcessingException(self,
-							'syntax error in function definition. check to make sure your function is declared properly')
-				continue
-				
-			if self.current_line == 1:
+
+			if self.current_line == 1 and not self.fragment:
 				raise ProcessingException(self, '$#module not on first line')
 
 			if not self.active_extrablock and not self.active_structure:
-				function_part = ACEFunction.FunctionDeclareEx.match(line)
-				if function_part:
-					# we are capturing a function, when we get the complete function
-					# we will flush the buffer. until then, wait for the next line
-					self.function_mode = True
-					function_start = self.current_line
-					line = self.addLineDirectives(line)
-					buffer.write(line)
-					self.needs_line_directive = False
-					continue
-					
-				struct_begin = ACEStructure.StructDeclareEx.match(line)
-				if struct_begin:
-					self.active_structure = ACEStructure(self.module, struct_begin.group(2))
-					if self.use_line_directives:
-						self.active_structure.line_number = self.current_line
-						self.active_structure.file = self.filename
-					continue
-					
-				typedef_declare = ACEStructure.TypedefDeclareEx.match(line)
-				if typedef_declare:
-					if self.use_line_directives:
-						self.module.typedefs.append((self.filename, self.current_line, typedef_declare.group(1)))
-					else:
-						self.module.typedefs.append((None, None, typedef_declare.group(1)))
-					continue
+				if '(' in line:
+					function_part = FunctionDeclareMatch(line)
+					if function_part:
+						# we are capturing a function, when we get the complete function
+						# we will register it. until then, wait for the next line
+						self.function_mode = True
+						self.function_start = self.current_line
+						self.function_header = None
+						self.function_text = []
+						if self.index:
+							self.local_pointers = set(PointerDeclarationFindall(line))
+						self.captureFunctionLine(line)
+						continue
+
+				if 'struct' in line:
+					struct_begin = StructDeclareMatch(line)
+					if struct_begin:
+						self.active_structure = ACEStructure(self.module, struct_begin.group(2))
+						if self.use_line_directives:
+							self.active_structure.line_number = self.current_line
+							self.active_structure.file = self.line_filename
+						continue
+
+				if line[0:7] == 'typedef':
+					typedef_declare = TypedefDeclareMatch(line)
+					if typedef_declare:
+						if self.use_line_directives:
+							self.module.typedefs.append((self.line_filename, self.current_line, typedef_declare.group(1)))
+						else:
+							self.module.typedefs.append((None, None, typedef_declare.group(1)))
+						continue
 
 			if self.active_structure:
 				if self.active_structure.closeviaregex:
-					ignore_line = ACEStructure.StructDeclareExtraEx.match(line)
-					if ignore_line:
+					if lead == '{' and StructDeclareExtraMatch(line):
 						continue
-						
-					end_struct = ACEStructure.StructEndEx.match(line)
+
+					end_struct = lead == '}' and StructEndMatch(line)
 					if end_struct:
 						if end_struct.group(1):
 							if self.active_structure.name and self.active_structure.name != end_struct.group(1):
 								raise ProcessingException(self, 'struct name inconsistency, check to make sure the struct is named as you want it')
 							self.active_structure.name = end_struct.group(1)
-							
+
 						if not self.active_structure.name:
 							raise ProcessingException(self, 'structures must have a name specified')
-						
+
 						varname = None
 						if self.active_structure.parent_structure:
 							varname = self.active_structure.name
@@ -1226,50 +1490,75 @@ class Processor:
 
 						if self.active_structure.name:
 							self.module.structs.append(self.active_structure)
-							
+
 						if self.active_structure.parent_structure:
-							self.active_structure.parent_structure.pushItem(self.filename, self.current_line, self.active_structure.name + ' ' + varname)
+							self.active_structure.parent_structure.pushItem(self.line_filename, self.current_line, self.active_structure.name + ' ' + varname)
 						self.active_structure = self.active_structure.parent_structure
 						continue
 
-				nested_struct_begin = ACEStructure.StructDeclareEx.match(line)
+				nested_struct_begin = 'struct' in line and StructDeclareMatch(line)
 				if nested_struct_begin:
 					new_structure = ACEStructure(self.module, nested_struct_begin.group(2))
 					new_structure.parent_structure = self.active_structure
 					self.active_structure = new_structure
 					if self.use_line_directives:
 						new_structure.line_number = self.current_line
-						new_structure.file = self.filename
+						new_structure.file = self.line_filename
 						continue
-				
-				itemSpecified = ACEStructure.StructFieldEx.match(line)
+
+				itemSpecified = ';' in line and StructFieldMatch(line)
 				if itemSpecified:
-					self.active_structure.pushItem(self.filename, self.current_line, itemSpecified.group(1))
+					item = itemSpecified.group(1)
+					hot = False
+					if not self.active_structure.closeviaregex:
+						# $#playerdata and $#arenadata fields may be marked hot or cold
+						placement = ACEStructure.FieldPlacementEx.match(item)
+						if placement:
+							hot = placement.group(1) == 'hot'
+							if not hot and not self.active_structure.dynamic:
+								raise ProcessingException(self,
+									'cold fields are only for dynamic data, static data is all kept together')
+							item = placement.group(2)
+						group = ACEStructure.FieldGroupEx.match(item)
+						if group:
+							item = group.group(2)
+							self.active_structure.groups[(self.line_filename, self.current_line, item)] = group.group(1)
+							if self.module.packed_layout:
+								# for the offsetof() checking the group
+								self.module.includes['<stddef.h>'] = '<stddef.h>'
+					self.active_structure.pushItem(self.line_filename, self.current_line, item, hot)
 				continue
 			elif self.active_command:
-				string_capture = Processor.StringEx.match(line)
+				string_capture = lead == '"' and StringMatch(line)
 				if string_capture:
 					if self.use_line_directives and self.needs_line_directive:
 						self.active_command.addHelpLine(string_capture.group(1),
-							self.filename, self.current_line)
+							self.line_filename, self.current_line)
 						self.needs_line_directive = False
 					else:
 						self.active_command.addHelpLine(string_capture.group(1))
 				else:
 					self.needs_line_directive = True
 				continue
-					
-			if self.active_extrablock and not used_inline:
-				line = '\t\t' + line
 
-			line = self.addLineDirectives(line)
-			self.needs_line_directive = False
-					
 			if self.active_extrablock:
-				self.active_extrablock.write(line)
-			else:
-				if line <> '\n' and line <> '\r\n':
-					self.module.writeCode(line)
+				if used_inline:
+					self.active_extrablock.write(self.addLineDirectives(line))
+				else:
+					# a single source line, written after its indent instead
+					# of building a new indented copy
+					if self.use_line_directives and self.needs_line_directive:
+						self.active_extrablock.write(self.lineDirective())
+					self.active_extrablock.write('\t\t')
+					self.active_extrablock.write(line)
+			elif line <> '\n' and line <> '\r\n':
+				self.module.writeCode(self.addLineDirectives(line))
+			self.needs_line_directive = False
+
+		if stats is not None:
+			stats[phase] += clock() - mark
+			stats['lines'] = self.current_line
+			stats['functions'] = len(self.module.functions)
 
 		if self.function_mode:
 			raise ProcessingException(self,
@@ -1278,7 +1567,244 @@ class Processor:
 			raise ProcessingException(self,
 				'expected $#' + self.expected_directive + ' before end of file')
 		self.module.last_line_number = self.current_line
-
+		self.checkImportedData()
+		# what a fragment declares is checked in the module importing it
+		if self.index and not self.fragment:
+			self.checkInterfaces()
+
+	def checkImportedData(self):
+		for (filename, line, data, kind) in self.module.imported_data:
+			structure = getattr(self.module, data)
+			if structure.accessKind() <> kind:
+				e = ProcessingException(self, 'an imported fragment uses ' +
+					structure.name + ' as ' + kind + ', but it is ' +
+					structure.accessKind() + ' in this module, so the fragment\'s code would not find it', line)
+				if filename <> self.filename:
+					e.filename = filename
+				raise e
+
+	# the lists in a module a fragment adds to, see ACEModule.import_parts
+	mergedLists = ('typedefs', 'structs', 'functions', 'internal_arena_callbacks',
+		'my_global_advisers', 'my_global_callbacks', 'my_global_interfaces',
+		'my_global_commands', 'my_arena_advisers', 'my_arena_callbacks',
+		'my_arena_interfaces', 'my_arena_commands',
+		'per_arena_data.items', 'per_arena_data.hot_items', 'per_arena_data.managed_items',
+		'per_player_data.items', 'per_player_data.hot_items', 'per_player_data.managed_items')
+
+	def mergedList(module, name):
+		for attribute in name.split('.'):
+			module = getattr(module, attribute, None)
+		return module
+	mergedList = staticmethod(mergedList)
+
+	def mergeFragment(self, fragment, path):
+		# merges a fragment parsed by parseFragment() into the module. the
+		# fragment is a copy of its own, whose parts are taken over. what it
+		# imported itself that the module has already is left out.
+		module = self.module
+		moved = []
+		dropped = [part for part in fragment.import_parts if part[0] in module.imports]
+		kept = [part for part in fragment.import_parts if part[0] not in module.imports]
+		if dropped:
+			leave = {}
+			for (imported, objects, ranges) in dropped:
+				for name, items in objects.iteritems():
+					for item in items:
+						leave[id(item)] = item
+			for name in Processor.mergedLists:
+				items = Processor.mergedList(fragment, name)
+				if items:
+					items[:] = [item for item in items if id(item) not in leave]
+		cuts = {}
+		for name in ACEModule.codeBuffers:
+			cuts[name] = mergeRanges([part[2][name] for part in dropped])
+			if cuts[name]:
+				text = getattr(fragment, name).getvalue()
+				setattr(fragment, name, StringIO())
+				last = 0
+				for (start, end) in cuts[name]:
+					getattr(fragment, name).write(text[last:start])
+					last = end
+				getattr(fragment, name).write(text[last:])
+
+		ranges = {}
+		for name in ACEModule.codeBuffers:
+			start = len(getattr(module, name).getvalue())
+			getattr(module, name).write(getattr(fragment, name).getvalue()
+				.replace(FragmentModuleName, module.name))
+			ranges[name] = (start, len(getattr(module, name).getvalue()))
+		objects = {}
+		for name in Processor.mergedLists:
+			objects[name] = list(Processor.mergedList(fragment, name) or [])
+		for (imported, items, parts) in kept:
+			module.import_parts.append((imported, items, dict([(name,
+				(ranges[name][0] + cutPosition(cuts[name], parts[name][0]),
+				ranges[name][0] + cutPosition(cuts[name], parts[name][1])))
+				for name in ACEModule.codeBuffers])))
+		module.import_parts.append((path, objects, ranges))
+
+		for include in fragment.includes:
+			module.includes.setdefault(include, include)
+		module.defines.update(fragment.defines)
+		module.typedefs.extend(fragment.typedefs)
+		module.structs.extend(fragment.structs)
+		moved.extend(fragment.structs)
+
+		for deps in ('global_dependencies', 'optional_global_dependencies',
+			'arena_dependencies', 'optional_arena_dependencies'):
+			for pointer, dep in getattr(fragment, deps).iteritems():
+				existing = getattr(module, deps).get(pointer)
+				if not existing:
+					getattr(module, deps)[pointer] = dep
+					moved.append(dep)
+				elif (existing.type, existing.identifier, existing.name) \
+					!= (dep.type, dep.identifier, dep.name):
+					raise ProcessingException(self, 'the fragment declares ' +
+						pointer + ' as ' + dep.type + ' (' + (dep.name or dep.identifier) +
+						'), but this module as ' + existing.type + ' (' +
+						(existing.name or existing.identifier) + ')')
+
+		# the fragment's $usearenadata() and $useplayerdata() were expanded
+		# for its own data, which has to end up reached the same way as the
+		# module's. that is only known once the module is complete, see
+		# checkImportedData()
+		for data in ('per_arena_data', 'per_player_data'):
+			if getattr(fragment, data):
+				module.imported_data.append((self.line_filename, self.current_line,
+					data, getattr(fragment, data).accessKind()))
+		module.imported_data.extend(fragment.imported_data)
+
+		if fragment.per_arena_data:
+			if not module.per_arena_data:
+				module.per_arena_data = fragment.per_arena_data
+				moved.append(fragment.per_arena_data)
+			else:
+				module.per_arena_data.items.extend(fragment.per_arena_data.items)
+				module.per_arena_data.hot_items.extend(fragment.per_arena_data.hot_items)
+				module.per_arena_data.managed_items.extend(fragment.per_arena_data.managed_items)
+				module.per_arena_data.groups.update(fragment.per_arena_data.groups)
+				module.per_arena_data.dynamic |= fragment.per_arena_data.dynamic
+
+		# dynamic player data comes with a callback to allocate it, which the
+		# module may have already
+		internal = [cb.function for cb in fragment.internal_arena_callbacks]
+		if fragment.per_player_data:
+			if not module.per_player_data:
+				module.per_player_data = fragment.per_player_data
+				moved.append(fragment.per_player_data)
+			else:
+				module.per_player_data.items.extend(fragment.per_player_data.items)
+				module.per_player_data.hot_items.extend(fragment.per_player_data.hot_items)
+				module.per_player_data.managed_items.extend(fragment.per_player_data.managed_items)
+				module.per_player_data.groups.update(fragment.per_player_data.groups)
+				module.per_player_data.dynamic |= fragment.per_player_data.dynamic
+				module.per_player_data.pool = module.per_player_data.pool or fragment.per_player_data.pool
+				module.per_player_data.lazy |= fragment.per_player_data.lazy
+			if fragment.internal_arena_callbacks and not module.internal_arena_callbacks:
+				module.internal_arena_callbacks.extend(fragment.internal_arena_callbacks)
+				moved.extend(fragment.internal_arena_callbacks)
+				module.per_player_data.action_function = fragment.per_player_data.action_function
+				internal = []
+			if module.per_player_data.action_function:
+				module.per_player_data.updateActionFunction()
+		module.functions.extend([fn for fn in fragment.functions if fn not in internal])
+
+		for name in ('my_global_advisers', 'my_global_callbacks', 'my_global_interfaces',
+			'my_global_commands', 'my_arena_advisers', 'my_arena_callbacks',
+			'my_arena_interfaces', 'my_arena_commands'):
+			getattr(module, name).extend(getattr(fragment, name))
+			moved.extend(getattr(fragment, name))
+		for int in fragment.my_global_interfaces + fragment.my_arena_interfaces:
+			if FragmentModuleName in int.name:
+				int.name = int.name.replace(FragmentModuleName, module.name)
+				int.var = int.name.replace('-', '_').lower() + '_interface'
+
+		module.force_attach |= fragment.force_attach
+		module.force_fail_load_label |= fragment.force_fail_load_label
+		module.force_fail_attach_label |= fragment.force_fail_attach_label
+		module.use_mutex = module.use_mutex or fragment.use_mutex
+		for item in moved:
+			item.module = module
+
+	def checkInterfaces(self):
+		# checks the interfaces, advisers and callbacks of the module against
+		# self.index and the headers the module includes. an interface that
+		# isn't declared anywhere would only fail to load on the server, and
+		# a function that doesn't match the slot it fills not even that.
+		module = self.module
+		index, complete = moduleIndex(self.index, module, self.filename)
+		implements = module.my_global_interfaces + module.my_arena_interfaces
+		implemented = [int.identifier for int in implements]
+		for deps in (module.global_dependencies, module.optional_global_dependencies,
+			module.arena_dependencies, module.optional_arena_dependencies):
+			for dep in deps.itervalues():
+				# automatic dependencies and named implementations aren't checked
+				if dep.line_number is None or dep.name:
+					continue
+				self.checkIdentifier(index, dep.type, dep.identifier, dep)
+				if complete and dep.type not in index['types'] \
+					and dep.identifier not in index['identifiers'] \
+					and dep.identifier not in implemented:
+					raise self.errorAt('unknown interface ' + dep.type +
+						' (' + dep.identifier + '), it is not declared in the asss headers or the headers this module includes',
+						dep)
+		for int in implements:
+			self.checkIdentifier(index, int.type, int.identifier, int)
+			self.checkSlots(index, int, '$#implement')
+		for adv in module.my_global_advisers + module.my_arena_advisers:
+			self.checkIdentifier(index, adv.type, adv.identifier, adv)
+			if complete and adv.type not in index['types']:
+				raise self.errorAt('unknown adviser ' + adv.type +
+					' (' + adv.identifier + '), it is not declared in the asss headers or the headers this module includes',
+					adv)
+			self.checkSlots(index, adv, '$#adviser')
+		for cb in module.my_global_callbacks + module.my_arena_callbacks:
+			if cb.identifier not in index['callbacks']:
+				if complete:
+					raise self.errorAt('unknown callback ' + cb.identifier +
+						', it is not declared in the asss headers or the headers this module includes',
+						cb)
+				continue
+			declared = index['callbacks'][cb.identifier]
+			fn = cb.function
+			if declared and not sameSignature(fn.declaration, fn.params, declared[0], declared[2]):
+				raise self.errorAt(cb.identifier + ' callbacks are ' +
+					signatureText(declared[0], declared[1], declared[2]) + ', but ' +
+					fn.name + ' is ' + signatureText(fn.declaration, fn.name, fn.params),
+					fn.line_number and fn or cb)
+
+	def checkIdentifier(self, index, type, identifier, item):
+		declared = index['identifiers'].get(identifier)
+		if declared and declared != type:
+			raise self.errorAt(identifier + ' is the identifier of ' +
+				declared + ', not ' + type, item)
+
+	def errorAt(self, value, item):
+		# an error about something parsed before, with a file and line_number
+		# of its own. it may be from a fragment imported with $#import.
+		error = ProcessingException(self, value, item.line_number)
+		if item.file and item.file != self.line_filename:
+			error.filename = item.file
+		return error
+
+	def checkSlots(self, index, impl, directive):
+		# the functions of an $#implement or $#adviser block against the
+		# function pointers of the struct, in order
+		if impl.type not in index['types']:
+			return
+		slots = index['types'][impl.type][1]
+		if slots is None:
+			# the struct has members other than functions
+			return
+		if len(impl.functions) != len(slots):
+			raise self.errorAt('%s has %d functions, but the %s block has %d'
+				% (impl.type, len(slots), directive, len(impl.functions)), impl)
+		for fn, (declaration, name, params) in zip(impl.functions, slots):
+			if fn and not sameSignature(fn.declaration, fn.params, declaration, params):
+				raise self.errorAt(name + ' of ' + impl.type + ' is ' +
+					signatureText(declaration, name, params) + ', but ' + fn.name +
+					' is ' + signatureText(fn.declaration, fn.name, fn.params),
+					fn.line_number and fn or impl)
 
 DirectiveHandlers = {'adviser': Processor.handleAdviser,
 	'endadviser': Processor.handleEndadviser,
@@ -1294,6 +1820,7 @@ DirectiveHandlers = {'adviser': Processor.handleAdviser,
 	'enddetach': Processor.handleEnddetach,
 	'implement': Processor.handleImplement,
 	'endimplement': Processor.handleEndimplement,
+	'import': Processor.handleImport,
 	'load': Processor.handleLoad,
 	'endload': Processor.handleEndload,
 	'module': Processor.handleModule,
@@ -1311,7 +1838,8 @@ InlineHandlers = {'null': Processor.handleNull,
 	'failload': Processor.handleFailload,
 	'failattach': Processor.handleFailattach,
 	'usearenadata': Processor.handleUsearenadata,
-	'useplayerdata': Processor.handleUseplayerdata
+	'useplayerdata': Processor.handleUseplayerdata,
+	'peekplayerdata': Processor.handlePeekplayerdata
 }
 
 class ACEModule:
@@ -1327,10 +1855,20 @@ class ACEModule:
 			'net': ('Inet', 'I_NET')
 	}
 
+	# code collected while parsing, kept in StringIO buffers
+	codeBuffers = ['midcode', 'extra_loadfirst_code', 'extra_unloadfirst_code',
+		'extra_attachfirst_code', 'extra_detachfirst_code',
+		'extra_loadlast_code', 'extra_unloadlast_code', 'extra_attachlast_code',
+		'extra_detachlast_code']
+
 	def __init__(self):
 		self.name = None
 
 		self.use_line_directives = False
+		# see --packed-layout
+		self.packed_layout = False
+		# see --size-probes
+		self.size_probes = False
 		
 		self.midcode = StringIO()
 		self.extra_loadfirst_code = StringIO()
@@ -1350,20 +1888,20 @@ class ACEModule:
 		self.per_player_data = None
 		self.use_mutex = None
 		
-		self.includes = {'<stdio.h>': '<stdio.h>'}
-		self.defines = {}
+		# ordered, so the generated code only depends on the source (see writeOut)
+		self.includes = OrderedDict([('<stdio.h>', '<stdio.h>')])
+		self.defines = OrderedDict()
 		self.typedefs = []
 		self.structs = []
 		self.functions = []
 		
-		self.global_dependencies = {'lm': ACEDependency(self, 'Ilogman', 'lm',
-			'I_LOGMAN')
-		}
+		self.global_dependencies = OrderedDict([('lm', ACEDependency(self,
+			'Ilogman', 'lm', 'I_LOGMAN'))])
 		
-		self.optional_global_dependencies = {}
+		self.optional_global_dependencies = OrderedDict()
 	
-		self.arena_dependencies = {}
-		self.optional_arena_dependencies = {}
+		self.arena_dependencies = OrderedDict()
+		self.optional_arena_dependencies = OrderedDict()
 	
 		self.my_global_advisers = []
 		self.my_global_callbacks = []
@@ -1376,7 +1914,40 @@ class ACEModule:
 		self.my_arena_commands = []
 		
 		self.internal_arena_callbacks = []
+		# the fragments merged in with $#import, directly or not
+		self.imports = []
+		# (file, line, data attribute, accessKind()) for the data each of them
+		# was written against
+		self.imported_data = []
+		# (path, {attribute: [objects]}, {buffer: (start, end)}) for what each
+		# of them brought in, to leave it out when it is imported again through
+		# another fragment
+		self.import_parts = []
 		self.last_line_number = 0
+		self.source_file = None
+		# the name used in #line directives, see lineFilename()
+		self.line_file = None
+		# the file name of the header written by writeHeader, if there is one
+		self.public_header = None
+		# the header written by writePrologue to start the module with, if any
+		self.prologue = None
+		# part of a --unity build: the includes are written once for every
+		# module
+		self.unity = False
+
+	def __getstate__(self):
+		# StringIO buffers can't be pickled, they are saved as their contents
+		state = self.__dict__.copy()
+		for key in ACEModule.codeBuffers:
+			state[key] = state[key].getvalue()
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		for key in ACEModule.codeBuffers:
+			buffer = StringIO()
+			buffer.write(state[key])
+			setattr(self, key, buffer)
 
 	def writeCode(self, code):
 		self.midcode.write(code)
@@ -1426,7 +1997,7 @@ class ACEModule:
 				self.optional_arena_dependencies[newDep.pointer] = newDep;
 			if not self.per_arena_data:
 				self.per_arena_data = ACEArenaData(self)
-			self.per_arena_data.pushItem(file, line, newDep.type + ' *' + newDep.pointer)
+			self.per_arena_data.pushItem(file, line, newDep.type + ' *' + newDep.pointer, managed=True)
 		return newDep
 			
 	def createImplementation(self, scope, intType, intId, intName):
@@ -1448,18 +2019,26 @@ class ACEModule:
 	def setupPlayerData(self, dynamic=False):
 		if not self.per_player_data:
 			self.per_player_data = ACEPlayerData(self, dynamic)
-			if dynamic:
-				newfnbody = '\n\tif (action == PA_PREENTERARENA && arena->status <= ARENA_RUNNING)\n\t{\n' + self.per_player_data.getWrapperInvokeCode('pdata', 'p', '\t\t') + '\t\twrapped_pdata->data = amalloc(sizeof(*wrapped_pdata));\n'
-				newfnbody += '\t}\n\telse if (action == PA_LEAVEARENA)\n\t{\n' + self.per_player_data.getInvokeCode('pdata', 'p', '\t\t') + '\n\t\twrapped_pdata->data = NULL;\n\t\tafree(pdata);\n\t}\n'
-				newfn = ACEFunction('void', 'ace_playeraction', 'Player *p, int action, Arena *arena', newfnbody)
-				newfn.body = newfnbody
-				self.functions.append(newfn)
-				newcb = ACECallback(self, 'CB_PLAYERACTION')
-				newcb.function = newfn
-				self.internal_arena_callbacks.append(newcb)
 		else:
 			self.per_player_data.dynamic = dynamic
 
+		# dynamic player data is allocated by a callback, which goes away again
+		# if a later $#playerdata makes it static
+		if dynamic and not self.per_player_data.action_function:
+			newfn = ACEFunction('void', 'ace_playeraction', 'Player *p, int action, Arena *arena', None)
+			self.per_player_data.action_function = newfn
+			self.per_player_data.updateActionFunction()
+			self.functions.append(newfn)
+			newcb = ACECallback(self, 'CB_PLAYERACTION')
+			newcb.function = newfn
+			self.internal_arena_callbacks.append(newcb)
+		elif not dynamic and self.per_player_data.action_function:
+			oldfn = self.per_player_data.action_function
+			self.per_player_data.action_function = None
+			self.functions.remove(oldfn)
+			self.internal_arena_callbacks = [cb for cb in self.internal_arena_callbacks
+				if cb.function is not oldfn]
+
 		self.addAutoDependency('pd')
 	
 	def isAttachable(self):
@@ -1519,275 +2098,438 @@ class ACEModule:
 			return True
 		return False
 
-	def addAutoDependency(self, key):
+	DeclaredNameEx = re.compile(r'^(?:local|static)\s+[^;=(]*?(\w+)\s*(?:\[[^\]]*\]\s*)*[=;]', re.M)
+	TypedefNameEx = re.compile(r'(?:\(\s*\*\s*(\w+)\s*\)|(\w+)\s*(?:\[[^\]]*\]\s*)*$)')
+
+	def fileScopeSymbols(self):
+		# the names this module declares at file scope, for --unity, as the
+		# keys of an OrderedDict. dependency pointers are the module's own
+		# too: each module gets and releases its own reference, and may fail
+		# to get one another module has. local variables in the module code
+		# are found by looking for "local" or "static" declarations at the
+		# start of a line.
+		symbols = OrderedDict()
+		symbols['mm'] = None
+		for deps in (self.global_dependencies, self.optional_global_dependencies):
+			for key, dep in deps.iteritems():
+				symbols[dep.pointer] = None
+		if self.per_arena_data:
+			symbols['arenaDataKey'] = None
+		if self.per_player_data:
+			symbols['playerDataKey'] = None
+			if self.per_player_data.dynamic and self.per_player_data.pool:
+				for name in ACEPlayerData.PoolSymbols:
+					symbols[name] = None
+			if self.per_player_data.dynamic and self.per_player_data.lazy:
+				symbols['ace_pdata_touch'] = None
+				symbols['ace_pdata_mutex'] = None
+		if self.use_mutex:
+			symbols['ace_mutex'] = None
+
+		for data in (self.per_arena_data, self.per_player_data):
+			if data:
+				symbols[data.name] = None
+				if data.dynamic:
+					symbols[data.keyType()] = None
+					symbols[data.heapType()] = None
+				if data.isSplit():
+					symbols[data.hotZero()] = None
+				for name in data.unpackedTypes():
+					symbols[name] = None
+		for struct in self.structs:
+			symbols[struct.name] = None
+			if struct.dynamic:
+				symbols['wrapper_' + struct.name] = None
+		for file, line, typedef in self.typedefs:
+			name = ACEModule.TypedefNameEx.search(typedef)
+			if name:
+				symbols[name.group(1) or name.group(2)] = None
+
+		for fn in self.functions:
+			symbols[fn.name] = None
+		for cmd in self.my_global_commands + self.my_arena_commands:
+			if cmd.helptext:
+				symbols[cmd.names[0] + '_help'] = None
+		for int in self.my_global_interfaces + self.my_arena_interfaces:
+			symbols[int.var] = None
+		for adv in self.my_global_advisers + self.my_arena_advisers:
+			symbols[adv.var] = None
+		for name in ACEModule.DeclaredNameEx.findall(self.midcode.getvalue()):
+			symbols[name] = None
+		return symbols
+
+	def addAutoDependency(self, key, interface=None):
+		# interface is (type, identifier), by default from autoInterfaces
 		if key in self.global_dependencies or key in self.optional_global_dependencies:
 			return
-		type, identifier = ACEModule.autoInterfaces[key]
+		type, identifier = interface or ACEModule.autoInterfaces[key]
 		self.global_dependencies[key] = ACEDependency(self, type, key, identifier)
 		
-	def writeOut(self):
-		print '#include "asss.h"'
-		
-		print
+	def writeOut(self, out=None):
+		# writes the generated C code to out, which may be any object with a
+		# write method. by default, to stdout.
+		# the output only depends on the source text and the options, never on
+		# dict ordering: includes and defines come in the order they first
+		# appear in the source (after <stdio.h>), dependencies in the order
+		# they were declared or first needed (after lm), and everything else
+		# (structs, functions, callbacks, commands, interfaces, advisers) in
+		# source order. dependencies are released in the same order as they
+		# are obtained.
+		if out is None:
+			out = sys.stdout
+		line_file = self.line_file or self.source_file
+
+		if not self.unity:
+			if self.prologue:
+				print >>out, '#include "' + self.prologue + '"'
+			else:
+				print >>out, '#include "asss.h"'
+			
+			print >>out
 
-		for value in self.includes.values():
-			print '#include', value
+			for value in self.includes.itervalues():
+				if self.prologue and value in PrologueIncludes:
+					continue
+				print >>out, '#include', value
 		
 		for key, value in self.defines.iteritems():
-			print '#define', key, value
+			print >>out, '#define', key, value
 		
 		for file, line, typedef in self.typedefs:
 			if file and line:
-				print '#line %i "%s"' % (line, file)
-			print 'typedef', typedef + ';'
+				print >>out, '#line %i "%s"' % (line, file)
+			print >>out, 'typedef', typedef + ';'
 			
 		for struct in self.structs:
-			struct.printDeclareCode()
-			print
+			struct.printDeclareCode(out)
+			print >>out
+
+		if self.public_header:
+			print >>out, '#include "' + self.public_header + '"'
 
-		print
+		print >>out
 		
-		print 'local Imodman *mm;'
-		for key, dep in self.global_dependencies.items():
-			dep.printDeclareCode()
-		for key, dep in self.optional_global_dependencies.items():
-			dep.printDeclareCode()
+		print >>out, 'local Imodman *mm;'
+		for key, dep in self.global_dependencies.iteritems():
+			dep.printDeclareCode(out)
+		for key, dep in self.optional_global_dependencies.iteritems():
+			dep.printDeclareCode(out)
 		
-		print 
+		print >>out
 		
 		for cmd in self.my_global_commands:
-			cmd.printDeclareCode()
+			cmd.printDeclareCode(out)
 		for cmd in self.my_arena_commands:
-			cmd.printDeclareCode()
+			cmd.printDeclareCode(out)
 			
 		for fn in self.functions:
-			print fn.prototype()
-		print
+			print >>out, fn.prototype()
+		print >>out
 			
 		for int in self.my_global_interfaces:
-			int.printDeclareCode()
+			int.printDeclareCode(out)
 		for int in self.my_arena_interfaces:
-			int.printDeclareCode()
+			int.printDeclareCode(out)
 		for adv in self.my_global_advisers:
-			adv.printDeclareCode()
+			adv.printDeclareCode(out)
 		for adv in self.my_arena_advisers:
-			adv.printDeclareCode()
+			adv.printDeclareCode(out)
 			
 		if self.per_arena_data:
-			print
-			self.per_arena_data.printDeclareCode()
+			print >>out
+			self.per_arena_data.printDeclareCode(out)
 
 		if self.per_player_data:
-			print
-			self.per_player_data.printDeclareCode()
+			print >>out
+			self.per_player_data.printDeclareCode(out)
+
+		if self.size_probes:
+			if self.per_arena_data:
+				self.per_arena_data.printProbeCode(out, 'arena')
+			if self.per_player_data:
+				self.per_player_data.printProbeCode(out, 'player')
 
 		if self.use_mutex:
-			print '\nlocal pthread_mutex_t ace_mutex;'
+			print >>out, '\nlocal pthread_mutex_t ace_mutex;'
 			
-		print self.midcode.getvalue()
+		print >>out, self.midcode.getvalue()
 
 		for fn in self.functions:
-			print fn.code()
+			print >>out, fn.code()
 		
 		# entry point function
 		if self.use_line_directives:
-			print '#line 1 "' + self.source_file + '"'
+			print >>out, '#line 1 "' + line_file + '"'
+
+		print >>out, 'EXPORT int MM_' + self.name + '(int _action, Imodman *_mm, Arena *arena)\n{'
 
-		print 'EXPORT int MM_' + self.name + '(int _action, Imodman *_mm, Arena *arena)\n{'
+		# lazy player data can be allocated in any arena, so it is freed
+		# when the player leaves any of them
+		lazy_pdata = self.per_player_data and self.per_player_data.dynamic \
+			and self.per_player_data.lazy
+		if lazy_pdata:
+			internal_global_callbacks = self.internal_arena_callbacks
+			internal_arena_callbacks = []
+		else:
+			internal_global_callbacks = []
+			internal_arena_callbacks = self.internal_arena_callbacks
 		
 		# MM_LOAD
 		if self.useFailLoadLabel():
-			print '\tint failedLoad = FALSE;'
+			print >>out, '\tint failedLoad = FALSE;'
 		if self.useFailAttachLabel():
-			print '\tint failedAttach = FALSE;'
+			print >>out, '\tint failedAttach = FALSE;'
 
-		print '\tif (_action == MM_LOAD)\n\t{'
+		print >>out, '\tif (_action == MM_LOAD)\n\t{'
 		if self.use_mutex:
-			print '\t\tpthread_mutexattr_t attr;'
-		print '\n\t\tmm = _mm;'
-		print '\t\tlm = mm->GetInterface(I_LOGMAN, ALLARENAS);'
-		print '\t\tif (!lm)\n\t\t{'
-		print '\t\t\tfprintf(stderr, "<' + self.name + '> error obtaining required interface I_LOGMAN " I_LOGMAN);'
-		print '\t\t\treturn MM_FAIL;'
-		print '\t\t}'
-		
-		for key, dep in self.global_dependencies.items():
+			print >>out, '\t\tpthread_mutexattr_t attr;'
+		print >>out, '\n\t\tmm = _mm;'
+		print >>out, '\t\tlm = mm->GetInterface(I_LOGMAN, ALLARENAS);'
+		print >>out, '\t\tif (!lm)\n\t\t{'
+		print >>out, '\t\t\tfprintf(stderr, "<' + self.name + '> error obtaining required interface I_LOGMAN " I_LOGMAN);'
+		print >>out, '\t\t\treturn MM_FAIL;'
+		print >>out, '\t\t}'
+		
+		for key, dep in self.global_dependencies.iteritems():
 			if key == 'lm':
 				continue
-			dep.printLoadCode(failGracefully=False)
+			dep.printLoadCode(out, failGracefully=False)
 
-		for key, dep in self.optional_global_dependencies.items():
-			dep.printLoadCode(failGracefully=True)
+		for key, dep in self.optional_global_dependencies.iteritems():
+			dep.printLoadCode(out, failGracefully=True)
 
 		if self.per_arena_data:
-			self.per_arena_data.printLoadCode()
+			self.per_arena_data.printLoadCode(out)
 			
 		if self.per_player_data:
-			self.per_player_data.printLoadCode()
+			self.per_player_data.printLoadCode(out)
 			
-		print self.extra_loadfirst_code.getvalue()
+		print >>out, self.extra_loadfirst_code.getvalue()
 
 		if self.use_mutex:
-			print '\t\tpthread_mutexattr_init(&attr);'
-			print '\t\tpthread_mutexattr_settype(&attr, PTHREAD_MUTEX_RECURSIVE);'
-			print '\t\tpthread_mutex_init(&ace_mutex, &attr);'
-			print '\t\tpthread_mutexattr_destroy(&attr);'
+			print >>out, '\t\tpthread_mutexattr_init(&attr);'
+			print >>out, '\t\tpthread_mutexattr_settype(&attr, PTHREAD_MUTEX_RECURSIVE);'
+			print >>out, '\t\tpthread_mutex_init(&ace_mutex, &attr);'
+			print >>out, '\t\tpthread_mutexattr_destroy(&attr);'
 	
+		for cb in internal_global_callbacks:
+			cb.printLoadCode(out)
+
 		for cb in self.my_global_callbacks:
-			cb.printLoadCode()
+			cb.printLoadCode(out)
 			
 		for adv in self.my_global_advisers:
-			adv.printLoadCode()
+			adv.printLoadCode(out)
 
 		for cmd in self.my_global_commands:
-			cmd.printLoadCode()
+			cmd.printLoadCode(out)
 						
-		print self.extra_loadlast_code.getvalue()
+		print >>out, self.extra_loadlast_code.getvalue()
 		
 		for int in self.my_global_interfaces:
-			int.printLoadCode()
+			int.printLoadCode(out)
 		
-		print '\t\treturn MM_OK;'
-		print '\t}'
+		print >>out, '\t\treturn MM_OK;'
+		print >>out, '\t}'
 		
 		# MM_UNLOAD
-		print '\telse if (_action == MM_UNLOAD)\n\t{'
+		print >>out, '\telse if (_action == MM_UNLOAD)\n\t{'
 		
 		for int in self.my_global_interfaces:
-			int.printUnloadCode()
+			int.printUnloadCode(out)
 			
-		print self.extra_unloadfirst_code.getvalue()
+		print >>out, self.extra_unloadfirst_code.getvalue()
 			
 		for cmd in self.my_global_commands:
-			cmd.printUnloadCode()
+			cmd.printUnloadCode(out)
 			
 		for adv in self.my_global_advisers:
-			adv.printUnloadCode()
+			adv.printUnloadCode(out)
 			
 		for cb in self.my_global_callbacks:
-			cb.printUnloadCode()
+			cb.printUnloadCode(out)
+
+		for cb in internal_global_callbacks:
+			cb.printUnloadCode(out)
 			
 		if self.use_mutex:
-			print '\t\tpthread_mutex_destroy(&ace_mutex);'
+			print >>out, '\t\tpthread_mutex_destroy(&ace_mutex);'
 			
 		if self.useFailLoadLabel():
-			print 'ace_fail_load:'
+			print >>out, 'ace_fail_load:'
 		
-		print self.extra_unloadlast_code.getvalue()
+		print >>out, self.extra_unloadlast_code.getvalue()
 		
 		if self.per_player_data:
-			self.per_player_data.printUnloadCode()
+			self.per_player_data.printUnloadCode(out)
 				
 		if self.per_arena_data:
-			self.per_arena_data.printUnloadCode()
+			self.per_arena_data.printUnloadCode(out)
 			
-		for key, dep in self.global_dependencies.items():
-			dep.printUnloadCode()
+		for key, dep in self.global_dependencies.iteritems():
+			dep.printUnloadCode(out)
 
-		for key, dep in self.optional_global_dependencies.items():
-			dep.printUnloadCode()
+		for key, dep in self.optional_global_dependencies.iteritems():
+			dep.printUnloadCode(out)
 		
 		if self.useFailLoadLabel():
-			print '\t\tif (failedLoad)\n\t\t\treturn MM_FAIL;\n\t\telse\n\t',
-		print '\t\treturn MM_OK;'
-		print '\t}'
+			print >>out, '\t\tif (failedLoad)\n\t\t\treturn MM_FAIL;\n\t\telse\n\t',
+		print >>out, '\t\treturn MM_OK;'
+		print >>out, '\t}'
 		
 		if self.isAttachable():
 			# MM_ATTACH
-			print '\telse if (_action == MM_ATTACH)\n\t{'
+			print >>out, '\telse if (_action == MM_ATTACH)\n\t{'
 
 			if self.needArenaDataInEntryPoint():
 				# defines arena data pointer _ad but only if we're going to make
 				# and use of it. use of this variable in ACE modules is
 				# unsupported and not recommended.
-				self.per_arena_data.printAttachCode()
+				self.per_arena_data.printAttachCode(out)
 		
-			for key, dep in self.arena_dependencies.items():
-				dep.printAttachCode(failGracefully=False)
+			for key, dep in self.arena_dependencies.iteritems():
+				dep.printAttachCode(out, failGracefully=False)
 
-			for key, dep in self.optional_arena_dependencies.items():
-				dep.printAttachCode(failGracefully=True)
+			for key, dep in self.optional_arena_dependencies.iteritems():
+				dep.printAttachCode(out, failGracefully=True)
 
-			print self.extra_attachfirst_code.getvalue()
+			print >>out, self.extra_attachfirst_code.getvalue()
 			
-			for cb in self.internal_arena_callbacks:
-				cb.printAttachCode()
+			for cb in internal_arena_callbacks:
+				cb.printAttachCode(out)
 				
 			if self.per_player_data:
-				self.per_player_data.printAttachCode()
+				self.per_player_data.printAttachCode(out)
 		
 			for cb in self.my_arena_callbacks:
-				cb.printAttachCode()	
+				cb.printAttachCode(out)	
 
 			for adv in self.my_arena_advisers:
-				adv.printAttachCode()
+				adv.printAttachCode(out)
 								
 			for cmd in self.my_arena_commands:
-				cmd.printAttachCode()
+				cmd.printAttachCode(out)
 			
-			print self.extra_attachlast_code.getvalue()
+			print >>out, self.extra_attachlast_code.getvalue()
 						
 			for int in self.my_arena_interfaces:
-				int.printAttachCode()
+				int.printAttachCode(out)
 			
-			print '\t\treturn MM_OK;'
-			print '\t}'
+			print >>out, '\t\treturn MM_OK;'
+			print >>out, '\t}'
 		
 			# MM_DETACH
-			print '\telse if (_action == MM_DETACH)\n\t{'
+			print >>out, '\telse if (_action == MM_DETACH)\n\t{'
 
 			if self.needArenaDataInEntryPoint():
 				# defines arena data pointer _ad but only if we're going to make
 				# and use of it. use of this variable in ACE modules is
 				# unsupported and not recommended.
-				self.per_arena_data.printDetachBeginCode()
+				self.per_arena_data.printDetachBeginCode(out)
 				
 			for int in self.my_arena_interfaces:
-				int.printDetachCode()
+				int.printDetachCode(out)
 				
-			print self.extra_detachfirst_code.getvalue()
+			print >>out, self.extra_detachfirst_code.getvalue()
 				
 			for cmd in self.my_arena_commands:
-				cmd.printDetachCode()
+				cmd.printDetachCode(out)
 				
 			for adv in self.my_arena_advisers:
-				adv.printDetachCode()
+				adv.printDetachCode(out)
 				
 			for cb in self.my_arena_callbacks:
-				cb.printDetachCode()
+				cb.printDetachCode(out)
 				
-			for cb in self.internal_arena_callbacks:
-				cb.printDetachCode()
+			for cb in internal_arena_callbacks:
+				cb.printDetachCode(out)
 
 			if self.per_player_data:
-				self.per_player_data.printDetachCode()
+				self.per_player_data.printDetachCode(out)
 	
 			if self.useFailAttachLabel():
-				print 'ace_fail_attach:'
+				print >>out, 'ace_fail_attach:'
 	
-			print self.extra_detachlast_code.getvalue()
+			print >>out, self.extra_detachlast_code.getvalue()
 						
-			for key, dep in self.arena_dependencies.items():
-				dep.printDetachCode()
+			for key, dep in self.arena_dependencies.iteritems():
+				dep.printDetachCode(out)
 
-			for key, dep in self.optional_arena_dependencies.items():
-				dep.printDetachCode()
+			for key, dep in self.optional_arena_dependencies.iteritems():
+				dep.printDetachCode(out)
 			
 			if self.per_arena_data:
-				self.per_arena_data.printDetachFinalCode()
+				self.per_arena_data.printDetachFinalCode(out)
 				
 			if self.useFailAttachLabel():
-				print '\t\tif (failedAttach)\n\t\t\treturn MM_FAIL;\n\t\telse\n\t',
-			print '\t\treturn MM_OK;'
-			print '\t}'
+				print >>out, '\t\tif (failedAttach)\n\t\t\treturn MM_FAIL;\n\t\telse\n\t',
+			print >>out, '\t\treturn MM_OK;'
+			print >>out, '\t}'
 
 		# the end
-		print '\treturn MM_FAIL;'
+		print >>out, '\treturn MM_FAIL;'
 	
-		print '}\n'
+		print >>out, '}\n'
 		if self.use_line_directives:
-			print '#line', str(self.last_line_number), '"' + self.source_file + '"\n'
+			print >>out, '#line', str(self.last_line_number), '"' + line_file + '"\n'
 			
+	def writeHeader(self, out=None, declared={}):
+		# writes the public header of the module: the interfaces it implements
+		# and its entry point, for other modules to include. it only depends
+		# on the public surface of the module (not on function bodies or line
+		# numbers), so it stays the same as long as that does. the interfaces
+		# in declared (see declaredInterfaces()) are included from the header
+		# that declares them instead.
+		if out is None:
+			out = sys.stdout
+		guard = 'ACE_HEADER_' + self.name
+
+		print >>out, '/* public interface of the module ' + self.name + ', generated by ACE */'
+		print >>out
+		print >>out, '#ifndef', guard
+		print >>out, '#define', guard
+		print >>out
+		print >>out, '#include "asss.h"'
+		# quoted includes are found next to this module's source, which other
+		# modules don't look in, unless they declare an interface
+		included = []
+		for value in self.includes.itervalues():
+			if value[0] == '<':
+				included.append(value)
+		for int in self.my_global_interfaces + self.my_arena_interfaces:
+			if int.identifier in declared and declared[int.identifier] not in included:
+				included.append(declared[int.identifier])
+		for include in included:
+			print >>out, '#include', include
+		print >>out
+
+		identifiers = []
+		for int in self.my_global_interfaces + self.my_arena_interfaces:
+			if int.identifier not in identifiers and int.identifier not in declared:
+				identifiers.append(int.identifier)
+				int.printTypeCode(out)
+				print >>out
+
+		print >>out, 'EXPORT int MM_' + self.name + '(int action, Imodman *mm, Arena *arena);'
+		print >>out
+		print >>out, '#endif'
+
+# the headers every module starts with. with --prologue they are included
+# through one header that is the same for every module, so it can be
+# precompiled once for all of them.
+PrologueIncludes = ['"asss.h"', '<stdio.h>']
+
+def writePrologue(out):
+	print >>out, '/* the start of every module generated by ACE */'
+	print >>out
+	print >>out, '#ifndef ACE_PROLOGUE_H'
+	print >>out, '#define ACE_PROLOGUE_H'
+	print >>out
+	for include in PrologueIncludes:
+		print >>out, '#include', include
+	print >>out
+	print >>out, '#endif'
+
 class ACEAdviser:
 	def __init__(self, module, type, identifier):
 		self.module = module
@@ -1798,33 +2540,33 @@ class ACEAdviser:
 		self.file = None
 		self.line_number = None
 		
-	def printDeclareCode(self):
+	def printDeclareCode(self, out):
 		if self.module.use_line_directives and self.file and self.line_number:
-			print '#line', self.line_number, '"' + self.file + '"' 
-		print 'local', self.type, self.var, '=\n{'
+			print >>out, '#line', self.line_number, '"' + self.file + '"' 
+		print >>out, 'local', self.type, self.var, '=\n{'
 		if self.module.use_line_directives and self.file and self.line_number:
-			print '#line', self.line_number, '"' + self.file + '"'
-		print '\tADVISER_HEAD_INIT(' + self.identifier + ')'
+			print >>out, '#line', self.line_number, '"' + self.file + '"'
+		print >>out, '\tADVISER_HEAD_INIT(' + self.identifier + ')'
 		for fn in self.functions:
 			if fn:
 				if self.module.use_line_directives:
-					print fn.getLineDirective(),
-				print '\t' + fn.name + ','
+					print >>out, fn.getLineDirective(),
+				print >>out, '\t' + fn.name + ','
 			else:
-				print '\tNULL,'
-		print '};'
+				print >>out, '\tNULL,'
+		print >>out, '};'
 
-	def printLoadCode(self):
-		print '\t\tmm->RegAdviser(&' + self.var + ', ALLARENAS);'
+	def printLoadCode(self, out):
+		print >>out, '\t\tmm->RegAdviser(&' + self.var + ', ALLARENAS);'
 		
-	def printAttachCode(self):
-		print '\t\tmm->RegAdviser(&' + self.var + ', arena);'
+	def printAttachCode(self, out):
+		print >>out, '\t\tmm->RegAdviser(&' + self.var + ', arena);'
 
-	def printUnloadCode(self):
-		print '\t\tmm->UnregAdviser(&' + self.var + ', ALLARENAS);'
+	def printUnloadCode(self, out):
+		print >>out, '\t\tmm->UnregAdviser(&' + self.var + ', ALLARENAS);'
 		
-	def printDetachCode(self):
-		print '\t\tmm->UnregAdviser(&' + self.var + ', arena);'
+	def printDetachCode(self, out):
+		print >>out, '\t\tmm->UnregAdviser(&' + self.var + ', arena);'
 		
 		
 class ACECallback:
@@ -1835,21 +2577,21 @@ class ACECallback:
 		self.file = None
 		self.line_number = None
 		
-	def printLoadCode(self):
+	def printLoadCode(self, out):
 		if self.module.use_line_directives and self.file and self.line_number:
-			print '#line', self.line_number, '"' + self.file + '"'
-		print '\t\tmm->RegCallback(' + self.identifier + ',', self.function.name + ', ALLARENAS);'
+			print >>out, '#line', self.line_number, '"' + self.file + '"'
+		print >>out, '\t\tmm->RegCallback(' + self.identifier + ',', self.function.name + ', ALLARENAS);'
 		
-	def printUnloadCode(self):
-		print '\t\tmm->UnregCallback(' + self.identifier + ',', self.function.name + ', ALLARENAS);'
+	def printUnloadCode(self, out):
+		print >>out, '\t\tmm->UnregCallback(' + self.identifier + ',', self.function.name + ', ALLARENAS);'
 		
-	def printAttachCode(self):
+	def printAttachCode(self, out):
 		if self.module.use_line_directives and self.file and self.line_number:
-			print '#line', self.line_number, '"' + self.file + '"'
-		print '\t\tmm->RegCallback(' + self.identifier + ',', self.function.name + ', arena);'
+			print >>out, '#line', self.line_number, '"' + self.file + '"'
+		print >>out, '\t\tmm->RegCallback(' + self.identifier + ',', self.function.name + ', arena);'
 		
-	def printDetachCode(self):
-		print '\t\tmm->UnregCallback(' + self.identifier + ',', self.function.name + ', arena);'
+	def printDetachCode(self, out):
+		print >>out, '\t\tmm->UnregCallback(' + self.identifier + ',', self.function.name + ', arena);'
 		
 		
 class ACECommand:
@@ -1867,40 +2609,52 @@ class ACECommand:
 		if file and line_number:
 			self.helptext.write('\n#line ' + str(line_number) + ' "' + file + '"')
 		self.helptext.write('\n' + line)
+
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		if self.helptext:
+			state['helptext'] = self.helptext.getvalue()
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		if self.helptext:
+			self.helptext = StringIO()
+			self.helptext.write(state['helptext'])
 		
-	def printDeclareCode(self):
+	def printDeclareCode(self, out):
 		if self.helptext:
 			firstname = self.names[0]
-			print 'local helptext_t ' + firstname + '_help =',
-			print self.helptext.getvalue() + ';\n'
+			print >>out, 'local helptext_t ' + firstname + '_help =',
+			print >>out, self.helptext.getvalue() + ';\n'
 			
-	def printLoadCode(self):
+	def printLoadCode(self, out):
 		firstname = self.names[0]
 		for cmdname in self.names:
 			if self.module.use_line_directives and self.file and self.line_number:
-				print '#line', self.line_number, '"' + self.file + '"' 
+				print >>out, '#line', self.line_number, '"' + self.file + '"' 
 			if self.helptext:
-				print '\t\tcmd->AddCommand("' + cmdname + '", ' + self.function.name + ', ALLARENAS, ' + firstname + '_help);'
+				print >>out, '\t\tcmd->AddCommand("' + cmdname + '", ' + self.function.name + ', ALLARENAS, ' + firstname + '_help);'
 			else:
-				print '\t\tcmd->AddCommand("' + cmdname + '", ' + self.function.name + ', ALLARENAS, NULL);'
+				print >>out, '\t\tcmd->AddCommand("' + cmdname + '", ' + self.function.name + ', ALLARENAS, NULL);'
 				
-	def printAttachCode(self):
+	def printAttachCode(self, out):
 		firstname = self.names[0]
 		for cmdname in self.names:
 			if self.module.use_line_directives and self.file and self.line_number:
-				print '#line', self.line_number, '"' + self.file + '"' 
+				print >>out, '#line', self.line_number, '"' + self.file + '"' 
 			if self.helptext:
-				print '\t\tcmd->AddCommand("' + cmdname + '", ' + self.function.name + ', arena, ' + firstname + '_help);'
+				print >>out, '\t\tcmd->AddCommand("' + cmdname + '", ' + self.function.name + ', arena, ' + firstname + '_help);'
 			else:
-				print '\t\tcmd->AddCommand("' + cmdname + '", ' + self.function.name + ', arena, NULL);'
+				print >>out, '\t\tcmd->AddCommand("' + cmdname + '", ' + self.function.name + ', arena, NULL);'
 				
-	def printUnloadCode(self):
+	def printUnloadCode(self, out):
 		for cmdname in self.names:
-			print '\t\tcmd->RemoveCommand("' + cmdname + '", ' + self.function.name + ', ALLARENAS);'
+			print >>out, '\t\tcmd->RemoveCommand("' + cmdname + '", ' + self.function.name + ', ALLARENAS);'
 		
-	def printDetachCode(self):
+	def printDetachCode(self, out):
 		for cmdname in self.names:
-			print '\t\tcmd->RemoveCommand("' + cmdname + '", ' + self.function.name + ', arena);'
+			print >>out, '\t\tcmd->RemoveCommand("' + cmdname + '", ' + self.function.name + ', arena);'
 			
 			
 class ACEDependency:
@@ -1914,102 +2668,105 @@ class ACEDependency:
 		self.file = None
 		self.line_number = None
 		
-	def printDeclareCode(self):
+	def printDeclareCode(self, out):
 		if self.module.use_line_directives and self.file and self.line_number:
-			print '#line', self.line_number, '"' + self.file + '"'
-		print 'local', self.type, '*' + self.pointer, '= 0;'
+			print >>out, '#line', self.line_number, '"' + self.file + '"'
+		print >>out, 'local', self.type, '*' + self.pointer, '= 0;'
 
-	def printLoadCode(self, arena=None, failGracefully=False):
+	def printLoadCode(self, out, arena=None, failGracefully=False):
 		if not self.name:
 			if self.module.use_line_directives and self.file and self.line_number:
-				print '#line', self.line_number, '"' + self.file + '"'
-			print '\t\t' + self.pointer, '= mm->GetInterface(' + self.identifier + ', ALLARENAS);'
+				print >>out, '#line', self.line_number, '"' + self.file + '"'
+			print >>out, '\t\t' + self.pointer, '= mm->GetInterface(' + self.identifier + ', ALLARENAS);'
 		
 			if not failGracefully:
-				print '\t\tif (!' + self.pointer + ')'
+				print >>out, '\t\tif (!' + self.pointer + ')'
 
-				print '\t\t{\n\t\t\tlm->Log(L_ERROR, "<' + self.module.name + '> error obtaining required interface', self.identifier, '"', self.identifier + ');'
-				print '\t\t\tfailedLoad = TRUE;'
-				print '\t\t\tgoto ace_fail_load;'
+				print >>out, '\t\t{\n\t\t\tlm->Log(L_ERROR, "<' + self.module.name + '> error obtaining required interface', self.identifier, '"', self.identifier + ');'
+				print >>out, '\t\t\tfailedLoad = TRUE;'
+				print >>out, '\t\t\tgoto ace_fail_load;'
 
-				print '\t\t}'
+				print >>out, '\t\t}'
 		else:
 			if self.module.use_line_directives and self.file and self.line_number:
-				print '#line', self.line_number, '"' + self.file + '"'
-			print '\t\t' + self.pointer, '= mm->GetInterfaceByName("' + self.name + '");'
+				print >>out, '#line', self.line_number, '"' + self.file + '"'
+			print >>out, '\t\t' + self.pointer, '= mm->GetInterfaceByName("' + self.name + '");'
 			
 			if not failGracefully:
-				print '\t\tif (!' + self.pointer + ')'
+				print >>out, '\t\tif (!' + self.pointer + ')'
 
-				print '\t\t{\n\t\t\tlm->Log(L_ERROR, "<' + self.module.name + '> error obtaining required named interface', self.name + '");'
-				print '\t\t\tfailedLoad = TRUE;'
-				print '\t\t\tgoto ace_fail_load;'
+				print >>out, '\t\t{\n\t\t\tlm->Log(L_ERROR, "<' + self.module.name + '> error obtaining required named interface', self.name + '");'
+				print >>out, '\t\t\tfailedLoad = TRUE;'
+				print >>out, '\t\t\tgoto ace_fail_load;'
 
-				print '\t\t}'
+				print >>out, '\t\t}'
 				
 			if self.identifier:
 				if self.module.use_line_directives and self.file and self.line_number:
-					print '#line', self.line_number, '"' + self.file + '"'
-				print '\t\tif (strcmp(' + self.pointer + '->head.iid,', self.identifier + '))\n\t\t{'
+					print >>out, '#line', self.line_number, '"' + self.file + '"'
+				print >>out, '\t\tif (strcmp(' + self.pointer + '->head.iid,', self.identifier + '))\n\t\t{'
 
-				print '\t\t\tlm->Log(L_ERROR, "<' + self.module.name + '> named interface', self.name, 'expected interface-id "', self.identifier, '", got %s",', self.pointer + '->head.iid);'
-				print '\t\t\tfailedLoad = TRUE;'
-				print '\t\t\tgoto ace_fail_load;'
+				print >>out, '\t\t\tlm->Log(L_ERROR, "<' + self.module.name + '> named interface', self.name, 'expected interface-id "', self.identifier, '", got %s",', self.pointer + '->head.iid);'
+				print >>out, '\t\t\tfailedLoad = TRUE;'
+				print >>out, '\t\t\tgoto ace_fail_load;'
 
-				print '\t\t}'
+				print >>out, '\t\t}'
 
-	def printAttachCode(self, failGracefully=False):
+	def printAttachCode(self, out, failGracefully=False):
+		ad = self.module.per_arena_data.managedVar()
 		if not self.name:
 			if self.module.use_line_directives and self.file and self.line_number:
-				print '#line', self.line_number, '"' + self.file + '"'
-			print '\t\t_ad->' + self.pointer, '= mm->GetArenaInterface(' + self.identifier + ', arena);'
+				print >>out, '#line', self.line_number, '"' + self.file + '"'
+			print >>out, '\t\t' + ad + '->' + self.pointer, '= mm->GetArenaInterface(' + self.identifier + ', arena);'
 			if not failGracefully:
-				print '\t\tif (!_ad->' + self.pointer + ')'
+				print >>out, '\t\tif (!' + ad + '->' + self.pointer + ')'
 
-				print '\t\t{\n\t\t\tlm->LogA(L_ERROR, "' + self.module.name + '", arena, "error obtaining required interface', self.identifier, '"', self.identifier + ');'
-				print '\t\t\tfailedAttach = TRUE;'
-				print '\t\t\tgoto ace_fail_attach;'
+				print >>out, '\t\t{\n\t\t\tlm->LogA(L_ERROR, "' + self.module.name + '", arena, "error obtaining required interface', self.identifier, '"', self.identifier + ');'
+				print >>out, '\t\t\tfailedAttach = TRUE;'
+				print >>out, '\t\t\tgoto ace_fail_attach;'
 				
-				print '\t\t}'
+				print >>out, '\t\t}'
 		else:
 			if self.module.use_line_directives and self.file and self.line_number:
-				print '#line', self.line_number, '"' + self.file + '"'
-			print '\t\t_ad->' + self.pointer, '= mm->GetInterfaceByName("' + self.name + '");'
+				print >>out, '#line', self.line_number, '"' + self.file + '"'
+			print >>out, '\t\t' + ad + '->' + self.pointer, '= mm->GetInterfaceByName("' + self.name + '");'
 			
 			if not failGracefully:
-				print '\t\tif (!_ad->' + self.pointer + ')'
+				print >>out, '\t\tif (!' + ad + '->' + self.pointer + ')'
 
-				print '\t\t{\n\t\t\tlm->LogA(L_ERROR, "' + self.module.name + '", arena, "error obtaining required named interface', self.name, '");'
-				print '\t\t\tfailedAttach = TRUE;'
-				print '\t\t\tgoto ace_fail_attach;'
+				print >>out, '\t\t{\n\t\t\tlm->LogA(L_ERROR, "' + self.module.name + '", arena, "error obtaining required named interface', self.name, '");'
+				print >>out, '\t\t\tfailedAttach = TRUE;'
+				print >>out, '\t\t\tgoto ace_fail_attach;'
 				
-				print '\t\t}'
+				print >>out, '\t\t}'
 				
 			if self.identifier:
 				if self.module.use_line_directives and self.file and self.line_number:
-					print '#line', self.line_number, '"' + self.file + '"'
-				print '\t\tif (strcmp(_ad->' + self.pointer + '->head.iid,', self.identifier + '))\n\t\t{'
+					print >>out, '#line', self.line_number, '"' + self.file + '"'
+				print >>out, '\t\tif (strcmp(' + ad + '->' + self.pointer + '->head.iid,', self.identifier + '))\n\t\t{'
 
-				print '\t\t\tlm->LogA(L_ERROR, "' + self.module.name + '", arena, "named interface', self.name, 'expected interface-id "', self.identifier, '", got %s",', self.pointer + '->head.iid);'
-				print '\t\t\tfailedAttach = TRUE;'
-				print '\t\t\tgoto ace_fail_attach;'
+				print >>out, '\t\t\tlm->LogA(L_ERROR, "' + self.module.name + '", arena, "named interface', self.name, 'expected interface-id "', self.identifier, '", got %s",', self.pointer + '->head.iid);'
+				print >>out, '\t\t\tfailedAttach = TRUE;'
+				print >>out, '\t\t\tgoto ace_fail_attach;'
 				
-				print '\t\t}'
+				print >>out, '\t\t}'
 			
-	def printUnloadCode(self):
-		print '\t\tmm->ReleaseInterface(' + self.pointer + ');'
+	def printUnloadCode(self, out):
+		print >>out, '\t\tmm->ReleaseInterface(' + self.pointer + ');'
 		
-	def printDetachCode(self):
+	def printDetachCode(self, out):
+		ad = self.module.per_arena_data.managedVar()
 		if not self.name:
-			print '\t\tmm->ReleaseArenaInterface(_ad->' + self.pointer + ', arena);'
+			print >>out, '\t\tmm->ReleaseArenaInterface(' + ad + '->' + self.pointer + ', arena);'
 		else:
-			print '\t\tmm->ReleaseInterface(_ad->' + self.pointer + ');'
+			print >>out, '\t\tmm->ReleaseInterface(' + ad + '->' + self.pointer + ');'
 		
 
 class ACEFunction:
 	FunctionDeclareEx = re.compile(r'\s*(local)?\s*([A-Za-z0-9_* ]+?)\s*?(\w+?)\((.*?)\)')
 	FunctionEndEx = re.compile(r'^}$')
-	FunctionCompleteEx = re.compile(r'\s*(local)?\s*([A-Za-z0-9_* ]+?)\s*?(\w+?)\((.*?)\)\s*{(.*)^}', re.DOTALL | re.MULTILINE)
+	# a function runs from its declaration up to the first unindented }
+	FunctionHeaderEx = re.compile(r'\s*(local)?\s*([A-Za-z0-9_* ]+?)\s*?(\w+?)\((.*?)\)\s*{', re.DOTALL)
 	def __init__(self, declaration, name, params, body):
 		self.name = name
 		self.declaration = declaration
@@ -2041,38 +2798,59 @@ class ACEInterface:
 		self.file = None
 		self.line_number = None
 		
-	def printDeclareCode(self):
+	def printDeclareCode(self, out):
 		if self.module.use_line_directives and self.file and self.line_number:
-			print '#line', self.line_number, '"' + self.file + '"' 
-		print 'local', self.type, self.var, '=\n{'
+			print >>out, '#line', self.line_number, '"' + self.file + '"' 
+		print >>out, 'local', self.type, self.var, '=\n{'
 		if self.module.use_line_directives and self.file and self.line_number:
-			print '#line', self.line_number, '"' + self.file + '"' 
-		print '\tINTERFACE_HEAD_INIT(' + self.identifier + ', "' + self.name + '")'
+			print >>out, '#line', self.line_number, '"' + self.file + '"' 
+		print >>out, '\tINTERFACE_HEAD_INIT(' + self.identifier + ', "' + self.name + '")'
 		for fn in self.functions:
 			if self.module.use_line_directives:
-				print fn.getLineDirective(),
-			print '\t' + fn.name + ','
-		print '};'
+				print >>out, fn.getLineDirective(),
+			print >>out, '\t' + fn.name + ','
+		print >>out, '};'
 		
-	def printLoadCode(self):
+	def printTypeCode(self, out):
+		# the interface struct, with its functions in the order they were
+		# implemented. the version in the identifier comes from the function
+		# signatures, so modules built against an older layout won't find it.
+		# an identifier that is already defined (by a hand written header,
+		# or asss itself) is assumed to come with its struct. the interfaces
+		# declared by the headers ACE knows of aren't written at all, see
+		# declaredInterfaces().
+		members = []
+		for fn in self.functions:
+			members.append(fn.declaration + ' (*' + fn.name + ')(' + fn.params + ');')
+		version = hashlib.sha1(self.type + '\0' + '\0'.join(members)).hexdigest()[0:8]
+		print >>out, '#ifndef', self.identifier
+		print >>out, '#define', self.identifier, '"' + self.type[1:].lower() + '-' + version + '"'
+		print >>out, 'typedef struct ' + self.type + '\n{'
+		print >>out, '\tINTERFACE_HEAD_DECL'
+		for member in members:
+			print >>out, '\t' + member
+		print >>out, '}', self.type + ';'
+		print >>out, '#endif'
+
+	def printLoadCode(self, out):
 		if self.module.use_line_directives and self.file and self.line_number:
-			print '#line', self.line_number, '"' + self.file + '"' 
-		print '\t\tmm->RegInterface(&' + self.var + ', ALLARENAS);'
+			print >>out, '#line', self.line_number, '"' + self.file + '"' 
+		print >>out, '\t\tmm->RegInterface(&' + self.var + ', ALLARENAS);'
 		
-	def printAttachCode(self):
+	def printAttachCode(self, out):
 		if self.module.use_line_directives and self.file and self.line_number:
-			print '#line', self.line_number, '"' + self.file + '"' 
-		print '\t\tmm->RegInterface(&' + self.var + ', arena);'
+			print >>out, '#line', self.line_number, '"' + self.file + '"' 
+		print >>out, '\t\tmm->RegInterface(&' + self.var + ', arena);'
 
-	def printUnloadCode(self):
-		print '\t\tif (mm->UnregInterface(&' + self.var + ', ALLARENAS))\n\t\t{'
-		print '\t\t\tlm->Log(L_ERROR, "<' + self.module.name + '> unable to unregister', self.var + '");'
-		print '\t\t\treturn MM_FAIL;\n\t\t}'
+	def printUnloadCode(self, out):
+		print >>out, '\t\tif (mm->UnregInterface(&' + self.var + ', ALLARENAS))\n\t\t{'
+		print >>out, '\t\t\tlm->Log(L_ERROR, "<' + self.module.name + '> unable to unregister', self.var + '");'
+		print >>out, '\t\t\treturn MM_FAIL;\n\t\t}'
 		
-	def printDetachCode(self):
-		print '\t\tif (mm->UnregInterface(&' + self.var + ', arena))\n\t\t{'
-		print '\t\t\tlm->LogA(L_ERROR, "' + self.module.name + '", arena, "unable to unregister', self.var + '");'
-		print '\t\t\treturn MM_FAIL;\n\t\t}'
+	def printDetachCode(self, out):
+		print >>out, '\t\tif (mm->UnregInterface(&' + self.var + ', arena))\n\t\t{'
+		print >>out, '\t\t\tlm->LogA(L_ERROR, "' + self.module.name + '", arena, "unable to unregister', self.var + '");'
+		print >>out, '\t\t\treturn MM_FAIL;\n\t\t}'
 
 			
 class ACEStructure:
@@ -2081,6 +2859,24 @@ class ACEStructure:
 	StructDeclareExtraEx = re.compile(r'^\s*{\s*$')
 	StructEndEx = re.compile(r'^\s*}\s*(\w+)?;\s*$')
 	StructFieldEx = re.compile(r'\s*(.+);')
+	# a field of $#playerdata or $#arenadata marked hot or cold
+	FieldPlacementEx = re.compile(r'^\s*(hot|cold)\s+(\S.*)$')
+	# and after that, in a group for --packed-layout
+	FieldGroupEx = re.compile(r'^\s*group\s+(\w+)\s+(\S.*)$')
+	FieldNameEx = re.compile(r'^(.*?)(\w+)\s*((?:\[[^\]]*\]\s*)*)$')
+	FieldDimensionEx = re.compile(r'\[\s*([^\]]*?)\s*\]')
+	# the size (and alignment) of basic types on LP64, to estimate the
+	# layout of fields for --packed-layout. other types are taken to be
+	# aligned like a pointer, and of unknown size.
+	TypeSizes = {'char': 1, '_Bool': 1, 'bool': 1, 'byte': 1, 'u8': 1, 'i8': 1,
+		'short': 2, 'u16': 2, 'i16': 2,
+		'int': 4, 'float': 4, 'u32': 4, 'i32': 4, 'ticks_t': 4, 'enum': 4,
+		'long': 8, 'long long': 8, 'double': 8, 'u64': 8, 'i64': 8,
+		'size_t': 8, 'time_t': 8, 'intptr_t': 8, 'uintptr_t': 8,
+		'long double': 16}
+	PointerSize = 8
+	# bytes in a cache line, which a group has to fit in
+	CacheLine = 64
 
 	def __init__(self, module, name, dynamic=False):
 		self.module = module
@@ -2089,30 +2885,271 @@ class ACEStructure:
 		if not self.name:
 			self.name = ''
 		self.items = []
+		# the items marked hot, see isSplit()
+		self.hot_items = []
+		# the items ACE adds itself (arena interface pointers), which are
+		# kept with the hot items
+		self.managed_items = []
+		# the group of each item in one, see packedItems()
+		self.groups = {}
 		self.closeviaregex = True
 		self.line_number = None
 		self.file = None
 		self.parent_structure = None
 	
-	def pushItem(self, file, line, item):
+	def pushItem(self, file, line, item, hot=False, managed=False):
 		self.items.append((file, line, item))
+		if hot:
+			self.hot_items.append((file, line, item))
+		if managed:
+			self.managed_items.append((file, line, item))
+
+	def isSplit(self):
+		# dynamic data with hot fields keeps them in the struct asss stores
+		# for each player (or arena), which points to the rest in a separately
+		# allocated cold_ struct
+		return self.dynamic and len(self.hot_items) > 0
+
+	def keyType(self):
+		# the type of the data asss stores for each player (or arena)
+		if self.dynamic and not self.isSplit():
+			return 'wrapper_' + self.name
+		return self.name
+
+	def heapType(self):
+		# the type of the struct allocated for dynamic data
+		if self.isSplit():
+			return 'cold_' + self.name
+		return self.name
+
+	def heapField(self):
+		# the member of keyType() pointing to the heapType() struct
+		if self.isSplit():
+			return 'cold'
+		return 'data'
+
+	def accessKind(self):
+		# how code reaches the data, which is what $use...data() expands to
+		kind = self.dynamic and 'dynamic' or 'static'
+		if getattr(self, 'lazy', False):
+			kind += ', lazy'
+		if self.isSplit():
+			kind += ', with hot fields'
+		return kind
+
+	def hotZero(self):
+		# a zeroed keyType() struct, for clearing the hot fields
+		return 'ace_hot_' + self.name
 		
-	def printDeclareCode(self):
+	def printDeclareCode(self, out):
+		if self.isSplit():
+			for name, items, extra in self.structFields():
+				self.printStructCode(out, name, items, extra)
+			print >>out, 'local const ' + self.keyType() + ' ' + self.hotZero() + ';'
+			return
+
+		self.printStructCode(out, self.name, self.items)
+		
+		if self.dynamic:
+			print >>out, 'typedef struct wrapper_' + self.name + '\n{\n\t' + self.name, '*data;\n} wrapper_' + self.name + ';'
+
+		return
+
+	def printStructCode(self, out, name, items, extra=None):
+		if self.isPacked():
+			fields = list(items)
+			if extra:
+				fields.append((None, None, extra))
+			packed = self.packedItems(fields)
+			if packed != fields:
+				self.printPackedCode(out, name, fields, packed)
+				self.printGroupCode(out, name, packed)
+				return
+
 		if self.line_number and self.file:	
-			print '#line', self.line_number, '"' + self.file + '"'
-		print 'typedef struct', self.name, '\n{'
+			print >>out, '#line', self.line_number, '"' + self.file + '"'
+		print >>out, 'typedef struct', name, '\n{'
 		
-		for file, line, item in self.items:
+		for file, line, item in items:
 			if self.module.use_line_directives:
-				print '#line', line, '"' + file + '"'
-			print '\t' + item + ';'
+				print >>out, '#line', line, '"' + file + '"'
+			print >>out, '\t' + item + ';'
+		if extra:
+			print >>out, '\t' + extra + ';'
 			
-		print '}', self.name + ';'
-		
-		if self.dynamic:
-			print 'typedef struct wrapper_' + self.name + '\n{\n\t' + self.name, '*data;\n} wrapper_' + self.name + ';'
+		print >>out, '}', name + ';'
 
-		return
+		if self.isPacked():
+			self.printGroupCode(out, name, items)
+
+	def printProbeCode(self, out, kind):
+		# arrays as large as the data asss stores (and the struct allocated,
+		# for dynamic data), for ace.py --budget to read from the object with
+		# nm -S. they are zeroed, so they take no space in the file.
+		probe = 'local char ace_probe_' + self.module.name + '_' + kind
+		print >>out, probe + '[sizeof(' + self.keyType() + ')] __attribute__((used));'
+		if self.dynamic:
+			print >>out, probe + '_alloc[sizeof(' + self.heapType() + ')] __attribute__((used));'
+
+	def isPacked(self):
+		# only player and arena data, whose layout is ACE's own business
+		return self.module.packed_layout and not self.closeviaregex
+
+	def structFields(self):
+		# (name, items, extra) of each struct printDeclareCode() prints
+		if self.isSplit():
+			hot = [item for item in self.items
+				if item in self.hot_items or item in self.managed_items]
+			cold = [item for item in self.items if item not in hot]
+			return [(self.heapType(), cold, None),
+				(self.name, hot, self.heapType() + ' *' + self.heapField())]
+		return [(self.name, self.items, None)]
+
+	def unpackedTypes(self):
+		# the ace_unpacked_ structs printPackedCode() declares
+		names = []
+		if self.isPacked():
+			for name, items, extra in self.structFields():
+				fields = list(items)
+				if extra:
+					fields.append((None, None, extra))
+				if self.packedItems(fields) != fields:
+					names.append('ace_unpacked_' + name)
+		return names
+
+	def fieldLayout(self, item):
+		# the (alignment, size) of a field, estimated for LP64. the size is
+		# None if it isn't known, and so is the alignment of a type that
+		# isn't, which is then ordered as if it were a pointer.
+		if '(' in item:
+			# a function pointer
+			return self.PointerSize, self.PointerSize
+		bits = ':' in item
+		if bits:
+			item = item.split(':')[0]
+		declarators = item.split(',')
+		field = ACEStructure.FieldNameEx.match(declarators[0].strip())
+		if not field:
+			return None, None
+		words = [word for word in field.group(1).replace('*', ' ').split()
+			if word not in ('const', 'volatile', 'signed')]
+		if words and words[0] in ('struct', 'union'):
+			words = []
+		elif words and words[0] == 'enum':
+			words = ['enum']
+		if 'unsigned' in words:
+			words.remove('unsigned')
+			if not words:
+				words = ['int']
+		if len(words) > 1 and words[-1] == 'int':
+			words.pop()
+		base = self.TypeSizes.get(' '.join(words))
+
+		align = None
+		size = 0
+		pointers = [declarators[0].strip()[:len(field.group(1))]] + declarators[1:]
+		for declarator, text in zip(pointers, declarators):
+			if '*' in declarator:
+				count, width = 1, self.PointerSize
+			else:
+				count, width = 1, base
+			if not bits:
+				for dimension in ACEStructure.FieldDimensionEx.findall(text):
+					if dimension.isdigit():
+						count *= int(dimension)
+					else:
+						count = None
+						break
+			align = max(align, width)
+			if size is not None and width and count is not None and not bits:
+				size += width * count
+			else:
+				size = None
+		return align, size
+
+	def packedItems(self, items):
+		# items in the order --packed-layout puts them: sorted by alignment,
+		# largest first, with the items of a group kept together (sorted the
+		# same way) where its first item would go, aligned like its largest.
+		# the sort is stable, so items of the same alignment keep their order
+		# in the source. items itself is returned if that order isn't smaller,
+		# or the size of a field isn't known: a group can leave padding the
+		# source order doesn't have, and a guess at an alignment can be wrong.
+		def alignment(item):
+			return -(self.fieldLayout(item[2])[0] or self.PointerSize)
+		units = []
+		grouped = {}
+		for item in items:
+			group = self.groups.get(item)
+			if not group:
+				units.append([item])
+			elif group in grouped:
+				grouped[group].append(item)
+			else:
+				grouped[group] = [item]
+				units.append(grouped[group])
+		for unit in units:
+			unit.sort(key=alignment)
+		units.sort(key=lambda unit: alignment(unit[0]))
+		packed = [item for unit in units for item in unit]
+		if packed == items:
+			return items
+		before = self.estimateSize(items)
+		after = self.estimateSize(packed)
+		if before is None or after is None or after >= before:
+			return items
+		return packed
+
+	def estimateSize(self, items):
+		# the size of a struct with these items on LP64, or None
+		offset = 0
+		largest = 1
+		for file, line, item in items:
+			align, size = self.fieldLayout(item)
+			if align is None or size is None:
+				return None
+			offset = (offset + align - 1) // align * align + size
+			largest = max(largest, align)
+		return (offset + largest - 1) // largest * largest
+
+	def printPackedCode(self, out, name, fields, packed):
+		# the struct in source order is only declared for the size checks
+		print >>out, 'typedef struct ace_unpacked_' + name, '\n{'
+		for file, line, item in fields:
+			print >>out, '\t' + item + ';'
+		print >>out, '} ace_unpacked_' + name + ';'
+
+		before = self.estimateSize(fields)
+		after = self.estimateSize(packed)
+		print >>out, '/* packed layout: %d bytes in source order, %d packed (estimated for LP64) */' \
+			% (before, after)
+		if self.line_number and self.file:	
+			print >>out, '#line', self.line_number, '"' + self.file + '"'
+		print >>out, 'typedef struct', name, '\n{'
+		for file, line, item in packed:
+			if self.module.use_line_directives and file:
+				print >>out, '#line', line, '"' + file + '"'
+			print >>out, '\t' + item + ';'
+		print >>out, '}', name + ';'
+
+		print >>out, '_Static_assert(sizeof(' + name + ') <= sizeof(ace_unpacked_' + name + '), "the packed layout of ' + name + ' is larger than its source order");'
+
+	def printGroupCode(self, out, name, items):
+		# checks that each group of the struct fits in a cache line, in
+		# whichever order it was declared
+		grouped = OrderedDict()
+		for item in items:
+			group = self.groups.get(item)
+			if group:
+				grouped.setdefault(group, []).append(item[2])
+		for group, items in grouped.iteritems():
+			first = ACEStructure.FieldNameEx.match(items[0].split(',')[0].strip())
+			last = ACEStructure.FieldNameEx.match(items[-1].split(',')[-1].strip())
+			if not first or not last or [item for item in items if ':' in item or '(' in item]:
+				continue
+			first = first.group(2)
+			last = last.group(2)
+			print >>out, '_Static_assert(offsetof(' + name + ', ' + last + ') + sizeof(((' + name + ' *)0)->' + last + ') - offsetof(' + name + ', ' + first + ') <= ' + str(self.CacheLine) + ', "group ' + group + ' of ' + name + ' is larger than a cache line");'
 
 
 class ACEArenaData(ACEStructure):
@@ -2120,164 +3157,2327 @@ class ACEArenaData(ACEStructure):
 		ACEStructure.__init__(self, module, 'arenadata', dynamic)
 		self.closeviaregex = False
 		
-	def printDeclareCode(self):
-		print 'local int arenaDataKey = -1;'
-		ACEStructure.printDeclareCode(self)
+	def printDeclareCode(self, out):
+		print >>out, 'local int arenaDataKey = -1;'
+		ACEStructure.printDeclareCode(self, out)
 
-	def printLoadCode(self):
-		if not self.dynamic:
-			print '\t\t' + 'arenaDataKey = aman->AllocateArenaData(sizeof(' + self.name + '));'
-		else:
-			print '\t\t' + 'arenaDataKey = aman->AllocateArenaData(sizeof(wrapper_' + self.name + '));'
+	def printLoadCode(self, out):
+		print >>out, '\t\t' + 'arenaDataKey = aman->AllocateArenaData(sizeof(' + self.keyType() + '));'
 			
-		print '\t\tif (' + 'arenaDataKey == -1)\n\t\t{'
-		print '\t\t\tlm->Log(L_ERROR, "<' + self.module.name + '> unable to register arena-data");'
-		print '\t\t\tfailedLoad = TRUE;'
-		print '\t\t\tgoto ace_fail_load;'
-		print '\t\t}'
-
-	def printUnloadCode(self):
-		print '\t\tif (' + 'arenaDataKey != -1)'
-		print '\t\t\taman->FreeArenaData(arenaDataKey);'
+		print >>out, '\t\tif (' + 'arenaDataKey == -1)\n\t\t{'
+		print >>out, '\t\t\tlm->Log(L_ERROR, "<' + self.module.name + '> unable to register arena-data");'
+		print >>out, '\t\t\tfailedLoad = TRUE;'
+		print >>out, '\t\t\tgoto ace_fail_load;'
+		print >>out, '\t\t}'
+
+	def printUnloadCode(self, out):
+		print >>out, '\t\tif (' + 'arenaDataKey != -1)'
+		print >>out, '\t\t\taman->FreeArenaData(arenaDataKey);'
 	
-	def printAttachCode(self):
+	def printAttachCode(self, out):
 		if self.dynamic:
-			print '\t\t' + self.name + ' *_ad = amalloc(sizeof(*_ad));'
-			print '\t\twrapper_' + self.name + ' *_wrapped_ad = P_ARENA_DATA(arena, arenaDataKey);'
-			print '\t\t_wrapped_ad->data = _ad;'
+			print >>out, '\t\t' + self.heapType() + ' *_ad = amalloc(sizeof(*_ad));'
+			print >>out, '\t\t' + self.keyType() + ' *_wrapped_ad = P_ARENA_DATA(arena, arenaDataKey);'
+			if self.isSplit():
+				print >>out, '\t\t*_wrapped_ad = ' + self.hotZero() + ';'
+			print >>out, '\t\t_wrapped_ad->' + self.heapField() + ' = _ad;'
 		else:
-			print '\t\t' + self.name + ' *_ad = P_ARENA_DATA(arena, arenaDataKey);'
+			print >>out, '\t\t' + self.name + ' *_ad = P_ARENA_DATA(arena, arenaDataKey);'
 		
-	def printDetachFinalCode(self):
+	def printDetachFinalCode(self, out):
 		if not self.dynamic:
 			return;
-		print '\t\t_wrapped_ad->data = NULL;'
-		print '\t\tafree(_ad);'
+		print >>out, '\t\t_wrapped_ad->' + self.heapField() + ' = NULL;'
+		print >>out, '\t\tafree(_ad);'
 		
 	def getInvokeCode(self, var, arena, space):
-		if not self.dynamic:
+		if not self.dynamic or self.isSplit():
 			return space + self.name + ' *' + var + ' = ' + arena + ' ? P_ARENA_DATA(' + arena + ', arenaDataKey) : NULL;'
 		else:
 			return space + 'wrapper_' + self.name + ' *_wrapped' + var + ' = ' + arena + ' ? P_ARENA_DATA(' + arena + ', arenaDataKey) : NULL;\n' + space + self.name + ' *' + var + ' = _wrapped' + var + ' ? _wrapped' + var + '->data : NULL;'
 
-	def printDetachBeginCode(self):
+	def managedVar(self):
+		# the variable the attach and detach code reaches managed_items through
+		if self.isSplit():
+			return '_wrapped_ad'
+		return '_ad'
+
+	def printDetachBeginCode(self, out):
 		if not self.dynamic:
-			print '\t\t' + self.name + ' *_ad = P_ARENA_DATA(arena, arenaDataKey);'
+			print >>out, '\t\t' + self.name + ' *_ad = P_ARENA_DATA(arena, arenaDataKey);'
 		else:
-			print '\t\twrapper_' + self.name + ' *_wrapped_ad = P_ARENA_DATA(arena, arenaDataKey);'
-			print '\t\t' + self.name + ' *_ad = _wrapped_ad->data;\n'
+			print >>out, '\t\t' + self.keyType() + ' *_wrapped_ad = P_ARENA_DATA(arena, arenaDataKey);'
+			print >>out, '\t\t' + self.heapType() + ' *_ad = _wrapped_ad->' + self.heapField() + ';\n'
 
 
 class ACEPlayerData(ACEStructure):
+	# structs in each slab of a pool, by default
+	PoolSize = 32
+	# the names declared for a pool
+	PoolSymbols = ['ace_pdata_slot', 'ace_pdata_slab', 'ace_pdata_slabs',
+		'ace_pdata_free', 'ace_pdata_zero', 'ace_pdata_grow', 'ace_pdata_get',
+		'ace_pdata_put']
+
 	def __init__(self, module, dynamic=False):
 		ACEStructure.__init__(self, module, 'playerdata', dynamic)
 		self.closeviaregex = False
+		# the number of structs in each slab, if they come from a pool
+		self.pool = None
+		# whether dynamic player data is only allocated once it is used
+		self.lazy = False
+		# the CB_PLAYERACTION function allocating dynamic player data
+		self.action_function = None
+
+	def pushItem(self, file, line, item, hot=False, managed=False):
+		ACEStructure.pushItem(self, file, line, item, hot, managed)
+		# the first hot field splits the struct
+		if hot and self.action_function:
+			self.updateActionFunction()
 		
-	def printDeclareCode(self):
-		print 'local int playerDataKey = -1;'
-		ACEStructure.printDeclareCode(self)
-
-	def printLoadCode(self):
-                if not self.dynamic:
-                        print '\t\t' + 'playerDataKey = pd->AllocatePlayerData(sizeof(' + self.name + '));'
-                else:
-                        print '\t\t' + 'playerDataKey = pd->AllocatePlayerData(sizeof(wrapper_' + self.name + '));'
-
-		print '\t\tif (' + 'playerDataKey == -1)\n\t\t{'
-		print '\t\t\tlm->Log(L_ERROR, "<' + self.module.name + '> unable to register player-data");'
-		print '\t\t\tfailedLoad = TRUE;'
-		print '\t\t\tgoto ace_fail_load;'
-		print '\t\t}'
-
-	def printUnloadCode(self):
-		print '\t\tif (' + 'playerDataKey != -1)'
-		print '\t\t\tpd->FreePlayerData(playerDataKey);'
+	def printDeclareCode(self, out):
+		print >>out, 'local int playerDataKey = -1;'
+		ACEStructure.printDeclareCode(self, out)
+		if self.dynamic and self.pool:
+			self.printPoolCode(out)
+		if self.dynamic and self.lazy:
+			# returns what $useplayerdata() points to. any thread may touch
+			# the data first, while the main loop frees it.
+			print >>out, 'local pthread_mutex_t ace_pdata_mutex = PTHREAD_MUTEX_INITIALIZER;'
+			print >>out, 'local ' + self.name + ' *ace_pdata_touch(Player *p)\n{'
+			print >>out, self.getWrapperInvokeCode('pdata', 'p', '\t'),
+			print >>out, '\tpthread_mutex_lock(&ace_pdata_mutex);'
+			print >>out, '\tif (!wrapped_pdata->' + self.heapField() + ')\n\t\twrapped_pdata->' + self.heapField() + ' = ' + self.getAllocCode() + ';'
+			print >>out, '\tpthread_mutex_unlock(&ace_pdata_mutex);'
+			if self.isSplit():
+				print >>out, '\treturn wrapped_pdata;\n}\n'
+			else:
+				print >>out, '\treturn wrapped_pdata->data;\n}\n'
+
+	def printPoolCode(self, out):
+		# a free list of structs, carved from slabs that are only freed on
+		# unload. it is used from the main loop (player actions, attach and
+		# detach), and for lazy data from whichever thread touches it first,
+		# which is why lazy data is allocated and freed under ace_pdata_mutex.
+		print >>out, 'typedef union ace_pdata_slot\n{\n\tunion ace_pdata_slot *next;\n\t' + self.heapType() + ' data;\n} ace_pdata_slot;'
+		print >>out, 'typedef struct ace_pdata_slab\n{\n\tstruct ace_pdata_slab *next;\n\tace_pdata_slot slots[' + str(self.pool) + '];\n} ace_pdata_slab;'
+		print >>out, 'local ace_pdata_slab *ace_pdata_slabs = NULL;'
+		print >>out, 'local ace_pdata_slot *ace_pdata_free = NULL;'
+		print >>out, 'local const ' + self.heapType() + ' ace_pdata_zero;\n'
+		print >>out, 'local void ace_pdata_grow(void)\n{\n\tint i;'
+		print >>out, '\tace_pdata_slab *slab = amalloc(sizeof(ace_pdata_slab));'
+		print >>out, '\tslab->next = ace_pdata_slabs;\n\tace_pdata_slabs = slab;'
+		print >>out, '\tfor (i = ' + str(self.pool) + ' - 1; i >= 0; i--)\n\t{'
+		print >>out, '\t\tslab->slots[i].next = ace_pdata_free;\n\t\tace_pdata_free = &slab->slots[i];\n\t}\n}\n'
+		print >>out, 'local ' + self.heapType() + ' *ace_pdata_get(void)\n{\n\tace_pdata_slot *slot;'
+		print >>out, '\tif (!ace_pdata_free)\n\t\tace_pdata_grow();'
+		print >>out, '\tslot = ace_pdata_free;\n\tace_pdata_free = slot->next;'
+		print >>out, '\tslot->data = ace_pdata_zero;\n\treturn &slot->data;\n}\n'
+		print >>out, 'local void ace_pdata_put(' + self.heapType() + ' *data)\n{'
+		print >>out, '\tace_pdata_slot *slot = (ace_pdata_slot *)data;'
+		print >>out, '\tif (slot)\n\t{\n\t\tslot->next = ace_pdata_free;\n\t\tace_pdata_free = slot;\n\t}\n}'
+
+	def getAllocCode(self):
+		# an expression for a new, zeroed struct
+		if self.pool:
+			return 'ace_pdata_get()'
+		return 'amalloc(sizeof(' + self.heapType() + '))'
+
+	def getFreeCode(self, var):
+		if self.pool:
+			return 'ace_pdata_put(' + var + ');'
+		return 'afree(' + var + ');'
+
+	def getAllocateCode(self, space):
+		# allocates the struct of wrapped_pdata, zeroing the hot fields
+		code = ''
+		if self.isSplit():
+			code += space + '*wrapped_pdata = ' + self.hotZero() + ';\n'
+		return code + space + 'wrapped_pdata->' + self.heapField() + ' = ' + self.getAllocCode() + ';\n'
+
+	def getClearCode(self, space):
+		# forgets the struct of wrapped_pdata, after getHeapCode(), zeroing
+		# the hot fields along with it
+		if self.isSplit():
+			return space + '*wrapped_pdata = ' + self.hotZero() + ';\n'
+		return space + 'wrapped_pdata->' + self.heapField() + ' = NULL;\n'
+
+	def updateActionFunction(self):
+		# (re)writes the body of action_function, which depends on the pool
+		# and whether the data is lazy or split
+		body = '\n\t'
+		if not self.lazy:
+			body += 'if (action == PA_PREENTERARENA && arena->status <= ARENA_RUNNING)\n\t{\n' + self.getWrapperInvokeCode('pdata', 'p', '\t\t') + self.getAllocateCode('\t\t')
+			body += '\t}\n\telse '
+		# lazy data may be allocated for a player outside of any arena, who
+		# then never leaves one
+		freed = 'action == PA_LEAVEARENA'
+		free = self.getHeapCode('pdata', 'p', '\t\t') + '\n' + self.getClearCode('\t\t') + '\t\t' + self.getFreeCode('pdata') + '\n'
+		if self.lazy:
+			freed += ' || action == PA_DISCONNECT'
+			free = '\t\tpthread_mutex_lock(&ace_pdata_mutex);\n' + free + '\t\tpthread_mutex_unlock(&ace_pdata_mutex);\n'
+		body += 'if (' + freed + ')\n\t{\n' + free + '\t}\n'
+		self.action_function.body = body
+
+	def printLoadCode(self, out):
+		print >>out, '\t\t' + 'playerDataKey = pd->AllocatePlayerData(sizeof(' + self.keyType() + '));'
+
+		print >>out, '\t\tif (' + 'playerDataKey == -1)\n\t\t{'
+		print >>out, '\t\t\tlm->Log(L_ERROR, "<' + self.module.name + '> unable to register player-data");'
+		print >>out, '\t\t\tfailedLoad = TRUE;'
+		print >>out, '\t\t\tgoto ace_fail_load;'
+		print >>out, '\t\t}'
+		if self.dynamic and self.pool:
+			print >>out, '\t\tace_pdata_grow();'
+
+	def printUnloadCode(self, out):
+		if self.dynamic and self.lazy and not self.pool:
+			# players in arenas the module wasn't attached to may still
+			# have theirs. a pool is freed all at once below.
+			print >>out, '\t\tif (playerDataKey != -1)\n\t\t{\n\t\t\tLink *link;'
+			print >>out, '\t\t\tPlayer *p;'
+			print >>out, '\t\t\tpd->Lock();'
+			print >>out, '\t\t\tpthread_mutex_lock(&ace_pdata_mutex);'
+			print >>out, '\t\t\tFOR_EACH_PLAYER(p)\n\t\t\t{'
+			print >>out, self.getHeapCode('pdata', 'p', '\t\t\t\t')
+			print >>out, '\t\t\t\twrapped_pdata->' + self.heapField() + ' = NULL;'
+			print >>out, '\t\t\t\t' + self.getFreeCode('pdata')
+			print >>out, '\t\t\t}\n\t\t\tpthread_mutex_unlock(&ace_pdata_mutex);'
+			print >>out, '\t\t\tpd->Unlock();'
+			print >>out, '\t\t\tpd->FreePlayerData(playerDataKey);\n\t\t}'
+		else:
+			print >>out, '\t\tif (' + 'playerDataKey != -1)'
+			print >>out, '\t\t\tpd->FreePlayerData(playerDataKey);'
+		if self.dynamic and self.pool:
+			print >>out, '\t\twhile (ace_pdata_slabs)\n\t\t{'
+			print >>out, '\t\t\tace_pdata_slab *slab = ace_pdata_slabs;'
+			print >>out, '\t\t\tace_pdata_slabs = slab->next;\n\t\t\tafree(slab);\n\t\t}'
+			print >>out, '\t\tace_pdata_free = NULL;'
 	
-	def printAttachCode(self):
-		if self.dynamic:
-			print '\t\tpd->Lock();'
-			print '\t\t{\n\t\t\tLink *link;'
-			print '\t\t\tPlayer *p;'
-			print '\t\t\tFOR_EACH_PLAYER_IN_ARENA(p, arena)\n\t\t\t{'
-			print self.getWrapperInvokeCode('pdata', 'p', '\t\t\t\t'),
-			print '\t\t\t\twrapped_pdata->data = amalloc(sizeof(' + self.name + '));'
-			print '\t\t\t}\n\t\t}\n\t\tpd->Unlock();'
-		
-	def printDetachCode(self):
+	def printAttachCode(self, out):
+		if self.dynamic and not self.lazy:
+			print >>out, '\t\tpd->Lock();'
+			print >>out, '\t\t{\n\t\t\tLink *link;'
+			print >>out, '\t\t\tPlayer *p;'
+			print >>out, '\t\t\tFOR_EACH_PLAYER_IN_ARENA(p, arena)\n\t\t\t{'
+			print >>out, self.getWrapperInvokeCode('pdata', 'p', '\t\t\t\t') + self.getAllocateCode('\t\t\t\t'),
+			print >>out, '\t\t\t}\n\t\t}\n\t\tpd->Unlock();'
+		
+	def printDetachCode(self, out):
 		if self.dynamic:
-			print '\t\tpd->Lock();'
-			print '\t\t{\n\t\t\tLink *link;'
-			print '\t\t\tPlayer *p;'
-			print '\t\t\tFOR_EACH_PLAYER_IN_ARENA(p, arena)\n\t\t\t{'
-			print self.getInvokeCode('pdata', 'p', '\t\t\t\t')
-			print '\t\t\t\twrapped_pdata->data = NULL;'
-			print '\t\t\t\tafree(pdata);'
-			print '\t\t\t}\n\t\t}\n\t\tpd->Unlock();'
+			print >>out, '\t\tpd->Lock();'
+			if self.lazy:
+				print >>out, '\t\tpthread_mutex_lock(&ace_pdata_mutex);'
+			print >>out, '\t\t{\n\t\t\tLink *link;'
+			print >>out, '\t\t\tPlayer *p;'
+			print >>out, '\t\t\tFOR_EACH_PLAYER_IN_ARENA(p, arena)\n\t\t\t{'
+			print >>out, self.getHeapCode('pdata', 'p', '\t\t\t\t')
+			print >>out, self.getClearCode('\t\t\t\t') + '\t\t\t\t' + self.getFreeCode('pdata')
+			print >>out, '\t\t\t}\n\t\t}'
+			if self.lazy:
+				print >>out, '\t\tpthread_mutex_unlock(&ace_pdata_mutex);'
+			print >>out, '\t\tpd->Unlock();'
 		
 	def getInvokeCode(self, var, player, space):
-		if not self.dynamic:
+		if self.dynamic and self.lazy:
+			return space + self.name + ' *' + var + ' = ace_pdata_touch(' + player + ');'
+		return self.getPeekCode(var, player, space)
+
+	def getPeekCode(self, var, player, space):
+		if not self.dynamic or self.isSplit():
 			return space + self.name + ' *' + var + ' = PPDATA(' + player + ', playerDataKey);'
 		else:
-			return space + 'wrapper_' + self.name + ' *wrapped_' + var + ' = PPDATA(' + player + ', playerDataKey);\n' + space + self.name + ' *' + var + ' = wrapped_' + var + '->data;'
+			return self.getHeapCode(var, player, space)
+
+	def getHeapCode(self, var, player, space):
+		# declares var as the allocated struct, and wrapped_var as the data
+		# it is kept in
+		return self.getWrapperInvokeCode(var, player, space) + space + self.heapType() + ' *' + var + ' = wrapped_' + var + '->' + self.heapField() + ';'
 
 	def getWrapperInvokeCode(self, var, player, space):
 		if self.dynamic:
-			return space + 'wrapper_' + self.name + ' *wrapped_' + var + ' = PPDATA(' + player + ', playerDataKey);\n'
+			return space + self.keyType() + ' *wrapped_' + var + ' = PPDATA(' + player + ', playerDataKey);\n'
 		else:
 			return ''
 
 
 
-usage = 'Usage: ace.py [options] input_file'
-parser = OptionParser(usage=usage)
-
-parser.add_option("-o", "--output",
-	dest="output_file",
-	help="output to the specified file")
-parser.add_option("-l", "--line-directives",
-	dest="use_line_directives",
-	action="store_true",
-	help="put #line directives in the output to associate output lines with input lines")
-
-(options, in_files) = parser.parse_args()
-
-if len(in_files) == 0:
-	sys.stderr.write('error: no input file\n')	
-	sys.exit(64)
-elif len(in_files) > 1:
-	sys.stderr.write('error: more than one input file specified\n')
-	sys.exit(64)
+def defaultOptions():
+	return makeOptionParser().get_default_values()
+
+def makeOptions(options):
+	# accepts parsed command line options, a dict of option names (as in
+	# the dest of each command line option) or None for the defaults.
+	if options is None:
+		return defaultOptions()
+	if isinstance(options, dict):
+		values = defaultOptions()
+		for key, value in options.items():
+			setattr(values, key, value)
+		return values
+	return options
+
+def lineFilename(filename, options):
+	# the file name written into #line directives. --line-relative-to makes it
+	# relative to a directory, then the last --line-prefix-map whose old
+	# prefix matches replaces that prefix, so the same source gives the same
+	# output wherever it is built from.
+	name = filename
+	relative_to = getattr(options, 'line_relative_to', None)
+	if relative_to:
+		name = os.path.relpath(os.path.abspath(name), os.path.abspath(relative_to))
+	for mapping in reversed(getattr(options, 'line_prefix_map', None) or []):
+		old, new = mapping.split('=', 1)
+		if name.startswith(old):
+			name = new + name[len(old):]
+			break
+	return name
+
+# the declarations --asss-include indexes, found by scanning the text of a
+# header with comments removed. an interface or adviser is a struct with
+# INTERFACE_HEAD_DECL or ADVISER_HEAD_DECL, identified by I_FOO (or A_FOO) for
+# type Ifoo if the header defines it, otherwise by the last I_ (or A_) define
+# before it. the struct may also be declared on its own and named by a
+# separate "typedef struct Ifoo Ifoo;". a callback's function type is the
+# first FooFunc typedef after its CB_ define. attributes, like asss's
+# ATTR_FORMAT(printf, 2, 3), are not part of a signature.
+IndexCommentEx = re.compile(r'/\*.*?\*/|//[^\n]*', re.DOTALL)
+IndexAttributeEx = re.compile(r'\b(?:__attribute__\s*\(\((?:[^()]|\([^()]*\))*\)\)|ATTR_\w+(?:\s*\([^()]*\))?)')
+IndexPreprocessorEx = re.compile(r'^[ \t]*#.*$', re.MULTILINE)
+IndexDefineEx = re.compile(r'^[ \t]*#[ \t]*define[ \t]+((?:I|A|CB)_\w+)\b', re.MULTILINE)
+IndexStructEx = re.compile(r'\btypedef\s+struct\s+\w*\s*\{([^{}]*)\}\s*(\w+)\s*;')
+IndexTaggedStructEx = re.compile(r'\bstruct\s+(\w+)\s*\{([^{}]*)\}\s*;')
+IndexStructNameEx = re.compile(r'\btypedef\s+struct\s+(\w+)\s+(\w+)\s*;')
+IndexFuncTypedefEx = re.compile(r'\btypedef\s+([\w\s*]+?)\s*\(\s*\*\s*(\w+Func)\s*\)\s*\(([^;]*)\)\s*;')
+IndexMemberEx = re.compile(r'^([\w\s*]+?)\s*\(\s*\*\s*(\w+)\s*\)\s*\((.*)\)$', re.DOTALL)
+
+# bumped whenever the result of scanHeader() changes
+IndexFormat = 3
+# the scan of every header read so far, by path: ((mtime, size), scan)
+IndexHeaders = {}
+# the last index of each list of directories, with the stamps of its headers
+IndexLoaded = {}
+
+def squeeze(text):
+	return ' '.join(text.split())
+
+def scanHeader(text):
+	# returns the interfaces and advisers declared in the text of a header,
+	# as {'types': {type: (identifier, slots)}, 'callbacks': {identifier:
+	# (declaration, name, params)}, 'identifiers': [identifier]}. slots are
+	# the (declaration, name, params) of the function pointers in order, or
+	# None if the struct has other members. a callback is None if its
+	# function type wasn't found. identifiers are the I_ and A_ defines.
+	text = IndexAttributeEx.sub(' ', IndexCommentEx.sub(' ', text))
+	found = []
+	for match in IndexDefineEx.finditer(text):
+		found.append((match.start(), 'define', match))
+	for match in IndexStructEx.finditer(text):
+		found.append((match.start(), 'struct', (match.group(1), match.group(2))))
+	# a struct declared by its tag is an interface by the name it is given
+	names = {}
+	for match in IndexStructNameEx.finditer(text):
+		names.setdefault(match.group(1), []).append(match.group(2))
+	for match in IndexTaggedStructEx.finditer(text):
+		for name in names.get(match.group(1), []):
+			found.append((match.start(), 'struct', (match.group(2), name)))
+	for match in IndexFuncTypedefEx.finditer(text):
+		found.append((match.start(), 'typedef', match))
+	found.sort(key=lambda item: item[0])
+	defined = set([match.group(1) for position, kind, match in found if kind == 'define'])
+
+	types = {}
+	callbacks = {}
+	last = {}
+	callback = None
+	for position, kind, match in found:
+		if kind == 'define':
+			identifier = match.group(1)
+			if identifier[0:3] == 'CB_':
+				callbacks[identifier] = None
+				callback = identifier
+			else:
+				last[identifier[0]] = identifier
+		elif kind == 'struct':
+			body, type = match
+			body = IndexPreprocessorEx.sub(' ', body)
+			if 'INTERFACE_HEAD_DECL' in body:
+				prefix = 'I'
+			elif 'ADVISER_HEAD_DECL' in body:
+				prefix = 'A'
+			else:
+				continue
+			identifier = prefix + '_' + type[1:].upper()
+			if identifier not in defined:
+				identifier = last.get(prefix)
+			if not identifier:
+				continue
+			body = body.replace(prefix == 'I' and 'INTERFACE_HEAD_DECL' or 'ADVISER_HEAD_DECL', '')
+			slots = []
+			for member in body.split(';'):
+				member = member.strip()
+				if not member:
+					continue
+				function = IndexMemberEx.match(member)
+				if not function:
+					slots = None
+					break
+				slots.append((squeeze(function.group(1)), function.group(2),
+					squeeze(function.group(3))))
+			types[type] = (identifier, slots)
+		elif callback:
+			callbacks[callback] = (squeeze(match.group(1)), match.group(2),
+				squeeze(match.group(3)))
+			callback = None
+	return {'types': types, 'callbacks': callbacks,
+		'identifiers': sorted([identifier for identifier in defined if identifier[0:3] <> 'CB_'])}
+
+def scanHeaderFile(path):
+	# returns the scan of a header and whether it had to be read, which is
+	# only when its mtime or size changed since the scan in IndexHeaders
+	info = os.stat(path)
+	stamp = (info.st_mtime, info.st_size)
+	known = IndexHeaders.get(path)
+	if known and known[0] == stamp:
+		return known[1], False
+	handle = open(path, 'rU')
+	try:
+		scan = scanHeader(handle.read())
+	finally:
+		handle.close()
+	IndexHeaders[path] = (stamp, scan)
+	return scan, True
+
+def indexFromScans(scans):
+	types = {}
+	callbacks = {}
+	for scan in scans:
+		types.update(scan['types'])
+		for identifier, declared in scan['callbacks'].iteritems():
+			if declared or identifier not in callbacks:
+				callbacks[identifier] = declared
+	identifiers = {}
+	auto = {}
+	for type, (identifier, slots) in types.iteritems():
+		identifiers[identifier] = type
+		# interfaces used through a pointer named after the type, like
+		# flagcore->, don't need a $#require. see autoInterfaces
+		if identifier[0:2] == 'I_':
+			auto[type[1:].lower()] = (type, identifier)
+	return {'types': types, 'callbacks': callbacks, 'identifiers': identifiers,
+		'auto': auto}
+
+def indexCachePath(cache_dir):
+	return os.path.join(cache_dir, 'asss-index.acecache')
+
+def loadInterfaceIndex(include_dirs, cache_dir=None):
+	# indexes the interfaces, advisers and callbacks declared in the .h files
+	# in include_dirs. each header is only scanned again when its mtime or
+	# size changes; the scans are kept for the life of the process and, with
+	# a cache_dir, on disk for the next one.
+	if cache_dir and not IndexHeaders:
+		try:
+			handle = open(indexCachePath(cache_dir), 'rb')
+			try:
+				cached = cPickle.load(handle)
+			finally:
+				handle.close()
+			if cached.get('format') == (ACE_VERSION, IndexFormat):
+				IndexHeaders.update(cached['headers'])
+		except (IOError, EOFError, cPickle.UnpicklingError, AttributeError):
+			pass
+
+	headers = []
+	for include_dir in include_dirs:
+		headers.extend([os.path.join(include_dir, name)
+			for name in sorted(os.listdir(include_dir)) if name.endswith('.h')])
+	scans = []
+	stamps = []
+	changed = False
+	for header in headers:
+		scan, scanned = scanHeaderFile(header)
+		scans.append(scan)
+		stamps.append((header, IndexHeaders[header][0]))
+		changed = changed or scanned
+	loaded = IndexLoaded.get(tuple(include_dirs))
+	if loaded and loaded[0] == stamps:
+		return loaded[1]
+	if cache_dir and changed:
+		# only an accelerator, like the cache of generated code
+		try:
+			if not os.path.isdir(cache_dir):
+				os.makedirs(cache_dir)
+			writeIfChanged(indexCachePath(cache_dir), cPickle.dumps({
+				'format': (ACE_VERSION, IndexFormat),
+				'headers': IndexHeaders}, cPickle.HIGHEST_PROTOCOL))
+		except (IOError, OSError):
+			pass
+
+	index = indexFromScans(scans)
+	index['dirs'] = list(include_dirs)
+	index['headers'] = headers
+	index['scans'] = scans
+	# changes with what the headers declare, not with their timestamps
+	index['fingerprint'] = hashlib.sha1(repr((sorted(index['types'].items()),
+		sorted(index['callbacks'].items())))).hexdigest()
+	IndexLoaded[tuple(include_dirs)] = (stamps, index)
+	return index
+
+def interfaceIndexFor(options):
+	include_dirs = getattr(options, 'asss_include', None)
+	if not include_dirs:
+		return None
+	return loadInterfaceIndex(include_dirs, getattr(options, 'cache_dir', None))
+
+def quotedHeaders(index, includes, filename):
+	# (include, path) for each include with quotes, looked for next to
+	# filename and in the index directories, if there is an index. path is
+	# None if it isn't found.
+	search = [os.path.dirname(filename)] + (index and index['dirs'] or [])
+	headers = []
+	for include in includes:
+		if include[0] != '"':
+			continue
+		for directory in search:
+			path = os.path.join(directory, include[1:-1])
+			if os.path.isfile(path):
+				headers.append((include, path))
+				break
+		else:
+			headers.append((include, None))
+	return headers
+
+def moduleIndex(index, module, filename):
+	# index with the declarations of the headers module includes with quotes
+	# added. also returns whether all of those headers were found; if not,
+	# something may be declared in one that is missing (not generated yet,
+	# say.)
+	scans = []
+	complete = True
+	for include, path in quotedHeaders(index, module.includes, filename):
+		if path is None:
+			complete = False
+		elif path not in index['headers']:
+			scans.append(scanHeaderFile(path)[0])
+	if scans:
+		index = indexFromScans(index['scans'] + scans)
+	return index, complete
+
+def declaredInterfaces(module, filename, options):
+	# {identifier: include} for the interfaces module implements that a
+	# header declares already: one the module includes with quotes, or one
+	# indexed for --asss-include. the public header includes it rather than
+	# declaring the interface again, with an identifier of its own.
+	index = interfaceIndexFor(options)
+	headers = []
+	for include, path in quotedHeaders(index, module.includes.values(), filename):
+		if path:
+			headers.append((include, scanHeaderFile(path)[0]))
+	if index:
+		for path, scan in zip(index['headers'], index['scans']):
+			headers.append(('"' + os.path.basename(path) + '"', scan))
+	declared = {}
+	for int in module.my_global_interfaces + module.my_arena_interfaces:
+		for include, scan in headers:
+			if int.identifier in scan['identifiers'] or int.type in scan['types']:
+				declared.setdefault(int.identifier, include)
+				break
+	return declared
+
+CTypeWords = set(['void', 'char', 'short', 'int', 'long', 'float', 'double',
+	'signed', 'unsigned', '_Bool', 'const', 'volatile', 'struct', 'union', 'enum'])
+CQualifiers = set(['const', 'volatile', 'register'])
+FunctionPointerEx = re.compile(r'^(.*)\(\*\w*\)\((.*)\)$')
+ParamNameEx = re.compile(r'^(.*[ *])([A-Za-z_]\w*)((?:\[[^\]]*\])*)$')
+
+def normalizeType(text):
+	# text without the spaces C doesn't care about
+	return re.sub(r' ?([*,()\[\]]) ?', r'\1', squeeze(text))
+
+def parameterTypes(params):
+	# the types in a parameter list, without the parameter names
+	split = []
+	depth = 0
+	current = ''
+	for c in params:
+		if c == ',' and depth == 0:
+			split.append(current)
+			current = ''
+			continue
+		if c == '(':
+			depth += 1
+		elif c == ')':
+			depth -= 1
+		current += c
+	split.append(current)
+
+	types = []
+	for param in split:
+		param = normalizeType(param)
+		pointer = FunctionPointerEx.match(param)
+		if pointer:
+			param = pointer.group(1) + '(*)(' + ','.join(parameterTypes(pointer.group(2))) + ')'
+		else:
+			named = ParamNameEx.match(param)
+			if named and named.group(2) not in CTypeWords:
+				rest = named.group(1).strip()
+				words = [word for word in re.findall(r'\w+', rest) if word not in CQualifiers]
+				if ('*' in rest or words) and words[-1:] not in (['struct'], ['union'], ['enum']):
+					param = rest + '*' * named.group(3).count('[')
+		types.append(param)
+	if types == ['']:
+		types = ['void']
+	return types
+
+def sameSignature(declaration, params, other_declaration, other_params):
+	return normalizeType(declaration) == normalizeType(other_declaration) \
+		and parameterTypes(params) == parameterTypes(other_params)
+
+def signatureText(declaration, name, params):
+	return '"' + squeeze(declaration) + ' ' + name + '(' + squeeze(params) + ')"'
+
+def setupProcessor(processor, module, filename, options):
+	processor.options = options
+	processor.index = interfaceIndexFor(options)
+	module.source_file = filename
+	processor.line_filename = module.line_file = lineFilename(filename, options)
+
+	if options.use_line_directives:
+		processor.use_line_directives = True
+		module.use_line_directives = True
+	if getattr(options, 'packed_layout', False):
+		module.packed_layout = True
+	if getattr(options, 'size_probes', False):
+		module.size_probes = True
+
+def parseModule(source_text, filename, options=None, stats=None):
+	# parses the text of an ACE module and returns the populated ACEModule.
+	# filename is used in error messages and #line directives, and to find
+	# the fragments the module imports.
+	# stats, if given, is a dict from newStats() to add parsing statistics to.
+	# raises ProcessingException on errors.
+	options = makeOptions(options)
+	module = ACEModule()
+	processor = Processor(filename, module, source_text)
+	processor.stats = stats
+	setupProcessor(processor, module, filename, options)
+	processor.process()
+	return module
+
+# a fragment is parsed as a module with this name, replaced by the name of the
+# module importing it. it can't be part of any C name or string.
+FragmentModuleName = '$#module'
+ImportEx = re.compile(r'^\$#import "([^"]+)"\s*$', re.MULTILINE)
+
+# the fragments parsed so far, pickled, by fragmentKey(). every import gets its
+# own copy to merge.
+FragmentCache = {}
+
+def importPath(filename, path):
+	return os.path.normpath(os.path.join(os.path.dirname(filename), path))
+
+def importedSources(filename, source, seen=None):
+	# the (path, text) of every fragment imported by source, directly or not,
+	# in the order they are found. the ones that can't be read are left out,
+	# parsing reports them.
+	if seen is None:
+		seen = set()
+	sources = []
+	for path in ImportEx.findall(source):
+		path = importPath(filename, path)
+		if path in seen:
+			continue
+		seen.add(path)
+		try:
+			handle = open(path, 'rb')
+			try:
+				text = handle.read()
+			finally:
+				handle.close()
+		except IOError:
+			continue
+		sources.append((path, text))
+		sources.extend(importedSources(path, text, seen))
+	return sources
+
+def mergeRanges(ranges):
+	# the (start, end) ranges sorted, with the overlapping ones joined
+	merged = []
+	for (start, end) in sorted(ranges):
+		if merged and start <= merged[-1][1]:
+			merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+		else:
+			merged.append((start, end))
+	return merged
+
+def cutPosition(cuts, position):
+	# where position in a text ends up once the ranges in cuts are removed
+	for (start, end) in cuts:
+		if start >= position:
+			break
+		position -= min(end, position) - start
+	return position
+
+def fragmentKey(path, source, options):
+	# everything parsing a fragment depends on: its text and the fragments it
+	# imports, the options the parser uses, and the interface index
+	key = hashlib.sha1()
+	key.update('%s\0%d\0%s\0%s\0' % (ACE_VERSION, CacheFormat, path, lineFilename(path, options)))
+	key.update('%r\0%r\0' % (bool(options.use_line_directives),
+		bool(getattr(options, 'packed_layout', False))))
+	index = interfaceIndexFor(options)
+	if index:
+		key.update(index['fingerprint'])
+	for imported, text in [(path, source)] + importedSources(path, source):
+		key.update('%s\0%d\0%s' % (imported, len(text), text))
+	return key.hexdigest()
+
+def parseFragment(path, options, importing=()):
+	# returns a copy of the ACEModule parsed from the fragment at path, for
+	# $#import, from FragmentCache or the --cache-dir if it was parsed before.
+	# raises IOError if it can't be read and ProcessingException on errors.
+	options = makeOptions(options)
+	handle = open(path, 'rb')
+	try:
+		source = handle.read()
+	finally:
+		handle.close()
+
+	key = fragmentKey(path, source, options)
+	pickled = FragmentCache.get(key)
+	cache_dir = getattr(options, 'cache_dir', None)
+	cache_file = cache_dir and os.path.join(cache_dir, key + '.acefragment')
+	if pickled is None and cache_file:
+		try:
+			handle = open(cache_file, 'rb')
+		except IOError:
+			handle = None
+		if handle:
+			try:
+				try:
+					pickled = handle.read()
+				finally:
+					handle.close()
+				unpickler = cPickle.Unpickler(StringIO(pickled))
+				unpickler.find_global = findIRClass
+				if not isinstance(unpickler.load(), ACEModule):
+					raise ValueError('not a fragment')
+			except Exception:
+				# as in cacheLoad(), anything wrong with it makes it a miss, and
+				# it is removed so it doesn't fail every time
+				pickled = None
+				try:
+					os.remove(cache_file)
+				except OSError:
+					pass
+
+	if pickled is None:
+		module = ACEModule()
+		module.name = FragmentModuleName
+		processor = Processor(path, module, source)
+		processor.fragment = True
+		processor.importing = list(importing)
+		processor.expected_directive = None
+		setupProcessor(processor, module, path, options)
+		processor.process()
+		pickled = cPickle.dumps(module, cPickle.HIGHEST_PROTOCOL)
+		if cache_file:
+			cacheStore(cache_dir, key, module, '.acefragment')
+	FragmentCache[key] = pickled
+	return cPickle.loads(pickled)
+
+def translate(source_text, filename, options=None):
+	# translates the text of an ACE module, returning the generated C code.
+	# raises ProcessingException on errors.
+	output = StringIO()
+	parseModule(source_text, filename, options).writeOut(output)
+	return output.getvalue()
+
+def sourceHash(source_text, filename=None):
+	# with a filename, the fragments the source imports are part of the hash
+	digest = hashlib.sha1(source_text)
+	if filename:
+		for path, text in importedSources(filename, source_text):
+			digest.update('\0%s\0%d\0%s' % (path, len(text), text))
+	return digest.hexdigest()
+
+# the intermediate representation of a module is the fully parsed ACEModule,
+# pickled along with a header saying where it came from. -l (and the #line
+# options) change what the parser records, so they are part of the header;
+# options that only change the emitted code can differ between writing and
+# using the IR.
+IR_FORMAT = 'ace-ir'
+IR_VERSION = 12
+
+class IRException(Exception):
+	def __init__(self, filename, value):
+		self.filename = filename
+		self.value = value
+	def message(self):
+		return self.filename + ': error: ' + self.value
+	def __str__(self):
+		return repr(self.message())
 
-in_file = in_files[0]
+def writeIR(handle, module, source_text, options=None):
+	options = makeOptions(options)
+	ir = {'format': IR_FORMAT,
+		'version': IR_VERSION,
+		'ace_version': ACE_VERSION,
+		'source_file': module.source_file,
+		'line_file': module.line_file,
+		'source_hash': sourceHash(source_text, module.source_file),
+		'use_line_directives': bool(options.use_line_directives),
+		'module': module}
+	cPickle.dump(ir, handle, cPickle.HIGHEST_PROTOCOL)
+
+def findIRClass(module_name, class_name):
+	# IR written by ace.py run as a script refers to __main__, IR written
+	# through the library to ace. either way only ACE's classes are loaded.
+	if module_name in ('__main__', 'ace') and class_name.startswith('ACE') \
+		and class_name in globals():
+		return globals()[class_name]
+	if module_name == 'collections' and class_name == 'OrderedDict':
+		return OrderedDict
+	raise cPickle.UnpicklingError('%s.%s is not part of ACE IR' % (module_name, class_name))
+
+def irMismatch(ir, in_file, options):
+	# returns why the module in the IR is not what parsing in_file with these
+	# options would give, or None if it is (as far as the options go.)
+	if ir['use_line_directives'] != bool(options.use_line_directives):
+		return 'IR was parsed %s -l' % (ir['use_line_directives'] and 'with' or 'without')
+	if not ir['use_line_directives']:
+		return None
+	if ir['line_file'] != lineFilename(in_file, options):
+		return 'IR was parsed with #line file name "%s"' % ir['line_file']
+	return None
+
+def readIR(filename):
+	# returns the IR dict written by writeIR. raises IRException if the file
+	# is not IR written by this version of ACE, IOError if it can't be read.
+	handle = open(filename, 'rb')
+	try:
+		try:
+			unpickler = cPickle.Unpickler(handle)
+			unpickler.find_global = findIRClass
+			ir = unpickler.load()
+		except (EOFError, cPickle.UnpicklingError, ValueError):
+			raise IRException(filename, 'not an ACE IR file')
+	finally:
+		handle.close()
+	if not isinstance(ir, dict) or ir.get('format') != IR_FORMAT:
+		raise IRException(filename, 'not an ACE IR file')
+	if ir.get('version') != IR_VERSION or ir.get('ace_version') != ACE_VERSION:
+		raise IRException(filename, 'IR was written by a different version of ACE')
+	return ir
+
+
+def outputPathFor(in_file, output_dir):
+	base = os.path.splitext(os.path.basename(in_file))[0]
+	return os.path.join(output_dir, base + '.acec')
+
+def splitJobSpec(spec):
+	# input:output pairs. a colon at index 1 is a drive letter, not a separator
+	sep = spec.rfind(':')
+	if sep > 1:
+		return spec[0:sep], spec[sep + 1:]
+	return spec, None
+
+# options that change the generated code, and so are part of the cache key
+CacheKeyOptions = ['use_line_directives', 'line_relative_to', 'line_prefix_map',
+	'compact_lines', 'line_map', 'header', 'prologue', 'packed_layout',
+	'size_probes']
+# bumped whenever the contents of a cache entry change
+CacheFormat = 6
+
+QuotedIncludeEx = re.compile(r'^#include ("[^"]+")', re.MULTILINE)
+
+def cacheKey(in_file, source, options):
+	key = hashlib.sha1()
+	key.update('%s\0%d\0%s\0' % (ACE_VERSION, CacheFormat, in_file))
+	for name in CacheKeyOptions:
+		key.update(name + '=' + repr(getattr(options, name, None)) + '\0')
+	# what the interface index finds changes the output, and the checks
+	index = interfaceIndexFor(options)
+	imports = importedSources(in_file, source)
+	if index:
+		key.update('index=' + index['fingerprint'] + '\0')
+	# as do the module's own quoted headers, which moduleIndex() adds and
+	# which may declare the interfaces of the public header
+	if index or getattr(options, 'header', False):
+		includes = []
+		for text in [source] + [text for path, text in imports]:
+			includes.extend(QuotedIncludeEx.findall(text))
+		for include, path in quotedHeaders(index, includes, in_file):
+			text = None
+			if path and not (index and path in index['headers']):
+				try:
+					handle = open(path, 'rb')
+					try:
+						text = handle.read()
+					finally:
+						handle.close()
+				except IOError:
+					pass
+			if text is not None:
+				key.update('header=%s\0%d\0%s' % (path, len(text), text))
+			else:
+				key.update('header=%s\0%s\0' % (include, path))
+	for path, text in imports:
+		key.update('import=%s\0%d\0%s' % (path, len(text), text))
+	key.update(source)
+	return key.hexdigest()
+
+def cacheLoad(cache_dir, key):
+	path = os.path.join(cache_dir, key + '.acecache')
+	try:
+		handle = open(path, 'rb')
+	except IOError:
+		return None
+	try:
+		try:
+			entry = cPickle.load(handle)
+		finally:
+			handle.close()
+		if not isinstance(entry, dict) or 'output' not in entry:
+			raise ValueError('not a cache entry')
+		return entry
+	except Exception:
+		# a truncated or corrupt entry unpickles with any exception at all.
+		# it is a miss, and is removed so it doesn't fail every time.
+		try:
+			os.remove(path)
+		except OSError:
+			pass
+		return None
 
-my_module = ACEModule()
-try:
-	my_processor = Processor(in_file, my_module)
-except IOError, e:
-	(errno, message) = e
-	sys.stderr.write('%s: error: unable to read file: %s\n' % (in_file, message))
-	sys.exit(32)
+def cacheStore(cache_dir, key, entry, suffix='.acecache'):
+	# the cache is only an accelerator, failing to store an entry is harmless
+	try:
+		if not os.path.isdir(cache_dir):
+			os.makedirs(cache_dir)
+		handle = open(os.path.join(cache_dir, key + suffix), 'wb')
+		try:
+			cPickle.dump(entry, handle, cPickle.HIGHEST_PROTOCOL)
+		finally:
+			handle.close()
+	except (IOError, OSError):
+		pass
+
+def writeIfChanged(out_file, text):
+	# leaves out_file (and its mtime) alone when it already holds text, so make
+	# does not recompile a module whose generated code did not change.
+	# otherwise the new contents are renamed into place, so a reader (or a
+	# concurrent build) never sees a half-written file.
+	# returns True if the file was written.
+	try:
+		handle = open(out_file, 'rb')
+		try:
+			if handle.read() == text:
+				return False
+		finally:
+			handle.close()
+	except IOError:
+		pass
+	temp_file = '%s.%d.tmp' % (out_file, os.getpid())
+	handle = open(temp_file, 'wb')
+	try:
+		try:
+			handle.write(text)
+		finally:
+			handle.close()
+		os.rename(temp_file, out_file)
+	except (IOError, OSError), e:
+		try:
+			os.remove(temp_file)
+		except OSError:
+			pass
+		raise IOError(e.errno, e.strerror)
+	return True
+
+StatsPhases = ['read', 'classify', 'function_capture', 'struct_capture', 'emit']
+StatsCounts = ['lines', 'directives', 'inlines', 'functions', 'line_directives', 'output_bytes']
+
+def newStats(in_file):
+	stats = {'file': in_file, 'cached': False}
+	for name in StatsPhases + StatsCounts:
+		stats[name] = 0
+	return stats
+
+def countOutputStats(stats, output):
+	stats['output_bytes'] = len(output)
+	stats['line_directives'] = output.count('\n#line ')
+	if output[0:6] == '#line ':
+		stats['line_directives'] += 1
+
+def formatStats(stats_list):
+	# a table for --stats, one row per input and a total if there are several
+	rows = list(stats_list)
+	if len(rows) > 1:
+		total = newStats('total')
+		for stats in rows:
+			for name in StatsPhases + StatsCounts:
+				total[name] += stats[name]
+		rows.append(total)
+
+	text = '%-24s %9s %9s %9s %9s %9s %7s %6s %6s %5s %6s %9s\n' % ('file',
+		'read', 'classify', 'function', 'struct', 'emit',
+		'lines', 'direct', 'inline', 'funcs', '#line', 'bytes')
+	for stats in rows:
+		name = stats['file']
+		if stats['cached']:
+			name += ' (cached)'
+		text += '%-24s' % name
+		for phase in StatsPhases:
+			text += ' %7.1fms' % (stats[phase] * 1000)
+		text += ' %7d %6d %6d %5d %6d %9d\n' % tuple([stats[name] for name in StatsCounts])
+	return text
+
+LineDirectiveEx = re.compile(r'#line (\d+) "(.*)"\s*$')
+
+def compactLineDirectives(text):
+	# drops every #line directive that names the line the preprocessor would
+	# be on anyway, along with the blank line ACE puts before most of them.
+	lines = []
+	file = None
+	line = 0
+	for L in text.splitlines(True):
+		if L[0:6] == '#line ':
+			directive = LineDirectiveEx.match(L)
+			if directive:
+				if lines and lines[-1] == '\n' and (len(lines) < 2 or lines[-2][-2:] != '\\\n'):
+					lines.pop()
+					line -= 1
+				if directive.group(2) == file and int(directive.group(1)) == line:
+					continue
+				file = directive.group(2)
+				line = int(directive.group(1))
+				lines.append(L)
+				continue
+		lines.append(L)
+		line += 1
+	return ''.join(lines)
+
+def presumedLines(text):
+	# the file and line the preprocessor takes each line of code to come
+	# from, as (code, file, line), leaving out blank lines and the #line
+	# directives. --compact-lines must not change it.
+	lines = []
+	file = None
+	line = 0
+	for L in text.splitlines(True):
+		if L[0:6] == '#line ':
+			directive = LineDirectiveEx.match(L)
+			if directive:
+				file = directive.group(2)
+				line = int(directive.group(1))
+				continue
+		if L.strip():
+			lines.append((L, file, line))
+		line += 1
+	return lines
+
+def stripLineDirectives(text):
+	# removes the #line directives, returning the code and a line map with a
+	# "first last file line" row for each run of output lines that come from
+	# consecutive source lines. output lines before the first directive are
+	# generated by ACE and not in the map.
+	lines = []
+	runs = []
+	file = None
+	line = 0
+	for L in text.splitlines(True):
+		if L[0:6] == '#line ':
+			directive = LineDirectiveEx.match(L)
+			if directive:
+				if lines and lines[-1] == '\n' and (len(lines) < 2 or lines[-2][-2:] != '\\\n'):
+					lines.pop()
+					if runs and runs[-1][1] > len(lines):
+						runs[-1][1] -= 1
+						if runs[-1][1] < runs[-1][0]:
+							runs.pop()
+				file = directive.group(2)
+				line = int(directive.group(1))
+				continue
+		lines.append(L)
+		if file is not None:
+			last = runs and runs[-1]
+			if last and last[2] == file and last[1] + 1 == len(lines) \
+				and last[3] + last[1] - last[0] + 1 == line:
+				last[1] += 1
+			else:
+				runs.append([len(lines), len(lines), file, line])
+			line += 1
+
+	line_map = '# ace line map: first and last output line, source file and line\n'
+	for first, last, file, line in runs:
+		line_map += '%d %d %s %d\n' % (first, last, file, line)
+	return ''.join(lines), line_map
+
+def headerNameFor(in_file):
+	# the public header is named after the input, like the output is in ace.mk.
+	# .ace.h keeps it apart from the asss header a module may be named after
+	# (chat.h, balls.h...)
+	return os.path.splitext(os.path.basename(in_file))[0] + '.ace.h'
+
+def renderModule(module, options=None):
+	# returns a cache entry with the generated code and the #include list
+	# needed for the dependency file, the line map with --line-map and the
+	# public header with --header.
+	output = StringIO()
+	module.writeOut(output)
+	text = output.getvalue()
+	entry = {'includes': module.includes.values(), 'imports': module.imports}
+	if module.public_header:
+		header = StringIO()
+		module.writeHeader(header, declaredInterfaces(module, module.source_file, options))
+		entry['header'] = header.getvalue()
+	if getattr(options, 'line_map', False):
+		text, entry['line_map'] = stripLineDirectives(text)
+	elif getattr(options, 'compact_lines', False):
+		text = compactLineDirectives(text)
+	entry['output'] = text
+	return entry
+
+def dependencyText(in_file, out_file, includes, index_headers=(), imports=(), scanned=False):
+	# make rules in the style of cc -MMD -MP: the generated file depends on the
+	# source, the fragments it imports and the headers indexed for
+	# --asss-include, the object depends on every quoted #include that can be
+	# found next to the source. system headers are left out. if scanned is
+	# set, ACE read those quoted headers too (for the index or the public
+	# header), so the generated file depends on them as well.
+	headers = []
+	source_dir = os.path.dirname(in_file)
+	for include in includes:
+		if include[0] != '"':
+			continue
+		header = os.path.join(source_dir, include[1:-1])
+		if os.path.exists(header) and header not in headers:
+			headers.append(header)
+
+	object_file = os.path.splitext(out_file)[0] + '.o'
+	sources = list(imports) + list(index_headers)
+	if scanned:
+		sources += [header for header in headers if header not in sources]
+	text = out_file + ': ' + ' '.join([in_file] + sources) + '\n'
+	text += object_file + ': ' + ' '.join([out_file] + headers) + '\n'
+	for header in headers + [source for source in sources if source not in headers]:
+		text += '\n' + header + ':\n'
+	return text
+
+def translateFile(in_file, out_file, options, stats=None):
+	# translates one .aces file with a fresh module and processor, writing to
+	# out_file (or stdout if None.) errors are reported on stderr, and an exit
+	# status is returned so batch callers can carry on with the next file.
+	# with --from-ir, in_file may be None to translate the IR without a source.
+	# stats, if given, is a dict from newStats() that is filled in.
+	ir = None
+	source_given = in_file is not None
+	from_ir = getattr(options, 'from_ir', None)
+	if from_ir:
+		try:
+			ir = readIR(from_ir)
+		except IOError, e:
+			(errno, message) = e
+			sys.stderr.write('%s: error: unable to read file: %s\n' % (from_ir, message))
+			return 32
+		except IRException, e:
+			if not source_given:
+				sys.stderr.write(e.message() + '\n')
+				return 32
+			ir = None
+		mismatch = ir and irMismatch(ir, in_file or ir['source_file'], options)
+		if mismatch:
+			if not source_given:
+				sys.stderr.write('%s: error: %s\n' % (from_ir, mismatch))
+				return 64
+			ir = None
+		if not source_given:
+			in_file = ir['source_file']
+
+	source = None
+	if source_given:
+		start = time.time()
+		try:
+			handle = open(in_file, 'rb')
+			try:
+				source = handle.read()
+			finally:
+				handle.close()
+		except IOError, e:
+			(errno, message) = e
+			sys.stderr.write('%s: error: unable to read file: %s\n' % (in_file, message))
+			return 32
+		if stats is not None:
+			stats['read'] = time.time() - start
+		# the IR only stands in for the source it was parsed from
+		if ir and sourceHash(source, in_file) != ir['source_hash']:
+			ir = None
+
+	emit_ir = getattr(options, 'emit_ir', None)
+	entry = None
+	cache_dir = getattr(options, 'cache_dir', None)
+	if source is None or emit_ir:
+		cache_dir = None
+	if cache_dir:
+		key = cacheKey(in_file, source, options)
+		entry = cacheLoad(cache_dir, key)
+		if entry and stats is not None:
+			stats['cached'] = True
+
+	if not entry:
+		if ir:
+			module = ir['module']
+		else:
+			try:
+				module = parseModule(source, in_file, options, stats)
+			except ProcessingException, e:
+				sys.stderr.write(e.message())
+				sys.stderr.write('\n')
+				return 1
+		if emit_ir and source is not None:
+			try:
+				handle = open(emit_ir, 'wb')
+				try:
+					writeIR(handle, module, source, options)
+				finally:
+					handle.close()
+			except IOError, e:
+				(errno, message) = e
+				sys.stderr.write('%s: error: unable to write file: %s\n' % (emit_ir, message))
+				return 16
+		if getattr(options, 'header', False):
+			module.public_header = headerNameFor(in_file)
+		module.prologue = getattr(options, 'prologue', None)
+		start = time.time()
+		entry = renderModule(module, options)
+		if stats is not None:
+			stats['emit'] = time.time() - start
+			if ir:
+				stats['functions'] = len(module.functions)
+		if cache_dir:
+			cacheStore(cache_dir, key, entry)
+
+	if stats is not None:
+		countOutputStats(stats, entry['output'])
+
+	if not out_file:
+		sys.stdout.write(entry['output'])
+		return 0
+
+	outputs = [(out_file, entry['output'])]
+	if getattr(options, 'make_deps', False):
+		index = interfaceIndexFor(options)
+		outputs.append((out_file + '.d',
+			dependencyText(in_file, out_file, entry['includes'],
+				index and index['headers'] or (), entry['imports'],
+				bool(index) or 'header' in entry)))
+	if 'line_map' in entry:
+		outputs.append((out_file + '.linemap', entry['line_map']))
+	if 'header' in entry:
+		# written first, so the output never includes a missing header
+		outputs.insert(0, (os.path.join(os.path.dirname(out_file),
+			headerNameFor(in_file)), entry['header']))
+
+	for path, text in outputs:
+		try:
+			if writeIfChanged(path, text) and getattr(options, 'verbose', False):
+				sys.stderr.write('%s: wrote %s\n' % (in_file, path))
+		except IOError, e:
+			(errno, message) = e
+			sys.stderr.write('%s: error: unable to write file: %s\n' % (path, message))
+			return 16
+	return 0
+
+MemberUseEx = r'(?:->|\.)\s*%s\b'
+
+def unityText(modules, out_file, interfaces=False, options=None):
+	# puts the generated code of every module in one translation unit. the
+	# includes of all the modules come first, in the order they first
+	# appear, followed by the interface types from the modules' public
+	# headers if interfaces is set (see writeHeader), which then aren't
+	# included themselves, so they needn't have been written. the headers
+	# declaring interfaces already (see declaredInterfaces()) are included
+	# with the others.
+	# names that several modules declare (dependency pointers included) are
+	# renamed within each module with #define and #undef, so the modules are
+	# compiled as they would be on their own, and MM_ entry points stay
+	# exported. a module's private headers, the quoted ones found next to its
+	# source, are included at the start of its own code rather than with the
+	# others.
+	# raises UnityException if a name can't be renamed safely.
+	names = {}
+	seen = {}
+	for module in modules:
+		if module.name in names:
+			raise UnityException(module.source_file,
+				'module ' + module.name + ' is also defined in ' + names[module.name])
+		names[module.name] = module.source_file
+		for name in module.fileScopeSymbols():
+			seen[name] = seen.get(name, 0) + 1
+	renamed = set([name for name, count in seen.iteritems() if count > 1])
+
+	out_dir = os.path.dirname(out_file or '')
+	includes = OrderedDict([('"asss.h"', None)])
+	private = {}
+	headers = set()
+	if interfaces:
+		headers = set(['"' + headerNameFor(module.source_file) + '"' for module in modules])
+	for module in modules:
+		source_dir = os.path.dirname(module.source_file)
+		private[module.name] = []
+		for include in module.includes.itervalues():
+			if include in headers:
+				continue
+			# quoted includes are found next to each source
+			if include[0] == '"' and source_dir:
+				header = os.path.join(source_dir, include[1:-1])
+				if os.path.exists(header):
+					private[module.name].append('"' + os.path.relpath(header, out_dir or '.') + '"')
+					continue
+			includes[include] = None
+
+	declared = set()
+	if interfaces:
+		for module in modules:
+			source_dir = os.path.dirname(module.source_file)
+			for identifier, include in declaredInterfaces(module, module.source_file, options).iteritems():
+				declared.add(identifier)
+				if include[0] == '"' and source_dir:
+					header = os.path.join(source_dir, include[1:-1])
+					if os.path.exists(header):
+						include = '"' + os.path.relpath(header, out_dir or '.') + '"'
+						if include in private[module.name]:
+							private[module.name].remove(include)
+				includes[include] = None
+
+	out = StringIO()
+	for include in includes:
+		print >>out, '#include', include
+	if interfaces:
+		identifiers = []
+		for module in modules:
+			for int in module.my_global_interfaces + module.my_arena_interfaces:
+				if int.identifier not in identifiers and int.identifier not in declared:
+					identifiers.append(int.identifier)
+					print >>out
+					int.printTypeCode(out)
+	for module in modules:
+		code = StringIO()
+		module.unity = True
+		module.writeOut(code)
+		code = code.getvalue()
+
+		local_names = [name for name in module.fileScopeSymbols() if name in renamed]
+		for name in local_names:
+			if re.search(MemberUseEx % name, code):
+				raise UnityException(module.source_file,
+					name + ' is declared by several modules, and renaming it would also rename the member ' + name + ', so it needs a name of its own')
+
+		print >>out
+		print >>out, '/* module ' + module.name + ' */'
+		for include in private[module.name]:
+			print >>out, '#include', include
+		for name in local_names:
+			print >>out, '#define', name, 'ace_' + module.name + '_' + name
+		out.write(code)
+		for name in local_names:
+			print >>out, '#undef', name
+		for key in module.defines:
+			print >>out, '#undef', key.split('(')[0]
+	return out.getvalue()
+
+class UnityException(Exception):
+	def __init__(self, filename, value):
+		self.filename = filename
+		self.value = value
+	def message(self):
+		return self.filename + ': error: ' + self.value
+	def __str__(self):
+		return repr(self.message())
 
-my_module.source_file = in_file
+def parseFiles(in_files, options):
+	# parses every input, reporting errors on stderr. returns the modules that
+	# were parsed and an exit status.
+	modules = []
+	status = 0
+	for in_file in in_files:
+		try:
+			handle = open(in_file, 'rb')
+			try:
+				source = handle.read()
+			finally:
+				handle.close()
+		except IOError, e:
+			(errno, message) = e
+			sys.stderr.write('%s: error: unable to read file: %s\n' % (in_file, message))
+			status |= 32
+			continue
+		try:
+			modules.append(parseModule(source, in_file, options))
+		except ProcessingException, e:
+			sys.stderr.write(e.message())
+			sys.stderr.write('\n')
+			status |= 1
+	return modules, status
+
+def translateUnity(in_files, out_file, options):
+	# --unity: every input goes into the single output file
+	modules, status = parseFiles(in_files, options)
+	if status:
+		return status
+
+	try:
+		text = unityText(modules, out_file, getattr(options, 'header', False), options)
+	except UnityException, e:
+		sys.stderr.write(e.message() + '\n')
+		return 1
+	if not out_file:
+		sys.stdout.write(text)
+		return 0
+
+	outputs = [(out_file, text)]
+	if getattr(options, 'make_deps', False):
+		imports = []
+		for module in modules:
+			imports.extend([path for path in module.imports if path not in imports])
+		outputs.append((out_file + '.d', out_file + ': ' + ' '.join(in_files + imports) + '\n'))
+	for path, text in outputs:
+		try:
+			if writeIfChanged(path, text) and getattr(options, 'verbose', False):
+				sys.stderr.write('wrote %s\n' % path)
+		except IOError, e:
+			(errno, message) = e
+			sys.stderr.write('%s: error: unable to write file: %s\n' % (path, message))
+			return 16
+	return 0
+
+# interfaces that are always there when ACE modules load: logman and the ones
+# ACE requires automatically are implemented by the asss core. more can be
+# given with --provided.
+CoreInterfaces = ['I_LOGMAN'] + [identifier for type, identifier in ACEModule.autoInterfaces.values()]
+
+def dependencyKey(dep):
+	# a named implementation is looked up by its name, anything else by the
+	# identifier of its interface
+	return dep.name or dep.identifier
+
+def moduleGraph(modules, provided=()):
+	# the load time dependencies between modules: a module that requires a
+	# global interface in MM_LOAD needs a module implementing it globally to
+	# be loaded first. a $#use of one is only a preference.
+	# returns (edges, problems): edges are (user, provider, key, hard) with
+	# indexes into modules, problems are (module, dep, message) for
+	# requirements no other module implements (in time.)
+	global_providers = {}
+	arena_providers = {}
+	for number, module in enumerate(modules):
+		for int in module.my_global_interfaces:
+			for key in (int.identifier, int.name):
+				global_providers.setdefault(key, []).append(number)
+		for int in module.my_arena_interfaces:
+			for key in (int.identifier, int.name):
+				arena_providers.setdefault(key, []).append(number)
+
+	edges = []
+	problems = []
+	for number, module in enumerate(modules):
+		requirements = [(dep, True, True) for dep in module.global_dependencies.itervalues()]
+		requirements += [(dep, False, True) for dep in module.optional_global_dependencies.itervalues()]
+		requirements += [(dep, True, False) for dep in module.arena_dependencies.itervalues()]
+		for dep, hard, at_load in requirements:
+			key = dependencyKey(dep)
+			providers = [provider for provider in global_providers.get(key, [])
+				if provider != number]
+			if at_load:
+				for provider in providers:
+					edges.append((number, provider, key, hard))
+			elif not providers:
+				providers = [provider for provider in arena_providers.get(key, [])
+					if provider != number]
+			if providers or not hard or key in provided:
+				continue
+			if number in global_providers.get(key, []) \
+				or (not at_load and number in arena_providers.get(key, [])):
+				# the module implements what it requires itself
+				continue
+			if at_load and key in arena_providers:
+				problems.append((module, dep, 'which is only implemented per arena (by ' +
+					', '.join([modules[provider].name for provider in arena_providers[key]]) +
+					') and is not there when it loads'))
+			else:
+				problems.append((module, dep, 'which no input module implements'))
+	return edges, problems
+
+def stronglyConnected(count, successors):
+	# tarjan's algorithm, without recursion. returns the components of the
+	# graph with nodes 0..count-1 in reverse topological order.
+	index = {}
+	lowlink = {}
+	stack = []
+	on_stack = set()
+	components = []
+	for root in range(count):
+		if root in index:
+			continue
+		work = [(root, 0)]
+		while work:
+			node, position = work.pop()
+			if position == 0:
+				index[node] = lowlink[node] = len(index)
+				stack.append(node)
+				on_stack.add(node)
+			recurse = False
+			for position in range(position, len(successors[node])):
+				successor = successors[node][position]
+				if successor not in index:
+					work.append((node, position + 1))
+					work.append((successor, 0))
+					recurse = True
+					break
+				elif successor in on_stack:
+					lowlink[node] = min(lowlink[node], index[successor])
+			if recurse:
+				continue
+			if lowlink[node] == index[node]:
+				component = []
+				while True:
+					member = stack.pop()
+					on_stack.discard(member)
+					component.append(member)
+					if member == node:
+						break
+				components.append(sorted(component))
+			if work:
+				parent = work[-1][0]
+				lowlink[parent] = min(lowlink[parent], lowlink[node])
+	return components
+
+def loadOrder(count, edges):
+	# orders the modules so every provider comes before the modules that need
+	# it, and so do the ones they prefer to have, unless that is impossible.
+	# otherwise the input order is kept. a cycle of hard dependencies can't
+	# be ordered; its modules are kept together, in input order, after what
+	# any of them needs from outside the cycle.
+	successors = [[] for number in range(count)]
+	for user, provider, key, is_hard in edges:
+		if is_hard:
+			successors[user].append(provider)
+	# each module is ordered as part of a unit, named by its first module
+	unit = range(count)
+	for component in stronglyConnected(count, successors):
+		for number in component:
+			unit[number] = min(component)
+	hard = [set() for number in range(count)]
+	soft = [set() for number in range(count)]
+	for user, provider, key, is_hard in edges:
+		if unit[user] <> unit[provider]:
+			(is_hard and hard or soft)[unit[user]].add(unit[provider])
+	units = sorted(set(unit))
+	order = []
+	done = set()
+	while len(done) < len(units):
+		remaining = [number for number in units if number not in done]
+		ready = [number for number in remaining
+			if not (hard[number] | soft[number]) - done] \
+			or [number for number in remaining if not hard[number] - done]
+		order.extend([number for number in range(count) if unit[number] == ready[0]])
+		done.add(ready[0])
+	return order
+
+def moduleLibrary(filename):
+	# asss builds the modules in src/LIB/ into LIB.so, loaded as LIB:module
+	return os.path.basename(os.path.dirname(os.path.abspath(filename)))
+
+def graphDot(modules, edges):
+	text = 'digraph modules {\n'
+	for module in modules:
+		text += '\t"%s";\n' % module.name
+	for user, provider, key, hard in edges:
+		text += '\t"%s" -> "%s" [label="%s"%s];\n' % (modules[user].name,
+			modules[provider].name, key, not hard and ', style=dashed' or '')
+	return text + '}\n'
+
+def runGraph(in_files, out_file, options):
+	# --graph: checks the dependencies between the input modules and writes
+	# the order to load them in, as modules.conf lines
+	modules, status = parseFiles(in_files, options)
+	if status:
+		return status
+
+	names = {}
+	for module in modules:
+		if module.name in names:
+			sys.stderr.write('%s: error: module %s is also in %s\n' % (module.source_file,
+				module.name, names[module.name]))
+			return 1
+		names[module.name] = module.source_file
+
+	provided = set(CoreInterfaces + (getattr(options, 'provided', None) or []))
+	edges, problems = moduleGraph(modules, provided)
+	for module, dep, message in problems:
+		where = module.source_file
+		if dep.line_number:
+			where += ':' + str(dep.line_number)
+		sys.stderr.write('%s: warning: %s requires %s, %s\n' % (where, module.name,
+			dependencyKey(dep), message))
+
+	successors = [[] for module in modules]
+	for user, provider, key, hard in edges:
+		if hard and provider not in successors[user]:
+			successors[user].append(provider)
+	for component in stronglyConnected(len(modules), successors):
+		if len(component) < 2:
+			continue
+		status = 1
+		cycle = [(modules[user].name, key, modules[provider].name)
+			for user, provider, key, hard in edges
+			if hard and user in component and provider in component]
+		sys.stderr.write('error: modules require each other when they load: %s\n' %
+			', '.join(['%s needs %s from %s' % need for need in cycle]))
+
+	text = '; load order of the ACE modules, written by ace.py --graph\n'
+	for number in loadOrder(len(modules), edges):
+		module = modules[number]
+		text += moduleLibrary(module.source_file) + ':' + module.name + '\n'
+
+	outputs = [(out_file, text)]
+	if getattr(options, 'graph_dot', None):
+		outputs.append((options.graph_dot, graphDot(modules, edges)))
+	for path, text in outputs:
+		if not path:
+			sys.stdout.write(text)
+			continue
+		try:
+			writeIfChanged(path, text)
+		except IOError, e:
+			(errno, message) = e
+			sys.stderr.write('%s: error: unable to write file: %s\n' % (path, message))
+			return 16
+	return status
+
+# the symbols ACEStructure.printProbeCode() declares, named for the module
+ProbeSymbolEx = re.compile(r'^_?ace_probe_(\w+)_(player|arena)(_alloc)?$')
+# what asss uses when General:PerPlayerBytes and PerArenaBytes aren't set
+BudgetLimits = OrderedDict([('player', ('PerPlayerBytes', 4000)),
+	('arena', ('PerArenaBytes', 10000))])
+
+def readProbes(paths, nm='nm'):
+	# returns the sizes in the objects at paths, as {module: {kind: bytes}},
+	# where kind is player or arena, or player_alloc or arena_alloc for the
+	# struct allocated for dynamic data. a module is only counted once, even
+	# if several objects have it. raises OSError if nm can't be run and
+	# IOError if it fails.
+	command = subprocess.Popen([nm, '-S'] + list(paths), stdout=subprocess.PIPE,
+		stderr=subprocess.PIPE)
+	output, errors = command.communicate()
+	if command.returncode:
+		raise IOError(errors.strip() or nm + ' failed')
+	probes = OrderedDict()
+	for line in output.splitlines():
+		fields = line.split()
+		if len(fields) != 4:
+			continue
+		probe = ProbeSymbolEx.match(fields[3])
+		if not probe:
+			continue
+		kind = probe.group(2) + (probe.group(3) or '')
+		sizes = probes.setdefault(probe.group(1), {})
+		sizes.setdefault(kind, int(fields[1], 16))
+	return probes
+
+def readGlobalLimits(path):
+	# the limits in the [General] section of an asss global.conf, where set
+	limits = {}
+	section = None
+	handle = open(path, 'rU')
+	try:
+		for line in handle:
+			line = line.split(';')[0].strip()
+			if line[0:1] == '[' and line[-1:] == ']':
+				section = line[1:-1].strip().lower()
+			elif section == 'general' and '=' in line:
+				key, value = [part.strip() for part in line.split('=', 1)]
+				if value.isdigit():
+					limits[key.lower()] = int(value)
+	finally:
+		handle.close()
+	return limits
+
+def budgetReport(probes, limits):
+	# returns the report for --budget, and the errors (with suggestions) for
+	# each limit that is exceeded. limits is {setting: bytes} for the
+	# settings in BudgetLimits.
+	text = ''
+	errors = ''
+	for kind, (setting, default) in BudgetLimits.iteritems():
+		limit = limits.get(setting.lower(), default)
+		rows = [(module, sizes) for module, sizes in probes.iteritems() if kind in sizes]
+		rows.sort(key=lambda row: -row[1][kind])
+		total = sum([sizes[kind] for module, sizes in rows])
+		text += '%s data, General:%s %d\n' % (kind, setting, limit)
+		for module, sizes in rows:
+			text += '  %-24s %7d' % (module, sizes[kind])
+			if kind + '_alloc' in sizes:
+				text += '  dynamic, %d allocated' % sizes[kind + '_alloc']
+			text += '\n'
+		text += '  %-24s %7d  of %d\n' % ('total', total, limit)
+		if total <= limit:
+			continue
+
+		errors += 'error: the %s data of the ACE modules needs %d bytes, more than General:%s (%d)\n' \
+			% (kind, total, setting, limit)
+		# static data would only need a pointer in asss's data if it was
+		# dynamic. the largest go first, until the rest fit.
+		for module, sizes in rows:
+			if total <= limit:
+				break
+			if kind + '_alloc' in sizes or sizes[kind] <= ACEStructure.PointerSize:
+				continue
+			saved = sizes[kind] - ACEStructure.PointerSize
+			total -= saved
+			errors += '  make the %s data of %s dynamic ($#%sdata dynamic) to save about %d bytes\n' \
+				% (kind, module, kind, saved)
+		if total > limit:
+			errors += '  that is still %d bytes over, General:%s has to be raised\n' % (total - limit, setting)
+	return text, errors
+
+def runBudget(in_files, out_file, options):
+	# --budget: reports the player and arena data of every module in the
+	# input objects against the limits asss puts on it
+	limits = {}
+	if getattr(options, 'global_conf', None):
+		try:
+			limits = readGlobalLimits(options.global_conf)
+		except IOError, e:
+			(errno, message) = e
+			sys.stderr.write('%s: error: unable to read file: %s\n' % (options.global_conf, message))
+			return 32
+	nm = getattr(options, 'nm', None) or 'nm'
+	try:
+		probes = readProbes(in_files, nm)
+	except OSError, e:
+		sys.stderr.write('error: unable to run %s: %s\n' % (nm, e.strerror))
+		return 32
+	except IOError, e:
+		sys.stderr.write('error: %s\n' % e)
+		return 32
+	if not probes:
+		sys.stderr.write('warning: no player or arena data found, are the objects built with --size-probes?\n')
+
+	text, errors = budgetReport(probes, limits)
+	sys.stderr.write(errors)
+	if not out_file:
+		sys.stdout.write(text)
+	else:
+		try:
+			writeIfChanged(out_file, text)
+		except IOError, e:
+			(errno, message) = e
+			sys.stderr.write('%s: error: unable to write file: %s\n' % (out_file, message))
+			return 16
+	if errors:
+		return 1
+	return 0
+
+def readMessage(stream):
+	# reads a JSON-RPC message with its Content-Length header, as the language
+	# server protocol sends them. returns None at the end of the input.
+	length = None
+	while True:
+		line = stream.readline()
+		if not line:
+			return None
+		line = line.strip()
+		if not line:
+			if length is not None:
+				break
+			continue
+		name, sep, value = line.partition(':')
+		if name.lower() == 'content-length':
+			length = int(value)
+	return json.loads(stream.read(length))
+
+def writeMessage(stream, message):
+	body = json.dumps(message)
+	stream.write('Content-Length: %d\r\n\r\n%s' % (len(body), body))
+	stream.flush()
+
+def applyChange(text, change):
+	# a change from textDocument/didChange, either the whole text or a range
+	# of it replaced. characters are counted in UTF-16 code units, as the
+	# protocol has them by default.
+	if 'range' not in change:
+		return change['text']
+	lines = text.splitlines(True)
+	def offset(position):
+		line = position['line']
+		units = (line < len(lines) and lines[line] or u'').encode('utf-16-le')
+		# as many characters of this python's own as the code units cover
+		prefix = units[:2 * position['character']].decode('utf-16-le', 'ignore')
+		return sum([len(before) for before in lines[:line]]) + len(prefix)
+	start = offset(change['range']['start'])
+	end = offset(change['range']['end'])
+	return text[:start] + change['text'] + text[end:]
+
+def uriFilename(uri):
+	if uri.startswith('file://'):
+		return urllib.url2pathname(urlparse.urlparse(uri).path)
+	return uri
+
+def documentDiagnostics(text, filename, options):
+	# the diagnostics for the text of a module: parsing stops at the first
+	# error, so there is one at most. the whole line is marked.
+	# a bug in ACE is reported on the line being parsed too, rather than
+	# taking the server down with it.
+	module = ACEModule()
+	processor = Processor(filename, module, text.encode('utf-8'))
+	try:
+		setupProcessor(processor, module, filename, makeOptions(options))
+		processor.process()
+	except ProcessingException, e:
+		line = e.lineNumber() - 1
+		message = e.value
+		where = e.filename or e.processor.filename
+		if os.path.normpath(where) != os.path.normpath(filename):
+			# in an imported fragment
+			message = '%s:%d: %s' % (where, line + 1, message)
+			line = 0
+	except Exception, e:
+		line = max(processor.current_line - 1, 0)
+		message = 'internal error: %s: %s' % (e.__class__.__name__, e)
+	else:
+		return []
+	return [{'range': {'start': {'line': line, 'character': 0},
+			'end': {'line': line + 1, 'character': 0}},
+		'severity': 1,
+		'source': 'ace',
+		'message': message}]
+
+def runLanguageServer(options, input=None, output=None):
+	# --lsp: a language server on stdin and stdout. every open .aces file is
+	# parsed again when it changes, and the error (if any) is published as a
+	# diagnostic. nothing is generated. the diagnostics of the last few texts
+	# of each file are kept, so undoing an edit doesn't parse again.
+	input = input or sys.stdin
+	output = output or sys.stdout
+	documents = {}
+	shutdown = False
+	while True:
+		message = readMessage(input)
+		if message is None:
+			break
+		method = message.get('method')
+		params = message.get('params') or {}
+		if not method:
+			# a response, the server sends no requests
+			continue
+		result = None
+		if method == 'initialize':
+			result = {'capabilities': {'textDocumentSync': {'openClose': True, 'change': 2}},
+				'serverInfo': {'name': 'ace', 'version': ACE_VERSION}}
+		elif method == 'shutdown':
+			shutdown = True
+		elif method == 'exit':
+			break
+		elif method in ('textDocument/didOpen', 'textDocument/didChange'):
+			uri = params['textDocument']['uri']
+			if method == 'textDocument/didOpen':
+				document = documents[uri] = {'text': params['textDocument']['text'],
+					'checked': OrderedDict(), 'published': None}
+			else:
+				document = documents.get(uri)
+				if document is None:
+					continue
+				for change in params['contentChanges']:
+					document['text'] = applyChange(document['text'], change)
+			key = hashlib.sha1(document['text'].encode('utf-8')).digest()
+			diagnostics = document['checked'].pop(key, None)
+			if diagnostics is None:
+				diagnostics = documentDiagnostics(document['text'], uriFilename(uri), options)
+			document['checked'][key] = diagnostics
+			while len(document['checked']) > 8:
+				document['checked'].popitem(False)
+			if diagnostics != document['published']:
+				document['published'] = diagnostics
+				writeMessage(output, {'jsonrpc': '2.0',
+					'method': 'textDocument/publishDiagnostics',
+					'params': {'uri': uri, 'diagnostics': diagnostics}})
+		elif method == 'textDocument/didClose':
+			uri = params['textDocument']['uri']
+			if documents.pop(uri, None) is not None:
+				writeMessage(output, {'jsonrpc': '2.0',
+					'method': 'textDocument/publishDiagnostics',
+					'params': {'uri': uri, 'diagnostics': []}})
+		elif 'id' in message:
+			writeMessage(output, {'jsonrpc': '2.0', 'id': message['id'],
+				'error': {'code': -32601, 'message': 'unsupported method ' + method}})
+			continue
+		if 'id' in message:
+			writeMessage(output, {'jsonrpc': '2.0', 'id': message['id'], 'result': result})
+	# exiting without a shutdown request first is an error
+	if shutdown:
+		return 0
+	return 1
+
+class ErrorStream:
+	# sys.stderr while jobs are translated: what a thread capturing its errors
+	# writes goes to its own buffer, everything else to the real stderr. it
+	# is installed once, so capturing doesn't swap sys.stderr under the other
+	# threads of --watch and --socket.
+	def __init__(self, stream):
+		self.stream = stream
+		self.local = threading.local()
+
+	def target(self):
+		return getattr(self.local, 'buffer', None) or self.stream
+
+	def write(self, text):
+		self.target().write(text)
+
+	def __getattr__(self, name):
+		return getattr(self.stream, name)
+
+def installErrorStream():
+	if not isinstance(sys.stderr, ErrorStream):
+		sys.stderr = ErrorStream(sys.stderr)
+	return sys.stderr
+
+def translateJob(job):
+	# worker side of -j: stderr is captured so the parent can report errors in
+	# input order, no matter which worker finishes first.
+	# the statistics of the job are returned too, or None without --stats.
+	in_file, out_file, options = job
+	stats = None
+	if wantStats(options):
+		stats = newStats(in_file)
+	errors = installErrorStream()
+	errors.local.buffer = StringIO()
+	try:
+		status = translateFile(in_file, out_file, options, stats)
+		return status, errors.local.buffer.getvalue(), stats
+	finally:
+		errors.local.buffer = None
+
+def wantStats(options):
+	return getattr(options, 'stats', False) or getattr(options, 'stats_json', None)
+
+def reportStats(stats_list, options):
+	if getattr(options, 'stats', False):
+		sys.stderr.write(formatStats(stats_list))
+	if getattr(options, 'stats_json', None):
+		try:
+			handle = open(options.stats_json, 'w')
+			try:
+				json.dump(stats_list, handle, indent=1, sort_keys=True,
+					separators=(',', ': '))
+				handle.write('\n')
+			finally:
+				handle.close()
+		except IOError, e:
+			(errno, message) = e
+			sys.stderr.write('%s: error: unable to write file: %s\n' % (options.stats_json, message))
+			return 16
+	return 0
+
+def translateAll(jobs, options):
+	status = 0
+	stats_list = []
+	if options.jobs == 1 or len(jobs) < 2:
+		for in_file, out_file in jobs:
+			stats = None
+			if wantStats(options):
+				stats = newStats(in_file)
+				stats_list.append(stats)
+			status |= translateFile(in_file, out_file, options, stats)
+	else:
+		pool = multiprocessing.Pool(min(options.jobs, len(jobs)))
+		try:
+			for job_status, errors, stats in pool.imap(translateJob,
+				[(in_file, out_file, options) for in_file, out_file in jobs]):
+				sys.stderr.write(errors)
+				status |= job_status
+				if stats is not None:
+					stats_list.append(stats)
+		finally:
+			pool.close()
+			pool.join()
+
+	if wantStats(options):
+		status |= reportStats(stats_list, options)
+	return status
+
+def scanSources(watch_dir):
+	sources = {}
+	for dirpath, dirnames, filenames in os.walk(watch_dir):
+		for filename in filenames:
+			if filename.endswith('.aces'):
+				path = os.path.join(dirpath, filename)
+				try:
+					info = os.stat(path)
+				except OSError:
+					continue
+				sources[path] = (info.st_mtime, info.st_size)
+	return sources
+
+def watchSources(watch_dir, options, lock, relative_to=None):
+	# regenerates every .aces file under watch_dir whenever it changes. the
+	# mtimes are the truth; inotify (through pyinotify, if it is installed) is
+	# only used to wake up as soon as something happens instead of polling.
+	# with relative_to, the files are translated by their path relative to
+	# it, as they would be if watch_dir had been given that way.
+	notifier = None
+	if pyinotify:
+		manager = pyinotify.WatchManager()
+		notifier = pyinotify.Notifier(manager, pyinotify.ProcessEvent(),
+			timeout=int(options.poll_interval * 1000))
+		manager.add_watch(watch_dir, pyinotify.IN_CLOSE_WRITE
+			| pyinotify.IN_MOVED_TO | pyinotify.IN_CREATE, rec=True,
+			auto_add=True)
+
+	known = {}
+	while True:
+		# the socket handler changes the working directory under the lock
+		lock.acquire()
+		try:
+			sources = scanSources(watch_dir)
+			changed = [path for path in sorted(sources)
+				if known.get(path) != sources[path]]
+			known = sources
+			for in_file in changed:
+				if relative_to:
+					in_file = os.path.relpath(in_file, relative_to)
+				if options.output_dir:
+					out_file = outputPathFor(in_file, options.output_dir)
+				else:
+					out_file = os.path.splitext(in_file)[0] + '.acec'
+				translateFile(in_file, out_file, options)
+		finally:
+			lock.release()
+
+		if notifier:
+			if notifier.check_events():
+				notifier.read_events()
+				notifier.process_events()
+		else:
+			time.sleep(options.poll_interval)
+
+class DaemonRequestHandler(SocketServer.StreamRequestHandler):
+	# one request per connection, a single tab separated line:
+	#   translate<TAB>working directory<TAB>input file<TAB>output file
+	# the reply is any error output, followed by a final "status N" line with
+	# the exit status ace.py would have had. e.g. from a shell:
+	#   printf 'translate\t%s\t%s\t%s\n' "$PWD" in.aces out.acec \
+	#     | socat - UNIX-CONNECT:ace.sock
+	def handle(self):
+		request = self.rfile.readline().rstrip('\r\n').split('\t')
+		if len(request) != 4 or request[0] != 'translate':
+			self.wfile.write('error: bad request\nstatus 64\n')
+			return
 
-if options.use_line_directives:
-	my_processor.use_line_directives = True
-	my_module.use_line_directives = True
-	
-try:
-	my_processor.process()
-	if options.output_file:
+		command, cwd, in_file, out_file = request
+		server = self.server
+		server.lock.acquire()
+		saved_cwd = os.getcwd()
 		try:
-			sys.stdout = open(options.output_file, 'w')
+			try:
+				os.chdir(cwd)
+			except OSError, e:
+				self.wfile.write('error: %s: %s\nstatus 64\n' % (cwd, e.strerror))
+				return
+			status, errors, stats = translateJob((in_file, out_file, server.options))
+		finally:
+			os.chdir(saved_cwd)
+			server.lock.release()
+		self.wfile.write(errors + 'status %d\n' % status)
+
+def startDaemon(socket_path, options, lock):
+	if os.path.exists(socket_path):
+		os.remove(socket_path)
+	server = SocketServer.UnixStreamServer(socket_path, DaemonRequestHandler)
+	server.options = options
+	server.lock = lock
+	thread = threading.Thread(target=server.serve_forever)
+	thread.daemon = True
+	thread.start()
+	return server
+
+def runResident(options):
+	# --watch and/or --socket: stay running until interrupted. the socket
+	# handler changes the working directory while it translates, so paths
+	# are made absolute before it starts.
+	lock = threading.Lock()
+	server = None
+	installErrorStream()
+	cwd = os.getcwd()
+	if options.socket:
+		options.socket = os.path.abspath(options.socket)
+	try:
+		if options.socket:
+			server = startDaemon(options.socket, options, lock)
+		if options.watch_dir:
+			relative_to = None
+			if not os.path.isabs(options.watch_dir):
+				relative_to = cwd
+			watchSources(os.path.join(cwd, options.watch_dir), options, lock, relative_to)
+		else:
+			while True:
+				time.sleep(3600)
+	except KeyboardInterrupt:
+		pass
+	finally:
+		if server:
+			server.shutdown()
+			os.remove(options.socket)
+	return 0
+
+
+def makeOptionParser():
+	usage = 'Usage: ace.py [options] input_file\n' \
+		+ '       ace.py [options] -d output_dir input_file...\n' \
+		+ '       ace.py [options] input_file:output_file...\n' \
+		+ '       ace.py [options] [-d output_dir] --watch dir [--socket path]'
+	parser = OptionParser(usage=usage)
+
+	parser.add_option("-o", "--output",
+		dest="output_file",
+		help="output to the specified file")
+	parser.add_option("-d", "--output-dir",
+		dest="output_dir",
+		help="batch mode: write each input file to output_dir/name.acec")
+	parser.add_option("-j", "--jobs",
+		dest="jobs",
+		type="int",
+		default=1,
+		help="translate up to JOBS files at once in worker processes (0: one per CPU)")
+	parser.add_option("-l", "--line-directives",
+		dest="use_line_directives",
+		action="store_true",
+		help="put #line directives in the output to associate output lines with input lines")
+	parser.add_option("--compact-lines",
+		dest="compact_lines",
+		action="store_true",
+		help="with -l, only put #line directives where the numbering of the output is not already right")
+	parser.add_option("--line-map",
+		dest="line_map",
+		action="store_true",
+		help="leave #line directives out of the output and write where each output line comes from to OUTPUT.linemap instead. implies -l")
+	parser.add_option("--line-relative-to",
+		dest="line_relative_to",
+		help="write file names in #line directives relative to the directory LINE_RELATIVE_TO")
+	parser.add_option("--line-prefix-map",
+		dest="line_prefix_map",
+		action="append",
+		metavar="OLD=NEW",
+		help="replace the prefix OLD of file names in #line directives with NEW. may be given more than once, the last matching OLD is used")
+	parser.add_option("-M", "--make-deps",
+		dest="make_deps",
+		action="store_true",
+		help="also write make dependency rules for each output file to OUTPUT.d")
+	parser.add_option("--header",
+		dest="header",
+		action="store_true",
+		help="also write a public header with the module's interfaces and entry point next to each output file, named after the input (NAME.ace.h). it is only rewritten when those change")
+	parser.add_option("--prologue",
+		dest="prologue",
+		help="start each output with #include \"PROLOGUE\" instead of asss.h and stdio.h. see --write-prologue")
+	parser.add_option("--write-prologue",
+		dest="write_prologue",
+		metavar="FILE",
+		help="write the header for --prologue to FILE, which can be precompiled for every module")
+	parser.add_option("--unity",
+		dest="unity",
+		action="store_true",
+		help="translate every input file into the single output file (or stdout), as one translation unit. with --header, the types of the interfaces the modules implement are put in it too")
+	parser.add_option("--packed-layout",
+		dest="packed_layout",
+		action="store_true",
+		help="order the fields of player and arena data to leave as little padding as possible, keeping fields marked with the same group together")
+	parser.add_option("--size-probes",
+		dest="size_probes",
+		action="store_true",
+		help="put the size of each module's player and arena data in its object, for --budget")
+	parser.add_option("--budget",
+		dest="budget",
+		action="store_true",
+		help="add up the player and arena data of the modules in the input objects (built with --size-probes), and check it against General:PerPlayerBytes and PerArenaBytes")
+	parser.add_option("--global-conf",
+		dest="global_conf",
+		help="with --budget, read the limits from the [General] section of GLOBAL_CONF instead of using the asss defaults")
+	parser.add_option("--nm",
+		dest="nm",
+		default="nm",
+		help="the nm used by --budget (default nm)")
+	parser.add_option("--asss-include",
+		dest="asss_include",
+		action="append",
+		metavar="DIR",
+		help="index the interfaces, advisers and callbacks declared in the headers in DIR (may be given more than once), to check the module against and to find interfaces used without $#require. with --cache-dir, the index is kept there")
+	parser.add_option("--check",
+		dest="check",
+		action="store_true",
+		help="only parse and check the input files, reporting errors as usual, without generating any code")
+	parser.add_option("--lsp",
+		dest="lsp",
+		action="store_true",
+		help="run a language server on stdin and stdout that reports the errors in open .aces files as they are edited")
+	parser.add_option("--graph",
+		dest="graph",
+		action="store_true",
+		help="instead of translating, check which modules need which others loaded first (reporting cycles and requirements no input implements) and write the order to load them in as modules.conf lines")
+	parser.add_option("--provided",
+		dest="provided",
+		action="append",
+		metavar="IDENTIFIER",
+		help="with --graph, an interface identifier (or implementation name) that is implemented outside of the input modules. may be given more than once. the interfaces ACE requires automatically are always assumed to be there")
+	parser.add_option("--graph-dot",
+		dest="graph_dot",
+		metavar="FILE",
+		help="with --graph, also write the dependencies to FILE for graphviz")
+	parser.add_option("--cache-dir",
+		dest="cache_dir",
+		help="reuse generated code for unchanged inputs, cached in CACHE_DIR")
+	parser.add_option("--emit-ir",
+		dest="emit_ir",
+		help="also save the parsed module to EMIT_IR, to be used with --from-ir")
+	parser.add_option("--from-ir",
+		dest="from_ir",
+		help="generate code from the parsed module saved in FROM_IR instead of parsing. if an input file is given, the IR is only used if it was made from that exact file")
+	parser.add_option("-v", "--verbose",
+		dest="verbose",
+		action="store_true",
+		help="report every output file that is written")
+	parser.add_option("--stats",
+		dest="stats",
+		action="store_true",
+		help="report the time spent in each phase and counts of what was generated for each input on stderr")
+	parser.add_option("--stats-json",
+		dest="stats_json",
+		help="write the --stats figures as JSON to STATS_JSON")
+	parser.add_option("--profile",
+		dest="profile",
+		help="run under cProfile and save the profile to PROFILE, for use with pstats. with -j, only the main process is profiled")
+	parser.add_option("--watch",
+		dest="watch_dir",
+		help="stay running and regenerate .aces files under WATCH_DIR when they change")
+	parser.add_option("--poll-interval",
+		dest="poll_interval",
+		type="float",
+		default=1.0,
+		help="seconds between checks for changes in --watch mode (default 1)")
+	parser.add_option("--socket",
+		dest="socket",
+		help="stay running and serve translation requests on the unix socket SOCKET")
+	return parser
+
+def main(argv=None):
+	parser = makeOptionParser()
+	(options, in_files) = parser.parse_args(argv)
+	if options.line_map:
+		options.use_line_directives = True
+	for include_dir in options.asss_include or []:
+		if not os.path.isdir(include_dir):
+			sys.stderr.write('error: --asss-include: %s is not a directory\n' % include_dir)
+			return 64
+
+	if options.lsp:
+		if in_files:
+			sys.stderr.write('error: input files can not be combined with --lsp\n')
+			return 64
+		return runLanguageServer(options)
+
+	if options.watch_dir or options.socket:
+		if in_files:
+			sys.stderr.write('error: input files can not be combined with --watch or --socket\n')
+			return 64
+		if options.watch_dir:
+			options.verbose = True
+		return runResident(options)
+
+	if options.write_prologue:
+		prologue = StringIO()
+		writePrologue(prologue)
+		try:
+			if writeIfChanged(options.write_prologue, prologue.getvalue()) and options.verbose:
+				sys.stderr.write('wrote %s\n' % options.write_prologue)
 		except IOError, e:
 			(errno, message) = e
-			sys.stderr.write('%s: error: unable to write file: %s\n' % (options.output_file, message))
-			sys.exit(16)
-	my_module.writeOut()
-	sys.exit(0)
+			sys.stderr.write('%s: error: unable to write file: %s\n' % (options.write_prologue, message))
+			return 16
+		if not in_files:
+			return 0
+
+	if (options.emit_ir or options.from_ir) and len(in_files) > 1:
+		sys.stderr.write('error: --emit-ir and --from-ir may only be used with a single input file\n')
+		return 64
+	elif options.from_ir and len(in_files) == 0:
+		return translateFile(None, options.output_file, options)
+
+	if len(in_files) == 0:
+		sys.stderr.write('error: no input file\n')
+		return 64
+	elif options.check:
+		return parseFiles(in_files, options)[1]
+	elif options.budget:
+		if options.output_dir or [spec for spec in in_files if splitJobSpec(spec)[1]]:
+			sys.stderr.write('error: --budget writes a single output file, given with --output\n')
+			return 64
+		return runBudget(in_files, options.output_file, options)
+	elif options.graph:
+		if options.output_dir or [spec for spec in in_files if splitJobSpec(spec)[1]]:
+			sys.stderr.write('error: --graph writes a single output file, given with --output\n')
+			return 64
+		return runGraph(in_files, options.output_file, options)
+	elif options.unity:
+		if options.output_dir or options.line_map \
+			or [spec for spec in in_files if splitJobSpec(spec)[1]]:
+			sys.stderr.write('error: --unity writes a single output file, given with --output\n')
+			return 64
+		return translateUnity(in_files, options.output_file, options)
+	elif options.output_file and len(in_files) > 1:
+		sys.stderr.write('error: --output may only be used with a single input file\n')
+		return 64
+
+	for mapping in options.line_prefix_map or []:
+		if '=' not in mapping:
+			sys.stderr.write('error: --line-prefix-map expects OLD=NEW\n')
+			return 64
+
+	if options.jobs < 0:
+		sys.stderr.write('error: --jobs must not be negative\n')
+		return 64
+	elif options.jobs == 0:
+		options.jobs = multiprocessing.cpu_count()
+
+	jobs = []
+	for spec in in_files:
+		in_file, out_file = splitJobSpec(spec)
+		if not out_file:
+			if options.output_dir:
+				out_file = outputPathFor(in_file, options.output_dir)
+			elif len(in_files) > 1:
+				sys.stderr.write('error: more than one input file specified without --output-dir or input:output pairs\n')
+				return 64
+			else:
+				out_file = options.output_file
+		if options.make_deps and not out_file:
+			sys.stderr.write('error: --make-deps needs an output file\n')
+			return 64
+		if options.line_map and not out_file:
+			sys.stderr.write('error: --line-map needs an output file\n')
+			return 64
+		if options.header and not out_file:
+			sys.stderr.write('error: --header needs an output file\n')
+			return 64
+		jobs.append((in_file, out_file))
+
+	if options.profile:
+		import cProfile
+		profile = cProfile.Profile()
+		try:
+			return profile.runcall(translateAll, jobs, options)
+		finally:
+			profile.dump_stats(options.profile)
+	return translateAll(jobs, options)
 
-except ProcessingException, e:
-	sys.stderr.write(e.message())
-	sys.stderr.write('\n')
-	sys.exit(1)
 
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,360 @@
+#!/usr/bin/env python
+
+# acebench - measures the speed of ACE on a synthetic corpus of modules
+# Copyright (C) 2010-2011 Justin M. Schwartz ("Arnk Kilo Dylie")
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/gpl-2.0.html>.
+
+# the corpus depends only on the seed and the sizes given, never on ace.py,
+# so results saved with --json on one commit can be given to --compare on
+# another to see whether the translator got slower.
+
+import sys, os, time, random, hashlib, json, resource
+from cStringIO import StringIO
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import ace
+
+BENCH_FORMAT = 1
+
+FieldTypes = ['int', 'short', 'char', 'long', 'double', 'unsigned int', 'ticks_t', 'Player *']
+Callbacks = [('CB_PLAYERACTION', 'Player *p, int action, Arena *arena'),
+	('CB_KILL', 'Arena *arena, Player *killer, Player *killed, int bounty, int flags, int *pts, int *green'),
+	('CB_SHIPFREQCHANGE', 'Player *p, int newship, int oldship, int newfreq, int oldfreq'),
+	('CB_ARENAACTION', 'Arena *arena, int action')]
+
+def generateFunction(rng, out, header, lines, usearenadata):
+	print >>out, header
+	print >>out, '{'
+	if usearenadata:
+		print >>out, '\t$usearenadata(ad, arena);'
+	print >>out, '\tint i, total = 0;'
+	for i in xrange(lines):
+		kind = rng.randrange(6)
+		if kind == 0:
+			print >>out, '\tfor (i = 0; i < %d; i++)\n\t{\n\t\ttotal += i * %d;\n\t}' % (rng.randrange(1, 64), rng.randrange(100))
+		elif kind == 1:
+			print >>out, '\tif (total > %d)\n\t\tlm->Log(L_INFO, "<bench> total %%d", total);' % rng.randrange(1000)
+		elif kind == 2 and usearenadata:
+			print >>out, '\tad->field%d += total;' % rng.randrange(usearenadata)
+		elif kind == 3:
+			print >>out, '\t/* %s */' % ('x' * rng.randrange(10, 60))
+		else:
+			print >>out, '\ttotal = (total << %d) ^ %d;' % (rng.randrange(1, 8), rng.randrange(1 << 16))
+	print >>out, '\t(void)total;'
+	print >>out, '}'
+
+def generateModule(rng, name, sizes):
+	out = StringIO()
+	print >>out, '$#module ' + name
+	print >>out, '#include <string.h>'
+	print >>out
+	print >>out, '$#require global Ilogman'
+	print >>out, '$#require global Ichat'
+	print >>out
+
+	print >>out, '$#playerdata'
+	for i in xrange(sizes['playerdata_fields']):
+		print >>out, '%s field%d;' % (rng.choice(FieldTypes), i)
+	print >>out, '$#endplayerdata'
+	print >>out
+
+	print >>out, '$#arenadata'
+	for i in xrange(max(sizes['arenadata_fields'], 1)):
+		print >>out, 'int field%d;' % i
+	print >>out, '$#endarenadata'
+	print >>out
+
+	for i in xrange(sizes['functions']):
+		generateFunction(rng, out, 'local int helper%d(Arena *arena, int x)' % i,
+			sizes['function_lines'], sizes['arenadata_fields'])
+		print >>out
+
+	for i in xrange(sizes['callbacks']):
+		callback, params = rng.choice(Callbacks)
+		print >>out, '$#callback arena ' + callback
+		generateFunction(rng, out, 'local void callback%d(%s)' % (i, params),
+			sizes['function_lines'] / 4, 0)
+		print >>out, '$#endcallback'
+		print >>out
+
+	for i in xrange(sizes['commands']):
+		print >>out, '$#command arena bench%d,benchalias%d' % (i, i)
+		print >>out, '"Targets: none"'
+		print >>out, '"Args: none"'
+		print >>out, '"Synthetic command %d."' % i
+		generateFunction(rng, out, 'local void Cbench%d(const char *command, const char *params, Player *p, const Target *target)' % i,
+			sizes['function_lines'] / 4, 0)
+		print >>out, '$#endcommand'
+		print >>out
+
+	for i in xrange(sizes['implements']):
+		print >>out, '$#implement global Ibench%s%d' % (name, i)
+		for j in xrange(4):
+			generateFunction(rng, out, 'local int bench%d_%d(Arena *arena, int x)' % (i, j),
+				sizes['function_lines'] / 4, sizes['arenadata_fields'])
+		print >>out, '$#endimplement'
+		print >>out
+
+	print >>out, '$#load'
+	print >>out, '\tlm->Log(L_INFO, "<%s> loaded");' % name
+	print >>out, '$#endload'
+	return out.getvalue()
+
+def generateCorpus(seed, sizes):
+	rng = random.Random(seed)
+	return [('bench%d.aces' % i, generateModule(rng, 'bench%d' % i, sizes))
+		for i in xrange(sizes['modules'])]
+
+def corpusHash(corpus):
+	h = hashlib.sha1()
+	for filename, text in corpus:
+		h.update(filename + '\0' + text + '\0')
+	return h.hexdigest()
+
+def peakMemory():
+	# ru_maxrss is in kilobytes on linux and bytes on mac os
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	if sys.platform == 'darwin':
+		peak /= 1024
+	return peak
+
+def runOnce(corpus, options):
+	parse_time = 0.0
+	emit_time = 0.0
+	output_bytes = 0
+	for filename, text in corpus:
+		module = ace.ACEModule()
+		processor = ace.Processor(filename, module, text)
+		module.source_file = filename
+		if options.use_line_directives:
+			processor.use_line_directives = True
+			module.use_line_directives = True
+
+		start = time.time()
+		processor.process()
+		parse_time += time.time() - start
+
+		output = StringIO()
+		start = time.time()
+		module.writeOut(output)
+		emit_time += time.time() - start
+		output_bytes += output.tell()
+	return parse_time, emit_time, output_bytes
+
+# dynamic data, $failload() in a load block and a command with an alias, so
+# --check-lines sees expansions that span several lines of output
+LineCheckSource = """$#module linecheck
+$#require global Ilogman lm
+$#playerdata dynamic
+int count;
+ticks_t last;
+$#endplayerdata
+
+$#command arena linecheck,lc
+local void Clinecheck(const char *command, const char *params, Player *p, const Target *target)
+{
+	$useplayerdata(pd, p);
+	pd->count++;
+}
+$#endcommand
+
+$#load
+	if (!lm)
+	{
+		$failload("no logman %d", 1);
+	}
+$#endload
+"""
+
+def checkLines(corpus):
+	# --compact-lines must leave every line of code attributed to the same
+	# line of the source as the full #line directives do. returns the names of
+	# the modules where it doesn't.
+	failed = []
+	for filename, text in corpus + [('linecheck.aces', LineCheckSource)]:
+		module = ace.parseModule(text, filename, {'use_line_directives': True})
+		full = ace.renderModule(module)['output']
+		compact = ace.compactLineDirectives(full)
+		if ace.presumedLines(full) <> ace.presumedLines(compact):
+			failed.append(filename)
+	return failed
+
+def runBenchmark(corpus, options):
+	lines = sum([text.count('\n') for filename, text in corpus])
+
+	# the best of several runs is the least disturbed by everything else
+	# running on the machine
+	best_parse = best_emit = None
+	for i in xrange(options.repeat):
+		parse_time, emit_time, output_bytes = runOnce(corpus, options)
+		if best_parse is None or parse_time < best_parse:
+			best_parse = parse_time
+		if best_emit is None or emit_time < best_emit:
+			best_emit = emit_time
+
+	peak = peakMemory()
+	return {'format': BENCH_FORMAT,
+		'ace_version': ace.ACE_VERSION,
+		'python': sys.version.split()[0],
+		'corpus_hash': corpusHash(corpus),
+		'seed': options.seed,
+		'line_directives': bool(options.use_line_directives),
+		'modules': len(corpus),
+		'lines': lines,
+		'output_bytes': output_bytes,
+		'repeat': options.repeat,
+		'process_seconds': best_parse,
+		'writeout_seconds': best_emit,
+		'process_lines_per_second': lines / max(best_parse, 1e-9),
+		'total_lines_per_second': lines / max(best_parse + best_emit, 1e-9),
+		'peak_memory_kb': peak}
+
+def printResult(result):
+	total = result['process_seconds'] + result['writeout_seconds']
+	print 'corpus:    %d modules, %d lines, %d bytes of output (%s%s)' % (result['modules'],
+		result['lines'], result['output_bytes'], result['corpus_hash'][0:12],
+		result['line_directives'] and ', -l' or '')
+	print 'process:   %8.3fs  %5.1f%%  %10.0f lines/s' % (result['process_seconds'],
+		100 * result['process_seconds'] / max(total, 1e-9), result['process_lines_per_second'])
+	print 'writeOut:  %8.3fs  %5.1f%%' % (result['writeout_seconds'],
+		100 * result['writeout_seconds'] / max(total, 1e-9))
+	print 'total:     %8.3fs         %10.0f lines/s' % (total, result['total_lines_per_second'])
+	print 'memory:    %d KB peak' % result['peak_memory_kb']
+
+def compareResults(baseline, result, threshold):
+	# returns True if no phase is slower than the baseline by more than
+	# threshold percent
+	if baseline.get('format') <> BENCH_FORMAT:
+		sys.stderr.write('error: baseline was written by a different version of acebench\n')
+		return False
+	if baseline.get('corpus_hash') <> result['corpus_hash'] \
+		or baseline.get('line_directives') <> result['line_directives']:
+		sys.stderr.write('error: baseline was measured on a different corpus, use the same sizes, --seed and -l\n')
+		return False
+
+	ok = True
+	for key in ('process_seconds', 'writeout_seconds'):
+		before = baseline[key]
+		after = result[key]
+		change = 100.0 * (after - before) / max(before, 1e-9)
+		flag = ''
+		if change > threshold:
+			flag = '  REGRESSION'
+			ok = False
+		print '%-17s %8.3fs -> %8.3fs  %+6.1f%%%s' % (key + ':', before, after, change, flag)
+	return ok
+
+def makeOptionParser():
+	parser = OptionParser(usage='Usage: acebench.py [options]')
+	parser.add_option("--modules", dest="modules", type="int", default=20,
+		help="number of modules in the corpus")
+	parser.add_option("--callbacks", dest="callbacks", type="int", default=20,
+		help="$#callback blocks per module")
+	parser.add_option("--commands", dest="commands", type="int", default=20,
+		help="$#command blocks per module")
+	parser.add_option("--implements", dest="implements", type="int", default=5,
+		help="$#implement blocks per module, with four functions each")
+	parser.add_option("--functions", dest="functions", type="int", default=20,
+		help="plain functions per module")
+	parser.add_option("--function-lines", dest="function_lines", type="int", default=100,
+		help="statements in each plain function, a quarter of that in the others")
+	parser.add_option("--playerdata-fields", dest="playerdata_fields", type="int", default=200,
+		help="fields in the $#playerdata struct")
+	parser.add_option("--arenadata-fields", dest="arenadata_fields", type="int", default=50,
+		help="fields in the $#arenadata struct, 0 to leave out $usearenadata")
+	parser.add_option("--seed", dest="seed", type="int", default=1,
+		help="seed for generating the corpus")
+	parser.add_option("-r", "--repeat", dest="repeat", type="int", default=3,
+		help="runs to take the best time from")
+	parser.add_option("-l", "--line-directives", dest="use_line_directives", action="store_true",
+		help="translate with #line directives")
+	parser.add_option("--check-lines", dest="check_lines", action="store_true",
+		help="check that --compact-lines attributes every line of code to the same source line, instead of timing")
+	parser.add_option("--write-corpus", dest="corpus_dir",
+		help="write the generated modules into this directory")
+	parser.add_option("--json", dest="json_file",
+		help="write the results as JSON to this file, - for stdout")
+	parser.add_option("--compare", dest="baseline_file",
+		help="compare with results written by --json")
+	parser.add_option("--threshold", dest="threshold", type="float", default=10.0,
+		help="percent slowdown reported as a regression by --compare")
+	return parser
+
+def main(argv=None):
+	(options, args) = makeOptionParser().parse_args(argv)
+	if args:
+		sys.stderr.write('error: acebench.py takes no arguments\n')
+		return 64
+	if options.repeat < 1:
+		sys.stderr.write('error: --repeat must be at least 1\n')
+		return 64
+
+	sizes = {}
+	for key in ('modules', 'callbacks', 'commands', 'implements', 'functions',
+		'function_lines', 'playerdata_fields', 'arenadata_fields'):
+		sizes[key] = getattr(options, key)
+	corpus = generateCorpus(options.seed, sizes)
+
+	if options.corpus_dir:
+		if not os.path.isdir(options.corpus_dir):
+			os.makedirs(options.corpus_dir)
+		for filename, text in corpus:
+			handle = open(os.path.join(options.corpus_dir, filename), 'w')
+			handle.write(text)
+			handle.close()
+
+	if options.check_lines:
+		try:
+			failed = checkLines(corpus)
+		except ace.ProcessingException, e:
+			sys.stderr.write(e.message())
+			sys.stderr.write('\n')
+			return 1
+		for filename in failed:
+			sys.stderr.write('error: %s: --compact-lines moves lines of code\n' % filename)
+		if failed:
+			return 1
+		print 'lines:     %d modules attributed the same with --compact-lines' % (len(corpus) + 1)
+		return 0
+
+	try:
+		result = runBenchmark(corpus, options)
+	except ace.ProcessingException, e:
+		sys.stderr.write(e.message())
+		sys.stderr.write('\n')
+		return 1
+	result['sizes'] = sizes
+
+	if options.json_file == '-':
+		json.dump(result, sys.stdout, indent=1, sort_keys=True)
+		print
+	else:
+		printResult(result)
+		if options.json_file:
+			handle = open(options.json_file, 'w')
+			json.dump(result, handle, indent=1, sort_keys=True)
+			handle.close()
+
+	if options.baseline_file:
+		handle = open(options.baseline_file)
+		baseline = json.load(handle)
+		handle.close()
+		if not compareResults(baseline, result, options.threshold):
+			return 1
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# tests for ace.py, run with: python test_ace.py
+
+import os, shutil, tempfile, unittest
+import ace
+
+class ImportTest(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		ace.FragmentCache.clear()
+		self.write('h.aces', '$#require global Ichat\n'
+			'typedef int hint;\n'
+			'local hint hhelper(void)\n'
+			'{\n'
+			'\treturn 1;\n'
+			'}\n'
+			'$#load\n'
+			'\tchat->SendMessage(NULL, "h loaded");\n'
+			'$#endload\n')
+		self.write('f.aces', '$#import "h.aces"\n'
+			'local int fuse(void)\n'
+			'{\n'
+			'\treturn hhelper();\n'
+			'}\n')
+		self.write('g.aces', 'local int gfirst(void)\n'
+			'{\n'
+			'\treturn 0;\n'
+			'}\n'
+			'$#import "h.aces"\n'
+			'local int guse(void)\n'
+			'{\n'
+			'\treturn hhelper();\n'
+			'}\n')
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def write(self, name, text):
+		handle = open(os.path.join(self.dir, name), 'w')
+		handle.write(text)
+		handle.close()
+
+	def translate(self, text):
+		return ace.translate(text, os.path.join(self.dir, 'm.aces'))
+
+	def assertOnce(self, code, *texts):
+		for text in texts:
+			self.assertEqual(code.count(text), 1, text + ' occurs ' +
+				str(code.count(text)) + ' times')
+
+	def testSameImportTwice(self):
+		code = self.translate('$#module m\n$#import "h.aces"\n$#import "h.aces"\n')
+		self.assertOnce(code, 'typedef int hint;', 'hint hhelper(void)\n', 'h loaded')
+
+	def testDiamond(self):
+		code = self.translate('$#module m\n$#import "f.aces"\n$#import "g.aces"\n')
+		self.assertOnce(code, 'typedef int hint;', 'hint hhelper(void)\n', 'h loaded',
+			'int fuse(void)\n', 'int gfirst(void)\n', 'int guse(void)\n')
+
+	def testDiamondInFragment(self):
+		self.write('k.aces', '$#import "f.aces"\n$#import "g.aces"\n')
+		code = self.translate('$#module m\n$#import "g.aces"\n$#import "k.aces"\n$#import "h.aces"\n')
+		self.assertOnce(code, 'typedef int hint;', 'hint hhelper(void)\n', 'h loaded',
+			'int fuse(void)\n', 'int gfirst(void)\n', 'int guse(void)\n')
+
+	def testDataLayoutMismatch(self):
+		self.write('d.aces', '$#playerdata\nint count;\n$#endplayerdata\n')
+		self.assertRaises(ace.ProcessingException, self.translate,
+			'$#module m\n$#import "d.aces"\n$#playerdata dynamic\nint more;\n$#endplayerdata\n')
+
+class ScanHeaderTest(unittest.TestCase):
+	def testAttributes(self):
+		scan = ace.scanHeader('#define I_CHAT "chat-7"\n'
+			'typedef struct Ichat\n{\n\tINTERFACE_HEAD_DECL\n'
+			'\tvoid (*SendMessage)(Player *p, const char *format, ...)\n'
+			'\t\tATTR_FORMAT(printf, 2, 3);\n'
+			'\tvoid (*SendArenaMessage)(Arena *arena, const char *format, ...)\n'
+			'\t\t__attribute__((format(printf, 2, 3)));\n'
+			'} Ichat;\n')
+		self.assertEqual(scan['types']['Ichat'], ('I_CHAT', [
+			('void', 'SendMessage', 'Player *p, const char *format, ...'),
+			('void', 'SendArenaMessage', 'Arena *arena, const char *format, ...')]))
+
+	def testTaggedStruct(self):
+		scan = ace.scanHeader('#define I_FOO "foo-1"\n'
+			'struct Ifoo\n{\n\tINTERFACE_HEAD_DECL\n\tint (*Get)(int a);\n};\n'
+			'typedef struct Ifoo Ifoo;\n')
+		self.assertEqual(scan['types']['Ifoo'], ('I_FOO', [('int', 'Get', 'int a')]))
+
+	def testTaggedStructNamedFirst(self):
+		scan = ace.scanHeader('#define I_FOO "foo-1"\n'
+			'typedef struct Ifoo Ifoo;\n'
+			'struct Ifoo\n{\n\tINTERFACE_HEAD_DECL\n\tint (*Get)(int a);\n};\n')
+		self.assertEqual(scan['types']['Ifoo'], ('I_FOO', [('int', 'Get', 'int a')]))
+
+	def testCallbackAttributes(self):
+		scan = ace.scanHeader('#define CB_FOO "foo"\n'
+			'typedef void (*FooFunc)(Player *p, int x) ATTR_UNUSED();\n')
+		self.assertEqual(scan['callbacks']['CB_FOO'], ('void', 'FooFunc', 'Player *p, int x'))
+
+class LoadOrderTest(unittest.TestCase):
+	def testProvidersFirst(self):
+		self.assertEqual(ace.loadOrder(3, [(0, 1, 'I_B', True), (1, 2, 'I_C', True)]), [2, 1, 0])
+
+	def testCycleIsOneUnit(self):
+		# c (2) needs a (0), which is in a cycle with b (1)
+		edges = [(2, 0, 'I_A', True), (0, 1, 'I_B', True), (1, 0, 'I_A', True)]
+		self.assertEqual(ace.loadOrder(3, edges), [0, 1, 2])
+		# and the cycle needs d (3)
+		edges.append((1, 3, 'I_D', True))
+		self.assertEqual(ace.loadOrder(4, edges), [3, 0, 1, 2])
+
+if __name__ == '__main__':
+	unittest.main()